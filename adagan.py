@@ -6,6 +6,7 @@
 
 """
 
+import os
 import logging
 import numpy as np
 import gan as GAN
@@ -15,7 +16,63 @@ from utils import ArraySaver
 from metrics import Metrics
 import utils
 
-class AdaGan(object):
+class Mixture(object):
+    """Sampling from a mixture of trained components.
+
+    Subclasses set steps_made, _mixture_weights, _weights (data weights,
+    utils.SparseWeights) and _saver holding the samples of the components.
+    """
+
+    @property
+    def _data_weights(self):
+        """Dense (num_points,) array of the current data weights.
+
+        """
+        return self._weights.dense()
+
+    def sample_mixture(self, num=100):
+        """Sample num elements from the current AdaGAN mixture of generators.
+
+        In this code we are not storing individual TensorFlow graphs
+        corresponding to every one of the already trained component generators.
+        Instead, we sample enough of points once per every trained
+        generator and store these samples. Later, in order to sample from the
+        mixture, we first define which component to sample from and then
+        pick points uniformly from the corresponding stored sample.
+
+        """
+
+        #First we define how many points do we need
+        #from each of the components
+        component_ids = np.random.choice(self.steps_made, num,
+                                         p=self._mixture_weights)
+        points_per_component = np.bincount(component_ids,
+                                           minlength=self.steps_made)
+
+        # Next we sample required number of points per component,
+        # the stored samples of the other components are not loaded
+        sample = []
+        for comp_id  in xrange(self.steps_made):
+            _num = points_per_component[comp_id]
+            if _num == 0:
+                continue
+            comp_samples = self.component_sample(comp_id)
+            sample.append(
+                comp_samples[np.random.randint(len(comp_samples), size=_num)])
+
+        # Finally we shuffle
+        res = np.concatenate(sample)
+        np.random.shuffle(res)
+
+        return res
+
+    def component_sample(self, comp_id):
+        """The sample stored for the trained component comp_id.
+
+        """
+        return self._saver.load('samples{:02d}.npy'.format(comp_id))
+
+class AdaGan(Mixture):
     """This class implements the AdaGAN meta-algorithm.
 
     The class provides the 'make_step' method, which calls Gan.train()
@@ -35,7 +92,8 @@ class AdaGan(object):
         self.steps_made = 0
         num = data.num_points
         self._data_num = num
-        self._data_weights = np.ones(num) / (num + 0.)
+        # Data weights are kept on their support, see utils.SparseWeights
+        self._weights = utils.SparseWeights.uniform(num)
         self._mixture_weights = np.zeros(0)
         self._beta_heur = opts['beta_heur']
         self._saver = ArraySaver('disk', workdir=opts['work_dir'])
@@ -107,7 +165,7 @@ class AdaGan(object):
                 the relevant info about it.
         """
 
-        with self._gan_class(opts, data, self._data_weights) as gan:
+        with self._gan_class(opts, data, self._weights) as gan:
 
             beta = self._next_mixture_weight(opts)
             if self.steps_made > 0 and not opts['is_bagging']:
@@ -116,9 +174,11 @@ class AdaGan(object):
                 # (a) We are running the very first GAN instance
                 # (b) We are bagging, in which case the weughts are always uniform
                 self._update_data_weights(opts, gan, beta, data)
-                gan._data_weights = np.copy(self._data_weights)
+                gan._data_weights = self._weights
 
-            # Train GAN
+            # Train GAN, each component exports its own frozen generator
+            gan._export_dir = os.path.join(
+                opts['work_dir'], 'generator{:02d}'.format(self.steps_made))
             gan.train(opts)
             # Save a sample
             logging.debug('Saving a sample from the trained component...')
@@ -156,48 +216,10 @@ class AdaGan(object):
         else:
             scaled_old_weights = [v * (1.0 - beta) for v in self._mixture_weights]
             self._mixture_weights = np.array(scaled_old_weights + [beta])
+        # Together with the exported generators, see sampling_server.py
+        self._saver.save('mixture_weights.npy', self._mixture_weights)
         self.steps_made += 1
 
-    def sample_mixture(self, num=100):
-        """Sample num elements from the current AdaGAN mixture of generators.
-
-        In this code we are not storing individual TensorFlow graphs
-        corresponding to every one of the already trained component generators.
-        Instead, we sample enough of points once per every trained
-        generator and store these samples. Later, in order to sample from the
-        mixture, we first define which component to sample from and then
-        pick points uniformly from the corresponding stored sample.
-
-        """
-
-        #First we define how many points do we need
-        #from each of the components
-        component_ids = []
-        for _ in xrange(num):
-            new_id = np.random.choice(self.steps_made, 1,
-                                      p=self._mixture_weights)[0]
-            component_ids.append(new_id)
-        points_per_component = [component_ids.count(i)
-                                for i in xrange(self.steps_made)]
-
-        # Next we sample required number of points per component
-        sample = []
-        for comp_id  in xrange(self.steps_made):
-            _num = points_per_component[comp_id]
-            if _num == 0:
-                continue
-            comp_samples = self._saver.load('samples{:02d}.npy'.format(comp_id))
-            for _ in xrange(_num):
-                sample.append(
-                    comp_samples[np.random.randint(len(comp_samples))])
-
-        # Finally we shuffle
-        res = np.array(sample)
-        np.random.shuffle(res)
-
-        return res
-
-
     def _next_mixture_weight(self, opts):
         """Returns a weight, corresponding to the next mixture component.
 
@@ -231,19 +253,20 @@ class AdaGan(object):
         prob_real_data = self._get_prob_real_data(opts, gan, data)
         prob_real_data = prob_real_data.flatten()
         density_ratios = (1. - prob_real_data) / (prob_real_data + 1e-8)
-        self._data_weights = self._compute_data_weights(opts,
-                                                        density_ratios, beta)
+        self._weights = self._compute_data_weights(opts,
+                                                   density_ratios, beta)
+        logging.debug('Support of the data weights: %d of %d points' % (
+            self._weights.support_size, self._data_num))
         # We may also print some debug info on the computed weights
         utils.debug_updated_weights(opts, self.steps_made,
-                                    self._data_weights, data)
-
+                                    self._weights, data)
 
     def _compute_data_weights(self, opts, density_ratios, beta):
         """Compute a discrite distribution over the training points.
 
         Given per-point estimates of dP_current_model(x)/dP_data(x), compute
         the discrite distribution over the training points, which is called
-        W_t in the arXiv paper, see Algorithm 1.
+        W_t in the arXiv paper, see Algorithm 1. Returns SparseWeights.
         """
 
         heur = opts['weights_heur']
@@ -269,10 +292,9 @@ class AdaGan(object):
                                   opts["topk_constant"]*100.0)
         # Note that largest prob_real_data corresponds to smallest density
         # ratios.
-        mask = density_ratios <= threshold
-        data_weights = np.zeros(self._data_num)
-        data_weights[mask] = 1.0 / np.sum(mask)
-        return data_weights
+        ids = np.flatnonzero(density_ratios <= threshold)
+        return utils.SparseWeights(
+            ids, np.ones(len(ids)) / len(ids), self._data_num)
 
     def _compute_data_weights_theory_star(self, beta, ratios):
         """Theory-inspired reweighting of training points.
@@ -300,11 +322,10 @@ class AdaGan(object):
                     is_found = True
                     break
         # Next we compute the actual weights using equation (17)
-        data_weights = np.zeros(num)
         if is_found:
             _lambdamask = ratios <= (_lambda / (1.-beta))
-            data_weights[_lambdamask] = (_lambda -
-                                         (1-beta)*ratios[_lambdamask]) / num / beta
+            ids = np.flatnonzero(_lambdamask)
+            data_weights = (_lambda - (1-beta)*ratios[ids]) / num / beta
             logging.debug(
                 'Lambda={}, sum={}, deleted points={}'.format(
                     _lambda,
@@ -316,12 +337,11 @@ class AdaGan(object):
             # resulting weights do not necessarily need to some
             # to one.
             data_weights = data_weights / np.sum(data_weights)
-            return data_weights
+            return utils.SparseWeights(ids, data_weights, num)
         else:
             logging.debug(
                 '[WARNING] Lambda search failed, passing uniform weights')
-            data_weights = np.ones(num) / (num + 0.)
-            return data_weights
+            return utils.SparseWeights.uniform(num)
 
     def _compute_data_weights_theory_dagger(self, beta, ratios):
         """Theory-inspired reweighting of training points.
@@ -350,11 +370,11 @@ class AdaGan(object):
                     is_found = True
                     break
         # Next we compute the actual weights using equation (17)
-        data_weights = np.zeros(num)
         if is_found:
             _lambdamask = ratios <= (1. / (1.-beta) / _lambda)
-            data_weights[_lambdamask] = \
-                (1. - _lambda * (1-beta) * ratios[_lambdamask]) / num / beta
+            ids = np.flatnonzero(_lambdamask)
+            data_weights = \
+                (1. - _lambda * (1-beta) * ratios[ids]) / num / beta
             logging.debug(
                 'Lambda={}, sum={}, deleted points={}'.format(
                     _lambda,
@@ -366,12 +386,11 @@ class AdaGan(object):
             # resulting weights do not necessarily need to some
             # to one.
             data_weights = data_weights / np.sum(data_weights)
-            return data_weights
+            return utils.SparseWeights(ids, data_weights, num)
         else:
             logging.warning(
                 '[WARNING] Lambda search failed, passing uniform weights')
-            data_weights = np.ones(num) / (num + 0.)
-            return data_weights
+            return utils.SparseWeights.uniform(num)
 
     def _get_prob_real_data(self, opts, gan, data):
         """Train a classifier, separating true data from the current mixture.
@@ -392,3 +411,19 @@ class AdaGan(object):
         utils.debug_mixture_classifier(opts, self.steps_made, prob_real,
                                        data.data, real=True)
         return prob_real
+
+class MixtureSnapshot(Mixture):
+    """The mixture of an AdaGan after its last step.
+
+    Only the mixture weights, the data weights and the saver of the
+    component sample files are kept, so the snapshot can be sent to
+    another process and stays valid while the AdaGan makes further steps.
+    """
+
+    def __init__(self, adagan):
+        self.steps_made = adagan.steps_made
+        self._mixture_weights = np.copy(adagan._mixture_weights)
+        self._weights = adagan._weights
+        self._saver = adagan._saver
+        if hasattr(adagan, '_invert_losses'):
+            self._invert_losses = np.copy(adagan._invert_losses)
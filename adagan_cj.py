@@ -14,8 +14,9 @@ import logging
 import tensorflow as tf
 from datahandler import DataHandler
 from adagan import AdaGan
-from metrics import Metrics
+from metrics import Metrics, MixtureEvaluator
 import utils
+import async_eval
 
 flags = tf.app.flags
 flags.DEFINE_float("g_learning_rate", 0.016,
@@ -65,9 +66,19 @@ def main():
     opts['optimizer'] = 'adam' # sgd, adam
     opts["batch_size"] = 64
     opts["d_steps"] = 1
+    opts["fused_updates"] = False # One session.run per minibatch, image and unrolled GANs
     opts["g_steps"] = 1
     opts["verbose"] = True
     opts['tf_run_batch_size'] = 100
+    opts['tf_intra_op_threads'] = 0 # 0 lets TensorFlow decide
+    opts['tf_inter_op_threads'] = 0
+    opts['tf_thread_affinity'] = None # e.g. 'granularity=fine,compact,1,0'
+    opts['tf_autotune'] = False # Benchmark thread settings per model class
+    opts['export_generator'] = True # Write a frozen decoder after training
+    opts['weights_mode'] = 'resample' # Or 'loss': uniform minibatches, data weights in the losses
+    opts['debug_plots'] = True # Plots of the extreme data weights and classifier outputs
+    opts['debug_max_points'] = 10 ** 6 # Debug plots use a random subset of larger datasets
+    opts['async_eval'] = True # Evaluate step t in a background process while step t + 1 trains
 
     opts['gmm_modes_num'] = 5
     opts['latent_space_dim'] = FLAGS.zdim
@@ -85,6 +96,8 @@ def main():
     opts["early_stop"] = -1 # set -1 to run normally
     opts["plot_every"] = 1 # 50 # set -1 to run normally
     opts["eval_points_num"] = 3000 # 25600
+    opts['frechet_num_points'] = 0 # Frechet distance of the classifier features, 0 to skip
+    opts['cached_eval'] = True # Mixture metrics from cached per-component predictions
     opts['digit_classification_threshold'] = 0.999
     opts['objective'] = FLAGS.objective
     opts['inverse_metric'] = False # Use metric from the Unrolled GAN paper?
@@ -129,32 +142,55 @@ def main():
 
     data = DataHandler(opts)
     assert data.num_points >= opts['batch_size'], 'Training set too small'
-    adagan = AdaGan(opts, data)
     metrics = Metrics()
+    if opts['cached_eval']:
+        evaluator = MixtureEvaluator(
+            opts, features=opts['frechet_num_points'] > 0)
 
-    for step in range(opts["adagan_steps_total"]):
-        logging.info('Running step {} of AdaGAN'.format(step + 1))
-        adagan.make_step(opts, data)
+    def evaluate(step, mixture):
         num_fake = opts['eval_points_num']
+        if opts['dataset'] != 'gmm' and opts['cached_eval']:
+            # The metrics come from the cached component predictions,
+            # only the plotted points are sampled
+            num_fake = 4 * 16
         logging.debug('Sampling fake points')
-        fake_points = adagan.sample_mixture(num_fake)
-        logging.debug('Sampling more fake points')
-        more_fake_points = adagan.sample_mixture(500)
+        fake_points = mixture.sample_mixture(num_fake)
+        if opts['dataset'] == 'gmm' or not opts['cached_eval']:
+            logging.debug('Sampling more fake points')
+            more_fake_points = mixture.sample_mixture(500)
         logging.debug('Plotting results')
         if opts['dataset'] == 'gmm':
             metrics.make_plots(opts, step, data.data[:500],
-                    fake_points[0:100], adagan._data_weights[:500])
+                    fake_points[0:100], mixture._data_weights[:500])
             logging.debug('Evaluating results')
-            (likelihood, C) = metrics.evaluate(
+            res = metrics.evaluate(
                 opts, step, data.data[:500],
                 fake_points, more_fake_points, prefix='')
         else:
             metrics.make_plots(opts, step, data.data,
-                    fake_points[:4 * 16], adagan._data_weights)
+                    fake_points[:4 * 16], mixture._data_weights)
             logging.debug('Evaluating results')
-            res = metrics.evaluate(
-                opts, step, data.data[:500],
-                fake_points, more_fake_points, prefix='')
+            if opts['cached_eval']:
+                res = evaluator.evaluate(opts, step, mixture, data.data)
+            else:
+                res = metrics.evaluate(
+                    opts, step, data.data[:500],
+                    fake_points, more_fake_points, prefix='')
+            if opts['frechet_num_points'] > 0 and not opts['cached_eval']:
+                metrics.evaluate_frechet(
+                    opts, step, data.data, mixture.sample_mixture,
+                    opts['frechet_num_points'])
+        return res
+
+    # Forked before AdaGan creates any TensorFlow session
+    eval_worker = async_eval.Evaluator(evaluate, opts['async_eval'])
+    adagan = AdaGan(opts, data)
+
+    for step in range(opts["adagan_steps_total"]):
+        logging.info('Running step {} of AdaGAN'.format(step + 1))
+        adagan.make_step(opts, data)
+        eval_worker.submit(step, adagan)
+    eval_worker.close()
     logging.debug("AdaGan finished working!")
 
 if __name__ == '__main__':
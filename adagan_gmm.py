@@ -63,8 +63,18 @@ def main():
     opts["batch_size"] = 64
     opts["d_steps"] = 1
     opts["g_steps"] = 1
+    opts["fused_steps"] = 0 # >0: minibatches per session.run, toy GANs only
+    opts["fused_updates"] = False # One session.run per minibatch, unrolled toy GAN
     opts["verbose"] = True
     opts['tf_run_batch_size'] = 100
+    opts['tf_intra_op_threads'] = 0 # 0 lets TensorFlow decide
+    opts['tf_inter_op_threads'] = 0
+    opts['tf_thread_affinity'] = None # e.g. 'granularity=fine,compact,1,0'
+    opts['tf_autotune'] = False # Benchmark thread settings per model class
+    opts['export_generator'] = True # Write a frozen decoder after training
+    opts['weights_mode'] = 'resample' # Or 'loss': uniform minibatches, data weights in the losses
+    opts['debug_plots'] = True # Plots of the extreme data weights and classifier outputs
+    opts['debug_max_points'] = 10 ** 6 # Debug plots use a random subset of larger datasets
     opts['objective'] = 'JS'
 
     opts['gmm_modes_num'] = 3
@@ -17,6 +17,7 @@ from datahandler import DataHandler
 from adagan import AdaGan
 from metrics import Metrics
 import utils
+import async_eval
 
 flags = tf.app.flags
 flags.DEFINE_float("g_learning_rate", 0.0008,
@@ -62,9 +63,19 @@ def main():
     opts['optimizer'] = 'adam' # sgd, adam
     opts["batch_size"] = 64
     opts["d_steps"] = 1
+    opts["fused_updates"] = False # One session.run per minibatch, image and unrolled GANs
     opts["g_steps"] = 1
     opts["verbose"] = True
     opts['tf_run_batch_size'] = 100
+    opts['tf_intra_op_threads'] = 0 # 0 lets TensorFlow decide
+    opts['tf_inter_op_threads'] = 0
+    opts['tf_thread_affinity'] = None # e.g. 'granularity=fine,compact,1,0'
+    opts['tf_autotune'] = False # Benchmark thread settings per model class
+    opts['export_generator'] = True # Write a frozen decoder after training
+    opts['weights_mode'] = 'resample' # Or 'loss': uniform minibatches, data weights in the losses
+    opts['debug_plots'] = True # Plots of the extreme data weights and classifier outputs
+    opts['debug_max_points'] = 10 ** 6 # Debug plots use a random subset of larger datasets
+    opts['async_eval'] = True # Evaluate step t in a background process while step t + 1 trains
 
     opts['gmm_modes_num'] = 5
     opts['latent_space_dim'] = FLAGS.zdim
@@ -98,35 +109,43 @@ def main():
 
     data = DataHandler(opts)
     assert data.num_points >= opts['batch_size'], 'Training set too small'
-    adagan = AdaGan(opts, data)
     metrics = Metrics()
 
-    for step in range(opts["adagan_steps_total"]):
-        logging.info('Running step {} of AdaGAN'.format(step + 1))
-        adagan.make_step(opts, data)
+    def evaluate(step, mixture):
         num_fake = opts['eval_points_num']
         logging.debug('Sampling fake points')
-        fake_points = adagan.sample_mixture(num_fake)
+        fake_points = mixture.sample_mixture(num_fake)
         logging.debug('Sampling more fake points')
-        more_fake_points = adagan.sample_mixture(500)
+        more_fake_points = mixture.sample_mixture(500)
         logging.debug('Plotting results')
         if opts['dataset'] == 'gmm':
             metrics.make_plots(opts, step, data.data[:500],
-                    fake_points[0:100], adagan._data_weights[:500])
+                    fake_points[0:100], mixture._data_weights[:500])
             logging.debug('Evaluating results')
-            (likelihood, C) = metrics.evaluate(
+            res = metrics.evaluate(
                 opts, step, data.data[:500],
                 fake_points, more_fake_points, prefix='')
         else:
             metrics.make_plots(opts, step, data.data,
-                    fake_points[:6 * 16], adagan._data_weights)
+                    fake_points[:6 * 16], mixture._data_weights)
             logging.debug('Evaluating results')
             if opts['inverse_metric']:
-                l2 = np.min(adagan._invert_losses[:step + 1], axis=0)
+                l2 = np.min(mixture._invert_losses[:step + 1], axis=0)
                 logging.debug('MSE=%.5f, STD=%.5f' % (np.mean(l2), np.std(l2)))
             res = metrics.evaluate(
                 opts, step, data.data[:500],
                 fake_points, more_fake_points, prefix='')
+        return res
+
+    # Forked before AdaGan creates any TensorFlow session
+    eval_worker = async_eval.Evaluator(evaluate, opts['async_eval'])
+    adagan = AdaGan(opts, data)
+
+    for step in range(opts["adagan_steps_total"]):
+        logging.info('Running step {} of AdaGAN'.format(step + 1))
+        adagan.make_step(opts, data)
+        eval_worker.submit(step, adagan)
+    eval_worker.close()
     logging.debug("AdaGan finished working!")
 
 if __name__ == '__main__':
@@ -16,7 +16,9 @@ import numpy as np
 from datahandler import DataHandler
 from adagan import AdaGan
 from metrics import Metrics
+import knn
 import utils
+import async_eval
 
 flags = tf.app.flags
 flags.DEFINE_float("g_learning_rate", 0.001,
@@ -48,6 +50,15 @@ def main():
     opts['ckpt_dir'] = 'checkpoints'
     opts["verbose"] = 1
     opts['tf_run_batch_size'] = 128
+    opts['tf_intra_op_threads'] = 0 # 0 lets TensorFlow decide
+    opts['tf_inter_op_threads'] = 0
+    opts['tf_thread_affinity'] = None # e.g. 'granularity=fine,compact,1,0'
+    opts['tf_autotune'] = False # Benchmark thread settings per model class
+    opts['export_generator'] = True # Write a frozen decoder after training
+    opts['weights_mode'] = 'resample' # Or 'loss': uniform minibatches, data weights in the losses
+    opts['debug_plots'] = True # Plots of the extreme data weights and classifier outputs
+    opts['debug_max_points'] = 10 ** 6 # Debug plots use a random subset of larger datasets
+    opts['async_eval'] = True # Evaluate step t in a background process while step t + 1 trains
     opts["early_stop"] = -1 # set -1 to run normally
     opts["plot_every"] = 50
     opts["save_every_epoch"] = 10
@@ -71,6 +82,8 @@ def main():
     opts['topk_constant'] = 0.5
     opts["mixture_c_epoch_num"] = 5
     opts["eval_points_num"] = 25600
+    opts['knn_metrics'] = False # Precision/recall and distances to the training set
+    opts['knn_mode'] = 'exact' # exact or projection (approximate)
     opts['digit_classification_threshold'] = 0.999
     opts['inverse_metric'] = False # Use metric from the Unrolled GAN paper?
     opts['inverse_num'] = 100 # Number of real points to inverse.
@@ -112,6 +125,7 @@ def main():
     opts['pot_lambda'] = FLAGS.pot_lambda
     opts['adv_c_loss'] = 'none'
     opts['vgg_layer'] = 'pool2'
+    opts['vgg_feature_cache'] = False # Compute VGG features of real points once
     opts['adv_c_patches_size'] = 5
     opts['adv_c_num_units'] = 32
     opts['adv_c_loss_w'] = 1.0
@@ -129,6 +143,7 @@ def main():
     opts['optimizer'] = 'adam' # sgd, adam
     opts["batch_size"] = 100
     opts["d_steps"] = 1
+    opts["fused_updates"] = False # One session.run per minibatch, image and unrolled GANs
     opts['d_new_minibatch'] = False
     opts["g_steps"] = 2
     opts['batch_norm'] = True
@@ -165,40 +180,49 @@ def main():
 
     data = DataHandler(opts)
     assert data.num_points >= opts['batch_size'], 'Training set too small'
-    adagan = AdaGan(opts, data)
     metrics = Metrics()
 
-    train_size = data.num_points
-    random_idx = np.random.choice(train_size, 4*320, replace=False)
-    metrics.make_plots(opts, 0, data.data,
-            data.data[random_idx], adagan._data_weights, prefix='dataset_')
-
-    for step in range(opts["adagan_steps_total"]):
-        logging.info('Running step {} of AdaGAN'.format(step + 1))
-        adagan.make_step(opts, data)
+    def evaluate(step, mixture):
         num_fake = opts['eval_points_num']
         logging.debug('Sampling fake points')
-        fake_points = adagan.sample_mixture(num_fake)
+        fake_points = mixture.sample_mixture(num_fake)
         logging.debug('Sampling more fake points')
-        more_fake_points = adagan.sample_mixture(500)
+        more_fake_points = mixture.sample_mixture(500)
         logging.debug('Plotting results')
         if opts['dataset'] == 'gmm':
             metrics.make_plots(opts, step, data.data[:500],
-                    fake_points[0:100], adagan._data_weights[:500])
+                    fake_points[0:100], mixture._data_weights[:500])
             logging.debug('Evaluating results')
-            (likelihood, C) = metrics.evaluate(
+            res = metrics.evaluate(
                 opts, step, data.data[:500],
                 fake_points, more_fake_points, prefix='')
         else:
             metrics.make_plots(opts, step, data.data,
-                    fake_points[:320], adagan._data_weights)
+                    fake_points[:320], mixture._data_weights)
             if opts['inverse_metric']:
                 logging.debug('Evaluating results')
-                l2 = np.min(adagan._invert_losses[:step + 1], axis=0)
+                l2 = np.min(mixture._invert_losses[:step + 1], axis=0)
                 logging.debug('MSE=%.5f, STD=%.5f' % (np.mean(l2), np.std(l2)))
             res = metrics.evaluate(
                 opts, step, data.data[:500],
                 fake_points, more_fake_points, prefix='')
+            if opts['knn_metrics']:
+                knn.evaluate(opts, step, data, fake_points)
+        return res
+
+    # Forked before AdaGan creates any TensorFlow session
+    eval_worker = async_eval.Evaluator(evaluate, opts['async_eval'])
+    adagan = AdaGan(opts, data)
+    train_size = data.num_points
+    random_idx = np.random.choice(train_size, 4*320, replace=False)
+    metrics.make_plots(opts, 0, data.data,
+            data.data[random_idx], adagan._data_weights, prefix='dataset_')
+
+    for step in range(opts["adagan_steps_total"]):
+        logging.info('Running step {} of AdaGAN'.format(step + 1))
+        adagan.make_step(opts, data)
+        eval_worker.submit(step, adagan)
+    eval_worker.close()
     logging.debug("AdaGan finished working!")
 
 if __name__ == '__main__':
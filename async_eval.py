@@ -0,0 +1,119 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Evaluating AdaGAN steps in a background process.
+
+Evaluating the mixture after step t (sampling, plots, metrics) only needs
+the mixture weights and the stored samples of the components, so it can
+run in a worker process while the main one trains the component of step
+t + 1.
+"""
+
+import os
+import logging
+import traceback
+import multiprocessing
+from six.moves import queue
+from adagan import MixtureSnapshot
+
+# Seconds between the checks that the worker is alive while waiting
+POLL_INTERVAL = 5.
+
+class Evaluator(object):
+    """Runs eval_fn(step, mixture) for the AdaGAN steps submitted.
+
+    mixture is an adagan.MixtureSnapshot. With background=True a worker
+    process evaluates the steps one by one, in the order they were
+    submitted. The worker is forked when the Evaluator is created and
+    inherits eval_fn together with its state, so create it before any
+    TensorFlow session: a forked TensorFlow runtime may hang. Otherwise
+    eval_fn is called right away in submit().
+
+    The training process of TensorFlow reserves almost all the memory of
+    the GPUs it uses, so unless use_gpu=True the worker does not see the
+    GPUs and its sessions run on the CPU.
+    """
+
+    def __init__(self, eval_fn, background=True, use_gpu=False):
+        self._eval_fn = eval_fn
+        self._steps = []
+        self._results = []
+        self._process = None
+        if background:
+            self._tasks = multiprocessing.Queue()
+            self._done = multiprocessing.Queue()
+            self._process = multiprocessing.Process(
+                target=_work,
+                args=(eval_fn, self._tasks, self._done, use_gpu))
+            self._process.daemon = True
+            self._process.start()
+
+    def submit(self, step, adagan):
+        """Evaluates the current mixture of adagan as the one of step.
+
+        """
+        mixture = MixtureSnapshot(adagan)
+        self._steps.append(step)
+        if self._process is None:
+            self._results.append((step, self._eval_fn(step, mixture)))
+            return
+        self._tasks.put((step, mixture))
+        self.collect()
+
+    def collect(self, block=False):
+        """(step, result) of the steps evaluated so far, in order.
+
+        With block=True waits for all the steps submitted. Fails if the
+        worker died before sending the result of some step.
+        """
+        while len(self._results) < len(self._steps):
+            try:
+                step, ok, res = self._done.get(block, POLL_INTERVAL)
+            except queue.Empty:
+                if self._process.is_alive():
+                    if block:
+                        continue
+                    break
+                try:
+                    # The worker may have sent the result right before exiting
+                    step, ok, res = self._done.get(False)
+                except queue.Empty:
+                    assert False, \
+                        'Evaluation worker died (exit code %s) on step %d' % (
+                            self._process.exitcode,
+                            self._steps[len(self._results)])
+            assert ok, 'Evaluation of step %d failed:\n%s' % (step, res)
+            logging.debug('Evaluation of step %d collected' % step)
+            self._results.append((step, res))
+        return list(self._results)
+
+    def close(self):
+        """Waits for the evaluations left and stops the worker.
+
+        Returns the results of all the steps, see collect().
+        """
+        if self._process is not None:
+            if len(self._results) < len(self._steps):
+                logging.info('Waiting for the evaluation of %d steps' % (
+                    len(self._steps) - len(self._results)))
+            self.collect(block=True)
+            self._tasks.put(None)
+            self._process.join()
+            self._process = None
+        return list(self._results)
+
+def _work(eval_fn, tasks, done, use_gpu):
+    if not use_gpu:
+        # No CUDA context exists yet in the worker, so this is enough to
+        # keep its sessions off the GPUs
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        step, mixture = task
+        try:
+            done.put((step, True, eval_fn(step, mixture)))
+        except Exception:
+            done.put((step, False, traceback.format_exc()))
@@ -0,0 +1,145 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Non-blocking checkpointing of the model variables.
+
+"""
+
+import os
+import logging
+import threading
+from six.moves import queue
+import tensorflow as tf
+
+TMP_PREFIX = '.tmp-'
+
+class AsyncSaver(object):
+    """Saves checkpoints of the variables on a background thread.
+
+    On save() the values of the variables are copied into memory with a
+    single session.run and the training can continue right away. A worker
+    thread writes them to disk using a mirror graph with the same variable
+    names, so the checkpoints are compatible with the main tf.train.Saver
+    (and tf.train.import_meta_graph). Files are first written under a
+    temporary prefix and renamed afterwards, the .index file last, so a
+    crash never leaves a half-written checkpoint behind.
+
+    Only the last keep_last checkpoints are kept, plus the one with the
+    smallest score (if scores are provided).
+    """
+
+    def __init__(self, session, saver, keep_last=10, background=True):
+        self._session = session
+        self._var_list = tf.global_variables()
+        # Meta graph is the same for every checkpoint, serialize it once.
+        self._meta_graph = saver.export_meta_graph().SerializeToString()
+        self._keep_last = keep_last
+        self._background = background
+        self._saved = []
+        self._best = None
+        self._error = None
+        self._build_mirror()
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = None
+        if background:
+            self._thread = threading.Thread(target=self._worker)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _build_mirror(self):
+        """Graph with one variable per model variable, fed by placeholders.
+
+        """
+        self._graph = tf.Graph()
+        self._placeholders = []
+        mirror_vars = {}
+        with self._graph.as_default():
+            for var in self._var_list:
+                name = var.op.name
+                placeholder = tf.placeholder(
+                    var.dtype.base_dtype, var.get_shape(),
+                    name='snapshot/' + name)
+                mirror = tf.Variable(placeholder, trainable=False,
+                                     collections=[], name=name)
+                self._placeholders.append(placeholder)
+                mirror_vars[name] = mirror
+            self._load_ops = [v.initializer for v in mirror_vars.values()]
+            self._mirror_saver = tf.train.Saver(mirror_vars, max_to_keep=None)
+        self._mirror_session = tf.Session(graph=self._graph)
+
+    def save(self, save_path, global_step=None, score=None):
+        """Snapshot the variables and schedule writing them to save_path.
+
+        """
+        self._check_error()
+        if global_step is not None:
+            save_path = '%s-%d' % (save_path, global_step)
+        values = self._session.run(self._var_list)
+        if self._background:
+            # Blocks only if the previous checkpoint is still being written.
+            self._queue.put((save_path, values, score))
+        else:
+            self._write(save_path, values, score)
+        return save_path
+
+    def close(self):
+        """Wait until all the pending checkpoints are written.
+
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._mirror_session.close()
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception as e:
+                logging.error('Failed to write checkpoint %s' % item[0])
+                self._error = e
+
+    def _write(self, save_path, values, score):
+        dirname, basename = os.path.split(save_path)
+        tmp_path = os.path.join(dirname, TMP_PREFIX + basename)
+        feed = dict(zip(self._placeholders, values))
+        self._mirror_session.run(self._load_ops, feed_dict=feed)
+        self._mirror_saver.save(self._mirror_session, tmp_path,
+                                write_meta_graph=False, write_state=False)
+        with tf.gfile.GFile(tmp_path + '.meta', 'wb') as f:
+            f.write(self._meta_graph)
+        # The checkpoint is valid as soon as its .index file exists.
+        tmp_files = tf.gfile.Glob(tmp_path + '.*')
+        tmp_files.sort(key=lambda name: name.endswith('.index'))
+        for tmp_file in tmp_files:
+            tf.gfile.Rename(tmp_file, save_path + tmp_file[len(tmp_path):],
+                            overwrite=True)
+        self._update_retention(save_path, score)
+        tf.train.update_checkpoint_state(
+            dirname, save_path, [path for path, _ in self._saved])
+
+    def _update_retention(self, save_path, score):
+        self._saved = [el for el in self._saved if el[0] != save_path]
+        self._saved.append((save_path, score))
+        if score is not None and (self._best is None or score < self._best[1]):
+            self._best = (save_path, score)
+        keep = set(path for path, _ in self._saved[-self._keep_last:])
+        if self._best is not None:
+            keep.add(self._best[0])
+        for path, _ in self._saved:
+            if path not in keep:
+                for name in tf.gfile.Glob(path + '.*'):
+                    tf.gfile.Remove(name)
+        self._saved = [el for el in self._saved if el[0] in keep]
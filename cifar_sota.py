@@ -48,6 +48,14 @@ def main():
     opts['ckpt_dir'] = 'checkpoints'
     opts["verbose"] = 1
     opts['tf_run_batch_size'] = 128
+    opts['tf_intra_op_threads'] = 0 # 0 lets TensorFlow decide
+    opts['tf_inter_op_threads'] = 0
+    opts['tf_thread_affinity'] = None # e.g. 'granularity=fine,compact,1,0'
+    opts['tf_autotune'] = False # Benchmark thread settings per model class
+    opts['export_generator'] = True # Write a frozen decoder after training
+    opts['weights_mode'] = 'resample' # Or 'loss': uniform minibatches, data weights in the losses
+    opts['debug_plots'] = True # Plots of the extreme data weights and classifier outputs
+    opts['debug_max_points'] = 10 ** 6 # Debug plots use a random subset of larger datasets
     opts["early_stop"] = -1 # set -1 to run normally
     opts["plot_every"] = 150
     opts["save_every_epoch"] = 10
@@ -112,6 +120,7 @@ def main():
     opts['pot_lambda'] = FLAGS.pot_lambda
     opts['adv_c_loss'] = 'conv'
     opts['vgg_layer'] = 'pool2'
+    opts['vgg_feature_cache'] = False # Compute VGG features of real points once
     opts['adv_c_patches_size'] = 5
     opts['adv_c_num_units'] = 32
     opts['adv_c_loss_w'] = 1.0
@@ -128,6 +137,7 @@ def main():
     opts['optimizer'] = 'adam' # sgd, adam
     opts["batch_size"] = 100
     opts["d_steps"] = 1
+    opts["fused_updates"] = False # One session.run per minibatch, image and unrolled GANs
     opts['d_new_minibatch'] = False
     opts["g_steps"] = 2
     opts['batch_norm'] = True
@@ -15,6 +15,7 @@ import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import utils
+import export
 
 z_dim = 64
 pz_std = 2.
@@ -24,24 +25,31 @@ num_pairs = 10
 ckpt_dir = os.path.join('.', 'trained_celeba_gan')
 output_dir = 'trained_celeba_gan/pics'
 normalyze = True
+noise_seed = 0
+export_dir = os.path.join(ckpt_dir, 'generator')
 
 with tf.Session() as sess:
-    saver = tf.train.import_meta_graph(
-        # os.path.join('.', 'results_cifar10_pot_conv', 'checkpoints', 'trained-pot-1.meta'))
-        os.path.join(ckpt_dir, 'trained-pot-126480.meta'))
-    saver.restore(sess, os.path.join(ckpt_dir, 'trained-pot-126480'))
-    # saver.restore(sess, os.path.join('.', 'results_cifar10_pot_conv', 'checkpoints', 'trained-pot-1'))
-    noise_ph = tf.get_collection('noise_ph')[0]
-    bn_ph = tf.get_collection('is_training_ph')[0]
-    decoder = tf.get_collection('decoder')[0]
+    if tf.gfile.Exists(os.path.join(export_dir, export.META_FILE)):
+        # Frozen decoder written at the end of the training
+        decode = export.FrozenGenerator(export_dir).decode
+    else:
+        saver = tf.train.import_meta_graph(
+            # os.path.join('.', 'results_cifar10_pot_conv', 'checkpoints', 'trained-pot-1.meta'))
+            os.path.join(ckpt_dir, 'trained-pot-126480.meta'))
+        saver.restore(sess, os.path.join(ckpt_dir, 'trained-pot-126480'))
+        # saver.restore(sess, os.path.join('.', 'results_cifar10_pot_conv', 'checkpoints', 'trained-pot-1'))
+        noise_ph = tf.get_collection('noise_ph')[0]
+        bn_ph = tf.get_collection('is_training_ph')[0]
+        decoder = tf.get_collection('decoder')[0]
+
+        def decode(points):
+            return sess.run(decoder, feed_dict={noise_ph: points, bn_ph: False})
 
-    mean = np.zeros(z_dim)
-    cov = np.identity(z_dim)
-    noise = pz_std * np.random.multivariate_normal(
-        mean, cov, 16 * num_cols).astype(np.float32)
+    noise = utils.noise_chunk(z_dim, 16 * num_cols, scale=pz_std,
+                              seed=noise_seed)
 
     # 1. Random samples
-    res = sess.run(decoder, feed_dict={noise_ph: noise, bn_ph: False})
+    res = decode(noise)
     metrics = Metrics()
     opts = {}
     opts['dataset'] = dataset
@@ -78,7 +86,7 @@ with tf.Session() as sess:
             _lambda = np.linspace(0., 1., 60)
             _lambda = np.reshape(_lambda, (60, 1))
             line = np.dot(_lambda, a) + np.dot((1 - _lambda), b)
-            pics = sess.run(decoder, feed_dict={noise_ph: line, bn_ph: False})
+            pics = decode(line)
             if normalyze:
                 pics = (pics + 1.) / 2.
             if res is None:
@@ -130,7 +138,7 @@ with tf.Session() as sess:
         _lambda = np.linspace(0., np.sqrt(z_dim * pz_std * pz_std) * 5, 30)
         _lambda = np.reshape(_lambda, (30, 1))
         line = np.dot(_lambda, b)
-        res = sess.run(decoder, feed_dict={noise_ph: line, bn_ph: False})
+        res = decode(line)
         metrics = Metrics()
         opts = {}
         opts['dataset'] = dataset
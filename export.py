@@ -0,0 +1,138 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Export of trained generators as frozen, inference-only graphs.
+
+The exported directory contains generator.pb, a GraphDef with all the
+variables replaced by constants, and generator.json with its metadata.
+FrozenGenerator loads it without the training code.
+"""
+
+import os
+import json
+import logging
+import numpy as np
+import tensorflow as tf
+
+GRAPH_FILE = 'generator.pb'
+META_FILE = 'generator.json'
+
+def export_generator(model, opts, export_dir):
+    """Write the decoder of a trained model to export_dir.
+
+    The decoder is built again in a new graph with batch normalization in
+    inference mode, using model._decoder_for_export. Every variable it asks
+    for is replaced with a constant holding the trained value, so only the
+    decoder ops end up in the exported graph.
+    """
+    src_graph = model._session.graph
+    src_vars = dict((var.op.name, var) for var in
+                    src_graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES))
+
+    def _frozen_getter(getter, name, *args, **kwargs):
+        assert name in src_vars, 'Variable %s not found in the model' % name
+        value = model._session.run(src_vars[name])
+        return tf.constant(value, name=name.split('/')[-1])
+
+    pz_scale = model._export_pz_scale(opts)
+    graph = tf.Graph()
+    with graph.as_default():
+        num_ph = tf.placeholder_with_default(
+            tf.constant(1, dtype=tf.int32), [], name='num')
+        shape = tf.stack([num_ph, opts['latent_space_dim']])
+        if opts['latent_space_distr'] == 'uniform':
+            noise = tf.random_uniform(shape, -1., 1.)
+        else:
+            noise = tf.random_normal(shape)
+        noise_ph = tf.placeholder_with_default(
+            pz_scale * noise, [None, opts['latent_space_dim']], name='noise')
+        with tf.variable_scope(tf.get_variable_scope(),
+                               custom_getter=_frozen_getter):
+            decoded = model._decoder_for_export(opts, noise_ph)
+        output = tf.identity(decoded, name='decoder')
+    graph_def = graph.as_graph_def()
+    graph_def = _fold_constants(graph_def, ['num', 'noise'], ['decoder'])
+
+    if not tf.gfile.IsDirectory(export_dir):
+        tf.gfile.MakeDirs(export_dir)
+    with tf.gfile.GFile(os.path.join(export_dir, GRAPH_FILE), 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    meta = {'num': 'num:0',
+            'noise': 'noise:0',
+            'output': 'decoder:0',
+            'latent_space_dim': opts['latent_space_dim'],
+            'latent_space_distr': opts['latent_space_distr'],
+            'pz_scale': pz_scale,
+            'data_shape': list(model._data.data_shape),
+            'input_normalize_sym': opts['input_normalize_sym']}
+    with tf.gfile.GFile(os.path.join(export_dir, META_FILE), 'w') as f:
+        f.write(json.dumps(meta, indent=2))
+    logging.error('Generator exported to %s' % export_dir)
+    return export_dir
+
+def _fold_constants(graph_def, inputs, outputs):
+    """Fold batch normalization and other constant subgraphs.
+
+    """
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+    except ImportError:
+        logging.error('Graph transforms not available, batch norm not folded')
+        return graph_def
+    return TransformGraph(
+        graph_def, inputs, outputs,
+        ['fold_constants(ignore_errors=true)',
+         'fold_batch_norms',
+         'fold_old_batch_norms'])
+
+class FrozenGenerator(object):
+    """Generator loaded from the directory written by export_generator.
+
+    """
+
+    def __init__(self, export_dir, config=None):
+        with tf.gfile.GFile(os.path.join(export_dir, META_FILE), 'r') as f:
+            self.meta = json.loads(f.read())
+        graph_def = tf.GraphDef()
+        with tf.gfile.GFile(os.path.join(export_dir, GRAPH_FILE), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+        self._num = self._graph.get_tensor_by_name(self.meta['num'])
+        self._noise = self._graph.get_tensor_by_name(self.meta['noise'])
+        self._output = self._graph.get_tensor_by_name(self.meta['output'])
+        self._session = tf.Session(graph=self._graph, config=config)
+
+    def decode(self, noise, batch_size=1000):
+        """Decoder outputs for the latent points in noise.
+
+        """
+        res = np.empty([len(noise)] + self.meta['data_shape'],
+                       dtype=np.float32)
+        for start in xrange(0, len(noise), batch_size):
+            end = min(start + batch_size, len(noise))
+            res[start:end] = self._session.run(
+                self._output, feed_dict={self._noise: noise[start:end]})
+        return res
+
+    def sample(self, num, batch_size=1000):
+        """num samples, the latent noise is drawn inside the graph.
+
+        """
+        res = np.empty([num] + self.meta['data_shape'], dtype=np.float32)
+        for start in xrange(0, num, batch_size):
+            end = min(start + batch_size, num)
+            res[start:end] = self._session.run(
+                self._output, feed_dict={self._num: end - start})
+        return res
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -8,14 +8,16 @@
 
 import os
 import sys
+import time
+import threading
+import multiprocessing
 import tensorflow as tf
 import numpy as np
 import ops
 from metrics import Metrics
-import matplotlib
-matplotlib.use("Agg")
-import matplotlib.pyplot as plt
 import utils
+import export
+import image_grid
 from datahandler import DataHandler
 
 NUM_PICS = 10000
@@ -25,6 +27,9 @@ SAVE_FAKE_PICS = False
 CELEBA_DATA_DIR = 'celebA/datasets/celeba/img_align_celeba'
 MNIST_DATA_DIR = 'mnist'
 OUT_DIR = 'fid_pics_celeba'
+NOISE_SEED = 0 # Seed of the latent noise streams, to replay the samples
+BATCH_SIZE = 500 # Pictures decoded and handed to the PNG writers at once
+NUM_WORKERS = None # Processes encoding the PNGs, None for all the cores
 
 class ExpInfo(object):
     def __init__(self):
@@ -199,7 +204,6 @@ def main():
                 opts['data_dir'] = MNIST_DATA_DIR
             opts['celebA_crop'] = 'closecrop'
             data = DataHandler(opts)
-            pic_id = 1
             if dataset == 'celebA':
                 shuffled_ids = np.load(os.path.join(model_path, 'shuffled_training_ids'))
                 test_ids = shuffled_ids[-exp.test_size:]
@@ -212,24 +216,21 @@ def main():
                 train_ids = range(len(train_images))
                 test_ids = range(len(test_images))
             if SAVE_PNG:
-                for idx in test_ids:
-                    if pic_id % 1000 == 0:
-                        print 'Saved %d/%d' % (pic_id, NUM_PICS)
-                    save_pic(test_images[idx], os.path.join(pic_dir, 'real_image{:05d}.png'.format(pic_id)), exp)
-                    pic_id += 1
-                    if pic_id > NUM_PICS:
-                        break
+                writer = PngWriter(pic_dir, 'real_image', exp, NUM_PICS)
+                num_test = min(len(test_ids), NUM_PICS)
+                for start in xrange(0, num_test, BATCH_SIZE):
+                    ids = list(test_ids[start:min(start + BATCH_SIZE, num_test)])
+                    writer.write(start, test_images[ids])
             num_remain = max(NUM_PICS - len(test_ids), 0)
             train_size = data.num_points
             rand_train_ids = np.random.choice(train_size, num_remain, replace=False)
             rand_train_ids = [train_ids[idx] for idx in rand_train_ids]
             rand_train_pics = train_images[rand_train_ids]
             if SAVE_PNG:
-                for i in range(num_remain):
-                    if pic_id % 1000 == 0:
-                        print 'Saved %d/%d' % (pic_id, NUM_PICS)
-                    save_pic(rand_train_pics[i], os.path.join(pic_dir, 'real_image{:05d}.png'.format(pic_id)), exp)
-                    pic_id += 1
+                for start in xrange(0, num_remain, BATCH_SIZE):
+                    writer.write(num_test + start,
+                                 rand_train_pics[start:start + BATCH_SIZE])
+                writer.close()
             all_pics = np.vstack([test_images, rand_train_pics])
             all_pics = all_pics.astype(np.float)
             if len(all_pics) > NUM_PICS:
@@ -239,67 +240,109 @@ def main():
 
 
         if SAVE_FAKE_PICS:
+            pic_dir = os.path.join(output_dir, 'fake')
+            create_dir(pic_dir)
+            if SAVE_PNG:
+                # Forking before TensorFlow starts its threads
+                writer = PngWriter(pic_dir, 'fake_image', exp, NUM_PICS)
             with tf.Session() as sess:
                 with sess.graph.as_default():
-                    saver = tf.train.import_meta_graph(
-                        os.path.join(model_path, 'checkpoints', model_name_prefix + exp.model_id + '.meta'))
-                    saver.restore(sess, os.path.join(model_path, 'checkpoints', model_name_prefix + exp.model_id))
-                    real_points_ph = tf.get_collection('real_points_ph')[0]
-                    noise_ph = tf.get_collection('noise_ph')[0]
-                    is_training_ph = tf.get_collection('is_training_ph')[0]
-                    decoder = tf.get_collection('decoder')[0]
-
                     # Saving random samples
-                    mean = np.zeros(z_dim)
-                    cov = np.identity(z_dim)
-                    noise = pz_std * np.random.multivariate_normal(
-                        mean, cov, NUM_PICS).astype(np.float32)
-                    res = sess.run(decoder, feed_dict={noise_ph: noise, is_training_ph: False})
-                    pic_dir = os.path.join(output_dir, 'fake')
-                    create_dir(pic_dir)
-                    if SAVE_PNG:
-                        for i in range(1, NUM_PICS + 1):
-                            if i % 1000 == 0:
-                                print 'Saved %d/%d' % (i, NUM_PICS)
-                            save_pic(res[i-1], os.path.join(pic_dir, 'fake_image{:05d}.png'.format(i)), exp)
-                    np.save(os.path.join(output_dir, 'fake'), res)
+                    noise = utils.noise_chunk(z_dim, NUM_PICS, scale=pz_std,
+                                              seed=NOISE_SEED)
+                    export_dir = os.path.join(model_path, 'generator')
+                    if tf.gfile.Exists(os.path.join(export_dir, export.META_FILE)):
+                        # Frozen decoder written at the end of the training
+                        generator = export.FrozenGenerator(export_dir)
+                        decode = generator.decode
+                    else:
+                        saver = tf.train.import_meta_graph(
+                            os.path.join(model_path, 'checkpoints', model_name_prefix + exp.model_id + '.meta'))
+                        saver.restore(sess, os.path.join(model_path, 'checkpoints', model_name_prefix + exp.model_id))
+                        noise_ph = tf.get_collection('noise_ph')[0]
+                        is_training_ph = tf.get_collection('is_training_ph')[0]
+                        decoder = tf.get_collection('decoder')[0]
+                        generator = None
+                        decode = lambda z: sess.run(
+                            decoder, feed_dict={noise_ph: z, is_training_ph: False})
+                    # The writers encode a chunk while the next one is decoded
+                    res = []
+                    for start in xrange(0, NUM_PICS, BATCH_SIZE):
+                        pics = decode(noise[start:start + BATCH_SIZE])
+                        if SAVE_PNG:
+                            writer.write(start, pics)
+                        res.append(pics)
+                    if generator is not None:
+                        generator.close()
+            if SAVE_PNG:
+                writer.close()
+            np.save(os.path.join(output_dir, 'fake'), np.concatenate(res))
+
+class PngWriter(object):
+    """Encodes pictures as PNG files in a pool of processes.
+
+    write() only queues a chunk of pictures, so the caller can prepare the
+    next chunk while the previous ones are encoded. close() waits for all
+    the files and reports the throughput.
+    """
+
+    def __init__(self, pic_dir, prefix, exp, total, num_workers=NUM_WORKERS):
+        self._pic_dir = pic_dir
+        self._prefix = prefix
+        self._exp = exp
+        self._total = total
+        self._num_saved = 0
+        self._lock = threading.Lock()
+        self._results = []
+        self._pool = multiprocessing.Pool(num_workers)
+        self._start_time = time.time()
+
+    def _done(self, saved):
+        with self._lock:
+            before = self._num_saved
+            self._num_saved += len(saved)
+            if self._num_saved / 1000 > before / 1000:
+                print 'Saved %d/%d (%.1f pics/sec)' % (
+                    self._num_saved, self._total,
+                    self._num_saved / (time.time() - self._start_time))
+
+    def write(self, start, pics):
+        """Queues pics, numbered from start + 1 on.
+
+        """
+        tasks = [(pic, os.path.join(
+            self._pic_dir, '%s%05d.png' % (self._prefix, start + i + 1)),
+                  self._exp) for i, pic in enumerate(pics)]
+        self._results.append(self._pool.map_async(
+            _save_pic_task, tasks, chunksize=50, callback=self._done))
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        # Raises the errors of the workers, if any
+        for res in self._results:
+            res.get()
+        elapsed = time.time() - self._start_time
+        print 'Saved %d pics in %.1f sec (%.1f pics/sec)' % (
+            self._num_saved, elapsed, self._num_saved / max(elapsed, 1e-6))
+
+def _save_pic_task(args):
+    save_pic(*args)
+    return args[1]
 
 def save_pic(pic, path, exp):
     if len(pic.shape) == 4:
         pic = pic[0]
-    height = pic.shape[0]
-    width = pic.shape[1]
-    fig = plt.figure(frameon=False, figsize=(width, height))#, dpi=1)
-    ax = plt.Axes(fig, [0., 0., 1., 1.])
-    ax.set_axis_off()
-    fig.add_axes(ax)
     if exp.symmetrize:
         pic = (pic + 1.) / 2.
     if exp.dataset == 'mnist':
-        pic = pic[:, :, 0]
-        pic = 1. - pic
-    if exp.dataset == 'mnist':
-        ax.imshow(pic, cmap='Greys', interpolation='none')
-    else:
-        ax.imshow(pic, interpolation='none')
-    fig.savefig(path, dpi=1, format='png')
-    plt.close()
-    # if exp.dataset == 'mnist':
-    #     pic = pic[:, :, 0]
-    #     pic = 1. - pic
-    #     ax = plt.imshow(pic, cmap='Greys', interpolation='none')
-    # else:
-    #     ax = plt.imshow(pic, interpolation='none')
-    # ax.axes.get_xaxis().set_ticks([])
-    # ax.axes.get_yaxis().set_ticks([])
-    # ax.axes.set_xlim([0, width])
-    # ax.axes.set_ylim([height, 0])
-    # ax.axes.set_aspect(1)
-    # fig.savefig(path, format='png')
-    # plt.close()
+        # Light digits on black, as with 1 - pic and the Greys colormap
+        pic = pic[:, :, :1]
+    image_grid.save(pic, path)
 
 def create_dir(d):
     if not tf.gfile.IsDirectory(d):
         tf.gfile.MakeDirs(d)
 
-main()
+if __name__ == '__main__':
+    main()
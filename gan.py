@@ -6,9 +6,12 @@
 
 """
 
+import os
+import time
 import logging
 import tensorflow as tf
 import utils
+import export
 from utils import ProgressBar
 from utils import TQDM
 import numpy as np
@@ -26,11 +29,14 @@ class Gan(object):
     """
     def __init__(self, opts, data, weights):
 
-        # Create a new session with session.graph = default graph
-        self._session = tf.Session()
+        # The session is created once the graph is built
+        self._session = None
         self._trained = False
         self._data = data
-        self._data_weights = np.copy(weights)
+        # Where export_generator writes the frozen decoder by default
+        self._export_dir = None
+        # Dense arrays of weights are accepted as well
+        self._data_weights = utils.SparseWeights.from_dense(weights)
         # Latent noise sampled ones to apply G while training
         self._noise_for_plots = utils.generate_noise(opts, 500)
         # Placeholders
@@ -57,7 +63,8 @@ class Gan(object):
         self._c_optim = None
         self._inv_optim = None
 
-        with self._session.as_default(), self._session.graph.as_default():
+        graph = tf.get_default_graph()
+        with graph.as_default():
             logging.debug('Building the graph...')
             self._build_model_internal(opts)
             if opts['inverse_metric']:
@@ -65,11 +72,18 @@ class Gan(object):
                     'Invertion currently supported only for mnist, mnist3, guitars'
                 logging.debug('Adding inversion ops to the graph...')
                 self._add_inversion_ops(opts)
+            # Make sure AdamOptimizer, if used in the Graph, is defined before
+            # calling global_variables_initializer().
+            self._init_op = tf.global_variables_initializer()
+            tuning_step = None
+            if opts.get('tf_autotune', False):
+                tuning_step = self._tuning_step(opts)
 
-        # Make sure AdamOptimizer, if used in the Graph, is defined before
-        # calling global_variables_initializer().
-        init = tf.global_variables_initializer()
-        self._session.run(init)
+        # Create a new session with session.graph = default graph
+        self._session = utils.create_session(
+            opts, graph, name=type(self).__name__,
+            init_fn=self._init_session, tuning_step=tuning_step)
+        self._init_session(self._session)
 
     def __enter__(self):
         return self
@@ -82,6 +96,20 @@ class Gan(object):
         # Finishing the session
         self._session.close()
 
+    def _init_session(self, session):
+        session.run(self._init_op)
+
+    def _tuning_step(self, opts):
+        """Fetches and feed_dict of a training step, to benchmark sessions.
+
+        """
+        batch_size = opts['batch_size']
+        feed_dict = {self._real_points_ph: self._data.data[:batch_size]}
+        is_training_ph = getattr(self, '_is_training_ph', None)
+        if is_training_ph is not None:
+            feed_dict[is_training_ph] = True
+        return [self._d_optim, self._g_optim], feed_dict
+
     def train(self, opts):
         """Train a GAN model.
 
@@ -89,6 +117,8 @@ class Gan(object):
         with self._session.as_default(), self._session.graph.as_default():
             self._train_internal(opts)
             self._trained = True
+        if opts.get('export_generator', True):
+            self.export_generator(opts)
 
     def sample(self, opts, num=100):
         """Sample points from the trained GAN model.
@@ -98,6 +128,25 @@ class Gan(object):
         with self._session.as_default(), self._session.graph.as_default():
             return self._sample_internal(opts, num)
 
+    def export_generator(self, opts, export_dir=None):
+        """Write the trained decoder as a frozen graph, see export.py.
+
+        """
+        if export_dir is None:
+            export_dir = self._export_dir
+        if export_dir is None:
+            export_dir = os.path.join(opts['work_dir'], 'generator')
+        return export.export_generator(self, opts, export_dir)
+
+    def _export_pz_scale(self, opts):
+        return 1.
+
+    def _decoder_for_export(self, opts, noise):
+        """Decoder applied to noise, in the inference mode.
+
+        """
+        return self.generator(opts, noise, False)
+
     def train_mixture_discriminator(self, opts, fake_images):
         """Train classifier separating true data from points in fake_images.
 
@@ -273,6 +322,9 @@ class ToyGan(Gan):
 
     """
 
+    def _decoder_for_export(self, opts, noise):
+        return self.generator(opts, noise)
+
     def generator(self, opts, noise, reuse=False):
         """Generator function, suitable for simple toy experiments.
 
@@ -317,6 +369,113 @@ class ToyGan(Gan):
 
         return h2
 
+    def _gan_losses(self, opts, real_points, noise, reuse=False, weights=None):
+        """Generator output and the D, G losses on the given inputs.
+
+        weights are the per-example loss weights of the real points.
+        """
+        G = self.generator(opts, noise, reuse=reuse)
+
+        d_logits_real = self.discriminator(opts, real_points, reuse=reuse)
+        d_logits_fake = self.discriminator(opts, G, reuse=True)
+
+        d_loss_real = ops.weighted_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=d_logits_real, labels=tf.ones_like(d_logits_real)),
+            weights)
+        d_loss_fake = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=d_logits_fake, labels=tf.zeros_like(d_logits_fake)))
+        d_loss = d_loss_real + d_loss_fake
+
+        g_loss = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=d_logits_fake, labels=tf.ones_like(d_logits_fake)))
+
+        return {'G': G, 'd_loss': d_loss, 'g_loss': g_loss}
+
+    def _fused_schedule(self, opts):
+        """Updates done on every minibatch of the fused training.
+
+        """
+        return ['d'] * opts['d_steps'] + ['g'] * opts['g_steps']
+
+    def _build_fused_loop(self, opts):
+        """Run opts['fused_steps'] minibatch iterations in one session.run.
+
+        The dataset is held in the graph as a constant. The support of the
+        data weights (ids and values, see utils.SparseWeights) is kept in
+        variables of varying length, minibatches are sampled (with
+        replacement) over the support only, and every update draws its own
+        noise in the graph.
+        """
+        num_points = self._data.num_points
+        batch_size = opts['batch_size']
+        data = tf.constant(self._data.data, dtype=tf.float32)
+        support_ids = tf.Variable(
+            np.arange(num_points, dtype=np.int64), trainable=False,
+            validate_shape=False, name='fused_support_ids')
+        weights = tf.Variable(
+            np.ones(num_points, dtype=np.float32) / num_points,
+            trainable=False, validate_shape=False,
+            name='fused_data_weights')
+        ids_ph = tf.placeholder(tf.int64, [None], name='fused_support_ids_ph')
+        weights_ph = tf.placeholder(
+            tf.float32, [None], name='fused_data_weights_ph')
+        log_weights = tf.log(tf.maximum(tf.reshape(weights, [1, -1]), 1e-30))
+        support_ids_flat = tf.reshape(support_ids, [-1])
+        schedule = self._fused_schedule(opts)
+
+        def _body(step, d_loss_sum, g_loss_sum):
+            with tf.control_dependencies([step]):
+                pos = tf.multinomial(log_weights, batch_size)[0]
+                ids = tf.gather(support_ids_flat, pos)
+                real_points = tf.gather(data, ids)
+            deps = [step]
+            losses = {}
+            for kind in schedule:
+                with tf.control_dependencies(deps):
+                    update, losses[kind] = self._fused_update(
+                        opts, kind, real_points, batch_size)
+                deps = [update]
+            with tf.control_dependencies(deps):
+                return (step + 1,
+                        d_loss_sum + losses['d'],
+                        g_loss_sum + losses['g'])
+
+        num_steps = opts['fused_steps']
+        _, d_loss_sum, g_loss_sum = tf.while_loop(
+            lambda step, d_loss_sum, g_loss_sum: step < num_steps, _body,
+            [tf.constant(0), tf.constant(0.), tf.constant(0.)])
+
+        self._fused_weights_assign = tf.group(
+            tf.assign(support_ids, ids_ph, validate_shape=False),
+            tf.assign(weights, weights_ph, validate_shape=False))
+        self._fused_ids_ph = ids_ph
+        self._fused_weights_ph = weights_ph
+        self._fused_loop = [d_loss_sum / num_steps, g_loss_sum / num_steps]
+
+    def _fused_update(self, opts, kind, real_points, num, weights=None):
+        """Update op and loss of one step of the fused training.
+
+        The update draws num points of fresh noise in the graph.
+        """
+        noise = ops.sample_pz(opts, num)
+        reads = ops.FreshReads()
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True,
+                               custom_getter=reads):
+            losses = self._gan_losses(
+                opts, real_points, noise, reuse=True, weights=weights)
+        if kind == 'd':
+            update = reads.minimize(
+                self._d_optimizer, losses['d_loss'], 'DISCRIMINATOR/')
+            return update, losses['d_loss']
+        elif kind == 'g':
+            update = reads.minimize(
+                self._g_optimizer, losses['g_loss'], 'GENERATOR/')
+            return update, losses['g_loss']
+        assert False, 'Unknown fused update %s' % kind
+
     def _build_model_internal(self, opts):
         """Build the Graph corresponding to GAN implementation.
 
@@ -328,14 +487,16 @@ class ToyGan(Gan):
             tf.float32, [None] + list(data_shape), name='real_points_ph')
         fake_points_ph = tf.placeholder(
             tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        # Noise is sampled in the graph unless noise_ph is fed
+        noise_ph, noise_num_ph = ops.noise_placeholder(opts)
+        real_weights_ph = ops.weights_placeholder(real_points_ph)
 
         # Operations
-        G = self.generator(opts, noise_ph)
-
-        d_logits_real = self.discriminator(opts, real_points_ph)
-        d_logits_fake = self.discriminator(opts, G, reuse=True)
+        losses = self._gan_losses(
+            opts, real_points_ph, noise_ph, weights=real_weights_ph)
+        G = losses['G']
+        d_loss = losses['d_loss']
+        g_loss = losses['g_loss']
 
         c_logits_real = self.discriminator(
             opts, real_points_ph, prefix='CLASSIFIER')
@@ -344,18 +505,6 @@ class ToyGan(Gan):
         c_training = tf.nn.sigmoid(
             self.discriminator(opts, real_points_ph, prefix='CLASSIFIER', reuse=True))
 
-        d_loss_real = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_real, labels=tf.ones_like(d_logits_real)))
-        d_loss_fake = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_fake, labels=tf.zeros_like(d_logits_fake)))
-        d_loss = d_loss_real + d_loss_fake
-
-        g_loss = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_fake, labels=tf.ones_like(d_logits_fake)))
-
         c_loss_real = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
                 logits=c_logits_real, labels=tf.ones_like(c_logits_real)))
@@ -367,14 +516,22 @@ class ToyGan(Gan):
         t_vars = tf.trainable_variables()
         d_vars = [var for var in t_vars if 'DISCRIMINATOR/' in var.name]
         g_vars = [var for var in t_vars if 'GENERATOR/' in var.name]
-        d_optim = ops.optimizer(opts, 'd').minimize(d_loss, var_list=d_vars)
-        g_optim = ops.optimizer(opts, 'g').minimize(g_loss, var_list=g_vars)
+        # Optimizers are kept to reuse their slots in the fused training
+        self._d_optimizer = ops.optimizer(opts, 'd')
+        self._g_optimizer = ops.optimizer(opts, 'g')
+        d_optim = self._d_optimizer.minimize(d_loss, var_list=d_vars)
+        g_optim = self._g_optimizer.minimize(g_loss, var_list=g_vars)
         c_vars = [var for var in t_vars if 'CLASSIFIER/' in var.name]
         c_optim = ops.optimizer(opts).minimize(c_loss, var_list=c_vars)
 
+        if opts.get('fused_steps', 0) > 0:
+            self._build_fused_loop(opts)
+
         self._real_points_ph = real_points_ph
         self._fake_points_ph = fake_points_ph
         self._noise_ph = noise_ph
+        self._noise_num_ph = noise_num_ph
+        self._real_weights_ph = real_weights_ph
 
         self._G = G
         self._d_loss = d_loss
@@ -389,50 +546,102 @@ class ToyGan(Gan):
         """Train a GAN model.
 
         """
+        if opts.get('fused_steps', 0) > 0:
+            return self._train_fused(opts)
 
         batches_num = self._data.num_points / opts['batch_size']
         train_size = self._data.num_points
 
         counter = 0
+        train_metrics = utils.TrainingMetrics(
+            ['d_loss', 'g_loss'], window=batches_num)
+        sampler = utils.MinibatchSampler(
+            self._data_weights, opts['batch_size'],
+            opts.get('weights_mode', 'resample'))
         logging.debug('Training GAN')
         for _epoch in xrange(opts["gan_epoch_num"]):
             for _idx in xrange(batches_num):
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
+                data_ids, batch_weights = sampler.sample()
                 batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
                 # Update discriminator parameters
                 for _iter in xrange(opts['d_steps']):
-                    _ = self._session.run(
-                        self._d_optim,
+                    _, d_loss = self._session.run(
+                        [self._d_optim, self._d_loss],
                         feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise})
+                                   self._real_weights_ph: batch_weights})
                 # Update generator parameters
                 for _iter in xrange(opts['g_steps']):
-                    _ = self._session.run(
-                        self._g_optim, feed_dict={self._noise_ph: batch_noise})
+                    _, g_loss = self._session.run(
+                        [self._g_optim, self._g_loss])
+                train_metrics.update(d_loss=d_loss, g_loss=g_loss)
                 counter += 1
                 if opts['verbose'] and counter % opts['plot_every'] == 0:
+                    logging.debug(
+                        'Epoch: %d/%d, batch:%d/%d, d_loss=%.4f, g_loss=%.4f' % \
+                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num,
+                         train_metrics.mean('d_loss'),
+                         train_metrics.mean('g_loss')))
                     metrics = Metrics()
                     points_to_plot = self._run_batch(
                         opts, self._G, self._noise_ph,
                         self._noise_for_plots[0:320])
-                    data_ids = np.random.choice(train_size, 320,
-                                                replace=False,
-                                                p=self._data_weights)
+                    data_ids = self._data_weights.sample(320)
                     metrics.make_plots(
                         opts, counter,
                         self._data.data[data_ids],
                         points_to_plot,
                         prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
 
+    def _train_fused(self, opts):
+        """Train a GAN model with opts['fused_steps'] minibatches per run.
 
+        """
+
+        assert opts.get('weights_mode', 'resample') == 'resample', \
+            'Fused training supports only the resample weights mode'
+        num_steps = opts['fused_steps']
+        batches_num = self._data.num_points / opts['batch_size']
+        runs_num = max(1, batches_num / num_steps)
+        train_size = self._data.num_points
+
+        self._session.run(
+            self._fused_weights_assign,
+            feed_dict={self._fused_ids_ph: self._data_weights.ids,
+                       self._fused_weights_ph: self._data_weights.values})
+        counter = 0
+        train_metrics = utils.TrainingMetrics(
+            ['d_loss', 'g_loss'], window=runs_num)
+        logging.debug('Training GAN, %d minibatches per run' % num_steps)
+        for _epoch in xrange(opts["gan_epoch_num"]):
+            for _idx in TQDM(opts, xrange(runs_num),
+                             desc='Epoch %2d/%2d' %\
+                             (_epoch+1, opts["gan_epoch_num"])):
+                d_loss, g_loss = self._session.run(self._fused_loop)
+                train_metrics.update(d_loss=d_loss, g_loss=g_loss)
+                counter += num_steps
+                if opts['verbose'] and counter % opts['plot_every'] < num_steps:
+                    logging.debug(
+                        'Epoch: %d/%d, batch:%d/%d, d_loss=%.4f, g_loss=%.4f' % \
+                        (_epoch+1, opts['gan_epoch_num'],
+                         (_idx+1) * num_steps, batches_num,
+                         train_metrics.mean('d_loss'),
+                         train_metrics.mean('g_loss')))
+                    metrics = Metrics()
+                    points_to_plot = self._run_batch(
+                        opts, self._G, self._noise_ph,
+                        self._noise_for_plots[0:320])
+                    data_ids = self._data_weights.sample(320)
+                    metrics.make_plots(
+                        opts, counter,
+                        self._data.data[data_ids],
+                        points_to_plot,
+                        prefix='sample_e%04d_mb%05d_' % (_epoch, _idx))
 
     def _sample_internal(self, opts, num):
         """Sample from the trained GAN model.
 
         """
-        noise = utils.generate_noise(opts, num)
+        noise = utils.noise_pool(opts).get(num)
         sample = self._run_batch(opts, self._G, self._noise_ph, noise)
         # sample = self._session.run(
         #     self._G, feed_dict={self._noise_ph: noise})
@@ -464,6 +673,43 @@ class ToyGan(Gan):
         return res, None
 
 
+def unrolled_fused_step(opts, fused_update):
+    """All the updates of one minibatch of an unrolled GAN as a single op.
+
+    fused_update(kind) builds the update op and the loss of one update,
+    kind is 'd', 'roll_back', 'd_cp' or 'g'. The D updates, the roll back,
+    the unrolling steps and the G updates are chained with control
+    dependencies. The unrolling steps run in a tf.while_loop, so the graph
+    does not grow with unrolling_steps. Returns the D and G losses, which
+    are computed after all the updates ran.
+    """
+    deps = []
+    losses = {}
+    for _ in xrange(opts['d_steps']):
+        with tf.control_dependencies(deps):
+            update, losses['d'] = fused_update('d')
+        deps = [update]
+    with tf.control_dependencies(deps):
+        roll_back, _ = fused_update('roll_back')
+
+    def _unroll(step):
+        with tf.control_dependencies([step]):
+            update, _ = fused_update('d_cp')
+        with tf.control_dependencies([update]):
+            return step + 1
+
+    with tf.control_dependencies([roll_back]):
+        start = tf.identity(0)
+    unrolled = tf.while_loop(
+        lambda step: step < opts['unrolling_steps'], _unroll, [start])
+    deps = [unrolled]
+    for _ in xrange(opts['g_steps']):
+        with tf.control_dependencies(deps):
+            update, losses['g'] = fused_update('g')
+        deps = [update]
+    with tf.control_dependencies(deps):
+        return [tf.identity(losses['d']), tf.identity(losses['g'])]
+
 class ToyUnrolledGan(ToyGan):
     """A simple GAN implementation, suitable for toy datasets.
 
@@ -525,50 +771,35 @@ class ToyUnrolledGan(ToyGan):
 
         return h2
 
-    def _build_model_internal(self, opts):
-        """Build the Graph corresponding to GAN implementation.
+    def _gan_losses(self, opts, real_points, noise, reuse=False, weights=None):
+        """Generator output and the D, D copy and G losses on the inputs.
 
+        weights are the per-example loss weights of the real points.
         """
-        data_shape = self._data.data_shape
-
-        # Placeholders
-        real_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='real_points_ph')
-        fake_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        G = self.generator(opts, noise, reuse=reuse)
 
-        # Operations
-        G = self.generator(opts, noise_ph)
-
-        d_logits_real = self.discriminator(opts, real_points_ph)
+        d_logits_real = self.discriminator(opts, real_points, reuse=reuse)
         d_logits_fake = self.discriminator(opts, G, reuse=True)
 
         # Disccriminator copy for the unrolling steps
         d_logits_real_cp = self.discriminator(
-            opts, real_points_ph, prefix='DISCRIMINATOR_CP')
+            opts, real_points, prefix='DISCRIMINATOR_CP', reuse=reuse)
         d_logits_fake_cp = self.discriminator(
             opts, G, prefix='DISCRIMINATOR_CP', reuse=True)
 
-        c_logits_real = self.discriminator(
-            opts, real_points_ph, prefix='CLASSIFIER')
-        c_logits_fake = self.discriminator(
-            opts, fake_points_ph, prefix='CLASSIFIER', reuse=True)
-        c_training = tf.nn.sigmoid(
-            self.discriminator(opts, real_points_ph, prefix='CLASSIFIER', reuse=True))
-
-        d_loss_real = tf.reduce_mean(
+        d_loss_real = ops.weighted_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_real, labels=tf.ones_like(d_logits_real)))
+                logits=d_logits_real, labels=tf.ones_like(d_logits_real)),
+            weights)
         d_loss_fake = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
                 logits=d_logits_fake, labels=tf.zeros_like(d_logits_fake)))
         d_loss = d_loss_real + d_loss_fake
 
-        d_loss_real_cp = tf.reduce_mean(
+        d_loss_real_cp = ops.weighted_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_real_cp, labels=tf.ones_like(d_logits_real_cp)))
+                logits=d_logits_real_cp, labels=tf.ones_like(d_logits_real_cp)),
+            weights)
         d_loss_fake_cp = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
                 logits=d_logits_fake_cp,
@@ -584,6 +815,76 @@ class ToyUnrolledGan(ToyGan):
         else:
             assert False, 'No objective %r implemented' % opts['objective']
 
+        return {'G': G, 'd_loss': d_loss, 'd_loss_cp': d_loss_cp,
+                'g_loss': g_loss}
+
+    def _fused_schedule(self, opts):
+        return ['d'] * opts['d_steps'] + ['roll_back'] + \
+            ['d_cp'] * opts['unrolling_steps'] + ['g'] * opts['g_steps']
+
+    def _fused_update(self, opts, kind, real_points, num, weights=None):
+        if kind == 'roll_back':
+            roll_back = []
+            for var, var_cp in zip(self._d_vars, self._d_vars_cp):
+                roll_back.append(tf.assign(var_cp, var.read_value()))
+            return tf.group(*roll_back), None
+        elif kind == 'd_cp':
+            noise = ops.sample_pz(opts, num)
+            reads = ops.FreshReads()
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True,
+                                   custom_getter=reads):
+                losses = self._gan_losses(
+                    opts, real_points, noise, reuse=True, weights=weights)
+            update = reads.minimize(
+                self._d_optimizer_cp, losses['d_loss_cp'], 'DISCRIMINATOR_CP/')
+            return update, losses['d_loss_cp']
+        return ToyGan._fused_update(
+            self, opts, kind, real_points, num, weights)
+
+    def _build_fused_step(self, opts):
+        """All the updates of one minibatch as a single op.
+
+        Every update draws its own noise in the graph.
+        """
+        real_points = self._real_points_ph
+        weights = self._real_weights_ph
+        num = self._noise_num_ph
+
+        def _update(kind):
+            return self._fused_update(opts, kind, real_points, num, weights)
+
+        self._fused_step = unrolled_fused_step(opts, _update)
+
+    def _build_model_internal(self, opts):
+        """Build the Graph corresponding to GAN implementation.
+
+        """
+        data_shape = self._data.data_shape
+
+        # Placeholders
+        real_points_ph = tf.placeholder(
+            tf.float32, [None] + list(data_shape), name='real_points_ph')
+        fake_points_ph = tf.placeholder(
+            tf.float32, [None] + list(data_shape), name='fake_points_ph')
+        # Noise is sampled in the graph unless noise_ph is fed
+        noise_ph, noise_num_ph = ops.noise_placeholder(opts)
+        real_weights_ph = ops.weights_placeholder(real_points_ph)
+
+        # Operations
+        losses = self._gan_losses(
+            opts, real_points_ph, noise_ph, weights=real_weights_ph)
+        G = losses['G']
+        d_loss = losses['d_loss']
+        d_loss_cp = losses['d_loss_cp']
+        g_loss = losses['g_loss']
+
+        c_logits_real = self.discriminator(
+            opts, real_points_ph, prefix='CLASSIFIER')
+        c_logits_fake = self.discriminator(
+            opts, fake_points_ph, prefix='CLASSIFIER', reuse=True)
+        c_training = tf.nn.sigmoid(
+            self.discriminator(opts, real_points_ph, prefix='CLASSIFIER', reuse=True))
+
         c_loss_real = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
                 logits=c_logits_real, labels=tf.ones_like(c_logits_real)))
@@ -605,18 +906,29 @@ class ToyUnrolledGan(ToyGan):
             for var, var_cp in zip(d_vars, d_vars_cp):
                 roll_back.append(tf.assign(var_cp, var))
 
-        d_optim = ops.optimizer(opts, 'd').minimize(d_loss, var_list=d_vars)
-        d_optim_cp = ops.optimizer(opts, 'd').minimize(
+        # Optimizers are kept to reuse their slots in the fused training
+        self._d_optimizer = ops.optimizer(opts, 'd')
+        self._d_optimizer_cp = ops.optimizer(opts, 'd')
+        self._g_optimizer = ops.optimizer(opts, 'g')
+        d_optim = self._d_optimizer.minimize(d_loss, var_list=d_vars)
+        d_optim_cp = self._d_optimizer_cp.minimize(
            d_loss_cp,
            var_list=d_vars_cp)
         c_optim = ops.optimizer(opts).minimize(c_loss, var_list=c_vars)
-        g_optim = ops.optimizer(opts, 'g').minimize(g_loss, var_list=g_vars)
+        g_optim = self._g_optimizer.minimize(g_loss, var_list=g_vars)
+
+        self._d_vars = d_vars
+        self._d_vars_cp = d_vars_cp
+        if opts.get('fused_steps', 0) > 0:
+            self._build_fused_loop(opts)
 
         # writer = tf.summary.FileWriter(opts['work_dir']+'/tensorboard', self._session.graph)
 
         self._real_points_ph = real_points_ph
         self._fake_points_ph = fake_points_ph
         self._noise_ph = noise_ph
+        self._noise_num_ph = noise_num_ph
+        self._real_weights_ph = real_weights_ph
 
         self._G = G
         self._roll_back = roll_back
@@ -630,6 +942,9 @@ class ToyUnrolledGan(ToyGan):
         self._d_optim_cp = d_optim_cp
         self._c_optim = c_optim
 
+        if opts.get('fused_updates', False):
+            self._build_fused_step(opts)
+
         logging.debug("Building Graph Done.")
 
 
@@ -637,47 +952,66 @@ class ToyUnrolledGan(ToyGan):
         """Train a GAN model.
 
         """
+        if opts.get('fused_steps', 0) > 0:
+            return self._train_fused(opts)
 
         batches_num = self._data.num_points / opts['batch_size']
         train_size = self._data.num_points
 
         counter = 0
+        train_metrics = utils.TrainingMetrics(
+            ['d_loss', 'g_loss'], window=batches_num)
+        sampler = utils.MinibatchSampler(
+            self._data_weights, opts['batch_size'],
+            opts.get('weights_mode', 'resample'))
+        fused = opts.get('fused_updates', False)
         logging.debug('Training GAN')
+        start_time = time.time()
         for _epoch in xrange(opts["gan_epoch_num"]):
             for _idx in TQDM(opts, xrange(batches_num),
                              desc='Epoch %2d/%2d' %\
                              (_epoch+1, opts["gan_epoch_num"])):
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
+                data_ids, batch_weights = sampler.sample()
                 batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
-                # Update discriminator parameters
-                for _iter in xrange(opts['d_steps']):
-                    _ = self._session.run(
-                        self._d_optim,
+                if fused:
+                    # Updates, roll back and unrolling in one session.run
+                    d_loss, g_loss = self._session.run(
+                        self._fused_step,
                         feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise})
-                # Roll back discriminator_cp's variables
-                self._session.run(self._roll_back)
-                # Unrolling steps
-                for _iter in xrange(opts['unrolling_steps']):
-                    self._session.run(
-                        self._d_optim_cp,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise})
-                # Update generator parameters
-                for _iter in xrange(opts['g_steps']):
-                    _ = self._session.run(
-                        self._g_optim, feed_dict={self._noise_ph: batch_noise})
+                                   self._real_weights_ph: batch_weights})
+                else:
+                    # Update discriminator parameters
+                    for _iter in xrange(opts['d_steps']):
+                        _, d_loss = self._session.run(
+                            [self._d_optim, self._d_loss],
+                            feed_dict={self._real_points_ph: batch_images,
+                                       self._real_weights_ph: batch_weights})
+                    # Roll back discriminator_cp's variables
+                    self._session.run(self._roll_back)
+                    # Unrolling steps
+                    for _iter in xrange(opts['unrolling_steps']):
+                        self._session.run(
+                            self._d_optim_cp,
+                            feed_dict={self._real_points_ph: batch_images,
+                                       self._real_weights_ph: batch_weights})
+                    # Update generator parameters
+                    for _iter in xrange(opts['g_steps']):
+                        _, g_loss = self._session.run(
+                            [self._g_optim, self._g_loss])
+                train_metrics.update(d_loss=d_loss, g_loss=g_loss)
                 counter += 1
                 if opts['verbose'] and counter % opts['plot_every'] == 0:
+                    logging.debug(
+                        'Epoch: %d/%d, batch:%d/%d, d_loss=%.4f, g_loss=%.4f, %.2f steps/sec' % \
+                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num,
+                         train_metrics.mean('d_loss'),
+                         train_metrics.mean('g_loss'),
+                         counter / (time.time() - start_time)))
                     metrics = Metrics()
                     points_to_plot = self._run_batch(
                         opts, self._G, self._noise_ph,
                         self._noise_for_plots[0:320])
-                    data_ids = np.random.choice(train_size, 320,
-                                                replace=False,
-                                                p=self._data_weights)
+                    data_ids = self._data_weights.sample(320)
                     metrics.make_plots(
                         opts, counter,
                         self._data.data[data_ids],
@@ -768,6 +1102,77 @@ class ImageGan(Gan):
 
         return h3
 
+    def _gan_losses(self, opts, real_points, noise, is_training, reuse=False,
+                    weights=None):
+        """Generator output and the D, G losses on the given inputs.
+
+        weights are the per-example loss weights of the real points.
+        """
+        G = self.generator(opts, noise, is_training, reuse=reuse)
+        # We use conv2d_transpose in the generator, which results in the
+        # output tensor of undefined shapes. However, we statically know
+        # the shape of the generator output, which is [-1, dim1, dim2, dim3]
+        # where (dim1, dim2, dim3) is given by self._data.data_shape
+        G.set_shape([None] + list(self._data.data_shape))
+
+        d_logits_real = self.discriminator(
+            opts, real_points, is_training, reuse=reuse)
+        d_logits_fake = self.discriminator(opts, G, is_training, reuse=True)
+
+        d_loss_real = ops.weighted_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=d_logits_real, labels=tf.ones_like(d_logits_real)),
+            weights)
+        d_loss_fake = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=d_logits_fake, labels=tf.zeros_like(d_logits_fake)))
+        d_loss = d_loss_real + d_loss_fake
+
+        g_loss = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=d_logits_fake, labels=tf.ones_like(d_logits_fake)))
+
+        return {'G': G, 'd_loss': d_loss, 'g_loss': g_loss}
+
+    def _build_fused_step(self, opts):
+        """One op doing all the D and G updates of a minibatch.
+
+        The updates are chained with control dependencies and each of them
+        is built on fresh reads of the variables (see ops.FreshReads), so
+        the G updates see the updated discriminator. Every update draws its
+        own noise in the graph, as the separate session.run calls did.
+        """
+        deps = []
+        losses = {}
+        for kind in ['d'] * opts['d_steps'] + ['g'] * opts['g_steps']:
+            with tf.control_dependencies(deps):
+                update, losses[kind] = self._fused_update(opts, kind)
+            deps = [update]
+        with tf.control_dependencies(deps):
+            self._fused_step = [tf.identity(losses['d']),
+                                tf.identity(losses['g'])]
+
+    def _fused_update(self, opts, kind):
+        """Update op and loss of one step of the fused minibatch update.
+
+        """
+        noise = ops.sample_pz(opts, self._noise_num_ph)
+        reads = ops.FreshReads()
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True,
+                               custom_getter=reads):
+            losses = self._gan_losses(
+                opts, self._real_points_ph, noise, self._is_training_ph,
+                reuse=True, weights=self._real_weights_ph)
+        if kind == 'd':
+            update = reads.minimize(
+                self._d_optimizer, losses['d_loss'], 'DISCRIMINATOR/')
+            return update, losses['d_loss']
+        elif kind == 'g':
+            update = reads.minimize(
+                self._g_optimizer, losses['g_loss'], 'GENERATOR/')
+            return update, losses['g_loss']
+        assert False, 'Unknown fused update %s' % kind
+
     def _build_model_internal(self, opts):
         """Build the Graph corresponding to GAN implementation.
 
@@ -779,21 +1184,18 @@ class ImageGan(Gan):
             tf.float32, [None] + list(data_shape), name='real_points_ph')
         fake_points_ph = tf.placeholder(
             tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        # Noise is sampled in the graph unless noise_ph is fed
+        noise_ph, noise_num_ph = ops.noise_placeholder(opts)
         is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
-
+        real_weights_ph = ops.weights_placeholder(real_points_ph)
 
         # Operations
-        G = self.generator(opts, noise_ph, is_training_ph)
-        # We use conv2d_transpose in the generator, which results in the
-        # output tensor of undefined shapes. However, we statically know
-        # the shape of the generator output, which is [-1, dim1, dim2, dim3]
-        # where (dim1, dim2, dim3) is given by self._data.data_shape
-        G.set_shape([None] + list(self._data.data_shape))
-
-        d_logits_real = self.discriminator(opts, real_points_ph, is_training_ph)
-        d_logits_fake = self.discriminator(opts, G, is_training_ph, reuse=True)
+        losses = self._gan_losses(
+            opts, real_points_ph, noise_ph, is_training_ph,
+            weights=real_weights_ph)
+        G = losses['G']
+        d_loss = losses['d_loss']
+        g_loss = losses['g_loss']
 
         c_logits_real = self.discriminator(
             opts, real_points_ph, is_training_ph, prefix='CLASSIFIER')
@@ -803,18 +1205,6 @@ class ImageGan(Gan):
             self.discriminator(opts, real_points_ph, is_training_ph,
                                prefix='CLASSIFIER', reuse=True))
 
-        d_loss_real = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_real, labels=tf.ones_like(d_logits_real)))
-        d_loss_fake = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_fake, labels=tf.zeros_like(d_logits_fake)))
-        d_loss = d_loss_real + d_loss_fake
-
-        g_loss = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_fake, labels=tf.ones_like(d_logits_fake)))
-
         c_loss_real = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
                 logits=c_logits_real, labels=tf.ones_like(c_logits_real)))
@@ -827,8 +1217,11 @@ class ImageGan(Gan):
         d_vars = [var for var in t_vars if 'DISCRIMINATOR/' in var.name]
         g_vars = [var for var in t_vars if 'GENERATOR/' in var.name]
 
-        d_optim = ops.optimizer(opts, 'd').minimize(d_loss, var_list=d_vars)
-        g_optim = ops.optimizer(opts, 'g').minimize(g_loss, var_list=g_vars)
+        # Optimizers are kept to reuse their slots in the fused updates
+        self._d_optimizer = ops.optimizer(opts, 'd')
+        self._g_optimizer = ops.optimizer(opts, 'g')
+        d_optim = self._d_optimizer.minimize(d_loss, var_list=d_vars)
+        g_optim = self._g_optimizer.minimize(g_loss, var_list=g_vars)
 
         # d_optim_op = ops.optimizer(opts, 'd')
         # g_optim_op = ops.optimizer(opts, 'g')
@@ -853,6 +1246,8 @@ class ImageGan(Gan):
         self._real_points_ph = real_points_ph
         self._fake_points_ph = fake_points_ph
         self._noise_ph = noise_ph
+        self._noise_num_ph = noise_num_ph
+        self._real_weights_ph = real_weights_ph
         self._is_training_ph = is_training_ph
         self._G = G
         self._d_loss = d_loss
@@ -863,6 +1258,9 @@ class ImageGan(Gan):
         self._d_optim = d_optim
         self._c_optim = c_optim
 
+        if opts.get('fused_updates', False):
+            self._build_fused_step(opts)
+
         logging.debug("Building Graph Done.")
 
 
@@ -875,33 +1273,49 @@ class ImageGan(Gan):
         train_size = self._data.num_points
 
         counter = 0
+        train_metrics = utils.TrainingMetrics(
+            ['d_loss', 'g_loss'], window=batches_num)
+        sampler = utils.MinibatchSampler(
+            self._data_weights, opts['batch_size'],
+            opts.get('weights_mode', 'resample'))
+        fused = opts.get('fused_updates', False)
         logging.debug('Training GAN')
+        start_time = time.time()
         for _epoch in xrange(opts["gan_epoch_num"]):
             for _idx in xrange(batches_num):
                 # logging.debug('Step %d of %d' % (_idx, batches_num ) )
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
+                data_ids, batch_weights = sampler.sample()
                 batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
-                # Update discriminator parameters
-                for _iter in xrange(opts['d_steps']):
-                    _ = self._session.run(
-                        self._d_optim,
+                if fused:
+                    # All the D and G updates in one session.run
+                    d_loss, g_loss = self._session.run(
+                        self._fused_step,
                         feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise,
-                                   self._is_training_ph: True})
-                # Update generator parameters
-                for _iter in xrange(opts['g_steps']):
-                    _ = self._session.run(
-                        self._g_optim,
-                        feed_dict={self._noise_ph: batch_noise,
+                                   self._real_weights_ph: batch_weights,
                                    self._is_training_ph: True})
+                else:
+                    # Update discriminator parameters
+                    for _iter in xrange(opts['d_steps']):
+                        _, d_loss = self._session.run(
+                            [self._d_optim, self._d_loss],
+                            feed_dict={self._real_points_ph: batch_images,
+                                       self._real_weights_ph: batch_weights,
+                                       self._is_training_ph: True})
+                    # Update generator parameters
+                    for _iter in xrange(opts['g_steps']):
+                        _, g_loss = self._session.run(
+                            [self._g_optim, self._g_loss],
+                            feed_dict={self._is_training_ph: True})
+                train_metrics.update(d_loss=d_loss, g_loss=g_loss)
                 counter += 1
 
                 if opts['verbose'] and counter % opts['plot_every'] == 0:
                     logging.debug(
-                        'Epoch: %d/%d, batch:%d/%d' % \
-                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num))
+                        'Epoch: %d/%d, batch:%d/%d, d_loss=%.4f, g_loss=%.4f, %.2f steps/sec' % \
+                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num,
+                         train_metrics.mean('d_loss'),
+                         train_metrics.mean('g_loss'),
+                         counter / (time.time() - start_time)))
                     metrics = Metrics()
                     points_to_plot = self._run_batch(
                         opts, self._G, self._noise_ph,
@@ -920,7 +1334,7 @@ class ImageGan(Gan):
         """Sample from the trained GAN model.
 
         """
-        noise = utils.generate_noise(opts, num)
+        noise = utils.noise_pool(opts).get(num)
         sample = self._run_batch(
             opts, self._G, self._noise_ph, noise,
             self._is_training_ph, False)
@@ -1020,30 +1434,12 @@ class MNISTLabelGan(ImageGan):
 
         return h5, h3
 
-    def _build_model_internal(self, opts):
-        """Build the Graph corresponding to GAN implementation.
+    def _label_gan_losses(self, opts, real_points, real_points_unl, labels,
+                          noise, is_training, reuse=False):
+        """Generator output, D and G losses and the D accuracy.
 
         """
-        data_shape = self._data.data_shape
-
-        # Placeholders
-        real_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='real_points_ph')
-        real_points_unl_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='real_points_ph')
-        fake_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
-        is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
-        dropout_rate_ph = tf.placeholder(tf.float32)
-        # labels_ph = tf.placeholder(tf.int8, [None, 10])
-        labels_ph = tf.placeholder(tf.int64, [None])
-        lr_ph = tf.placeholder(tf.float32)
-
-
-        # Operations
-        G = self.generator(opts, noise_ph, is_training_ph)
+        G = self.generator(opts, noise, is_training, reuse=reuse)
         # We use conv2d_transpose in the generator, which results in the
         # output tensor of undefined shapes. However, we statically know
         # the shape of the generator output, which is [-1, dim1, dim2, dim3]
@@ -1053,19 +1449,20 @@ class MNISTLabelGan(ImageGan):
         # Here we follow a proposal of "Improved techniques for training
         # GANs" paper, Section 5
 
-        d_logits_real, _ = self.discriminator(opts, real_points_ph, is_training_ph)
+        d_logits_real, _ = self.discriminator(
+            opts, real_points, is_training, reuse=reuse)
         d_logits_real_unl, d_features_real_unl = self.discriminator(
-            opts, real_points_unl_ph, is_training_ph, reuse=True)
+            opts, real_points_unl, is_training, reuse=True)
         d_logits_fake, d_features_fake = self.discriminator(
-            opts, G, is_training_ph, reuse=True)
+            opts, G, is_training, reuse=True)
 
         d_loss_labelled = tf.reduce_mean(
             tf.nn.sparse_softmax_cross_entropy_with_logits(
-                logits=d_logits_real, labels=labels_ph))
+                logits=d_logits_real, labels=labels))
         correct_predictions = tf.equal(
             tf.argmax(d_logits_real, axis=1),
             # tf.argmax(labels_ph, axis=1))
-            labels_ph)
+            labels)
         d_accuracy = tf.reduce_mean(tf.cast(correct_predictions, tf.float32))
 
         # 0 / 1 labels:
@@ -1110,6 +1507,63 @@ class MNISTLabelGan(ImageGan):
         f_mean_real = tf.reduce_mean(d_features_real_unl, axis=0)
         g_loss = tf.reduce_mean(tf.square(f_mean_fake - f_mean_real))
 
+        return {'G': G, 'd_loss': d_loss, 'g_loss': g_loss,
+                'd_accuracy': d_accuracy}
+
+    def _fused_update(self, opts, kind):
+        """Update op and loss of one step of the fused minibatch update.
+
+        """
+        noise = ops.sample_pz(opts, self._noise_num_ph)
+        reads = ops.FreshReads()
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True,
+                               custom_getter=reads):
+            losses = self._label_gan_losses(
+                opts, self._real_points_ph, self._real_points_unl_ph,
+                self._labels_ph, noise, self._is_training_ph, reuse=True)
+        if kind == 'd':
+            update = reads.minimize(
+                self._d_optimizer, losses['d_loss'], 'DISCRIMINATOR/')
+            return update, losses['d_loss']
+        elif kind == 'g':
+            update = reads.minimize(
+                self._g_optimizer, losses['g_loss'], 'GENERATOR/')
+            return update, losses['g_loss']
+        assert False, 'Unknown fused update %s' % kind
+
+    def _build_model_internal(self, opts):
+        """Build the Graph corresponding to GAN implementation.
+
+        """
+        data_shape = self._data.data_shape
+
+        # Placeholders
+        real_points_ph = tf.placeholder(
+            tf.float32, [None] + list(data_shape), name='real_points_ph')
+        real_points_unl_ph = tf.placeholder(
+            tf.float32, [None] + list(data_shape), name='real_points_ph')
+        fake_points_ph = tf.placeholder(
+            tf.float32, [None] + list(data_shape), name='fake_points_ph')
+        # Noise is sampled in the graph unless noise_ph is fed
+        noise_ph, noise_num_ph = ops.noise_placeholder(opts)
+        is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
+        dropout_rate_ph = tf.placeholder(tf.float32)
+        # labels_ph = tf.placeholder(tf.int8, [None, 10])
+        labels_ph = tf.placeholder(tf.int64, [None])
+        lr_ph = tf.placeholder(tf.float32)
+        # The fused updates need different D and G learning rates in one run
+        lr_g_ph = tf.placeholder_with_default(lr_ph, [])
+
+
+        # Operations
+        losses = self._label_gan_losses(
+            opts, real_points_ph, real_points_unl_ph, labels_ph,
+            noise_ph, is_training_ph)
+        G = losses['G']
+        d_loss = losses['d_loss']
+        g_loss = losses['g_loss']
+        d_accuracy = losses['d_accuracy']
+
         c_logits_real, _ = self.discriminator(
             opts, real_points_ph, is_training_ph, prefix='CLASSIFIER')
         c_logits_fake, _ = self.discriminator(
@@ -1148,11 +1602,14 @@ class MNISTLabelGan(ImageGan):
         # g_optim = g_optim_op.apply_gradients(g_grads_and_vars)
 
 
-        d_optim = tf.train.AdamOptimizer(lr_ph, beta1=opts["opt_beta1"])
-        g_optim = tf.train.AdamOptimizer(lr_ph, beta1=opts["opt_beta1"])
+        # Optimizers are kept to reuse their slots in the fused updates
+        self._d_optimizer = tf.train.AdamOptimizer(
+            lr_ph, beta1=opts["opt_beta1"])
+        self._g_optimizer = tf.train.AdamOptimizer(
+            lr_g_ph, beta1=opts["opt_beta1"])
         # g_optim = tf.train.GradientDescentOptimizer(lr_ph)
-        d_optim = d_optim.minimize(d_loss, var_list=d_vars)
-        g_optim = g_optim.minimize(g_loss, var_list=g_vars)
+        d_optim = self._d_optimizer.minimize(d_loss, var_list=d_vars)
+        g_optim = self._g_optimizer.minimize(g_loss, var_list=g_vars)
 
         c_vars = [var for var in t_vars if 'CLASSIFIER/' in var.name]
         c_optim = ops.optimizer(opts).minimize(c_loss, var_list=c_vars)
@@ -1160,6 +1617,7 @@ class MNISTLabelGan(ImageGan):
         self._real_points_ph = real_points_ph
         self._fake_points_ph = fake_points_ph
         self._noise_ph = noise_ph
+        self._noise_num_ph = noise_num_ph
         self._real_points_unl_ph = real_points_unl_ph
         self._is_training_ph = is_training_ph
         self._dropout_rate_ph = dropout_rate_ph
@@ -1175,17 +1633,31 @@ class MNISTLabelGan(ImageGan):
         self._d_accuracy = d_accuracy
         self._g_loss = g_loss
         self._lr_ph = lr_ph
+        self._lr_g_ph = lr_g_ph
+
+        if opts.get('fused_updates', False):
+            self._build_fused_step(opts)
 
         logging.debug("Building Graph Done.")
 
+    def _tuning_step(self, opts):
+        batch_size = opts['batch_size']
+        fetches, feed_dict = ImageGan._tuning_step(self, opts)
+        feed_dict[self._real_points_unl_ph] = self._data.data[:batch_size]
+        feed_dict[self._labels_ph] = self._data.labels[:batch_size]
+        feed_dict[self._lr_ph] = opts['opt_d_learning_rate']
+        return fetches, feed_dict
+
     def _train_internal(self, opts):
         """Train a GAN model.
 
         """
 
+        assert opts.get('weights_mode', 'resample') == 'resample', \
+            'MNISTLabelGan supports only the resample weights mode'
         train_data = self._data.data[:60000]
         train_labels = self._data.labels[:60000]
-        train_weights = self._data_weights[:60000]
+        train_weights = self._data_weights.dense()[:60000]
         train_weights = train_weights / np.sum(train_weights)
         test_data = self._data.data[60000:]
         test_labels = self._data.labels[60000:]
@@ -1193,10 +1665,14 @@ class MNISTLabelGan(ImageGan):
         train_size = len(train_data)
 
         counter = 0
+        train_metrics = utils.TrainingMetrics(
+            ['d_loss', 'g_loss'], window=batches_num)
         logging.debug('Training GAN')
         lr_g = opts['opt_g_learning_rate']
         lr_d = opts['opt_d_learning_rate']
         accuracy = 0.
+        fused = opts.get('fused_updates', False)
+        start_time = time.time()
         for _epoch in xrange(opts["gan_epoch_num"]):
             for _idx in xrange(batches_num):
                 # logging.debug('Step %d of %d' % (_idx, batches_num ) )
@@ -1206,29 +1682,40 @@ class MNISTLabelGan(ImageGan):
                                             replace=False, p=train_weights)
                 batch_images = train_data[data_ids].astype(np.float)
                 batch_images_unl = train_data[data_ids_unl].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
                 # Update discriminator parameters
                 # labels_oh = utils.one_hot(self._data.labels[data_ids])
                 labels_oh = train_labels[data_ids]
-                lr = lr_d * min(1., 1. - ((0. + _epoch) / opts['gan_epoch_num']))
-                for _iter in xrange(opts['d_steps']):
-                    _ = self._session.run(
-                        self._d_optim,
+                lr_decay = min(1., 1. - ((0. + _epoch) / opts['gan_epoch_num']))
+                if fused:
+                    # All the D and G updates in one session.run
+                    lr = lr_g * lr_decay
+                    d_loss, g_loss = self._session.run(
+                        self._fused_step,
                         feed_dict={self._real_points_ph: batch_images,
                                    self._real_points_unl_ph: batch_images_unl,
                                    self._is_training_ph: True,
-                                   self._lr_ph: lr,
-                                   self._noise_ph: batch_noise,
+                                   self._lr_ph: lr_d * lr_decay,
+                                   self._lr_g_ph: lr,
                                    self._labels_ph: labels_oh})
-                # Update generator parameters
-                lr = lr_g * min(1., 1. - ((0. + _epoch) / opts['gan_epoch_num']))
-                for _iter in xrange(opts['g_steps']):
-                    _ = self._session.run(
-                        self._g_optim,
-                        feed_dict={self._noise_ph: batch_noise,
-                                   self._is_training_ph: True,
-                                   self._lr_ph: lr,
-                                   self._real_points_unl_ph: batch_images_unl})
+                else:
+                    lr = lr_d * lr_decay
+                    for _iter in xrange(opts['d_steps']):
+                        _, d_loss = self._session.run(
+                            [self._d_optim, self._d_loss],
+                            feed_dict={self._real_points_ph: batch_images,
+                                       self._real_points_unl_ph: batch_images_unl,
+                                       self._is_training_ph: True,
+                                       self._lr_ph: lr,
+                                       self._labels_ph: labels_oh})
+                    # Update generator parameters
+                    lr = lr_g * lr_decay
+                    for _iter in xrange(opts['g_steps']):
+                        _, g_loss = self._session.run(
+                            [self._g_optim, self._g_loss],
+                            feed_dict={self._is_training_ph: True,
+                                       self._lr_ph: lr,
+                                       self._real_points_unl_ph: batch_images_unl})
+                train_metrics.update(d_loss=d_loss, g_loss=g_loss)
                 counter += 1
 
                 if opts['verbose'] and counter % opts['plot_every'] == 0:
@@ -1238,12 +1725,13 @@ class MNISTLabelGan(ImageGan):
                                    # self._labels_ph: utils.one_hot(self._data.labels[:1000])})
                                    self._labels_ph: test_labels})
                     g_loss = self._g_loss.eval(
-                        feed_dict={self._noise_ph: batch_noise,
-                                   self._is_training_ph: False,
+                        feed_dict={self._is_training_ph: False,
                                    self._real_points_unl_ph: batch_images_unl})
                     logging.debug(
-                        'Epoch:%3d/%d, batch:%4d/%d, lr_g=%.4f, D accuracy in telling digits:%f, G feature matching loss:%f' % \
-                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num, lr, accuracy, g_loss))
+                        'Epoch:%3d/%d, batch:%4d/%d, lr_g=%.4f, D loss:%f, D accuracy in telling digits:%f, G feature matching loss:%f, %.2f steps/sec' % \
+                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num, lr,
+                         train_metrics.mean('d_loss'), accuracy, g_loss,
+                         counter / (time.time() - start_time)))
                     metrics = Metrics()
                     points_to_plot = self._run_batch(
                         opts, self._G, self._noise_ph,
@@ -1375,58 +1863,43 @@ class ImageUnrolledGan(ImageGan):
 
         ImageGan.__init__(self, opts, data, weights)
 
-    def _build_model_internal(self, opts):
-        """Build the Graph corresponding to GAN implementation.
+    def _gan_losses(self, opts, real_points, noise, is_training, reuse=False,
+                    weights=None):
+        """Generator output and the D, D copy and G losses on the inputs.
 
+        weights are the per-example loss weights of the real points.
         """
-        data_shape = self._data.data_shape
-
-        # Placeholders
-        real_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='real_points_ph')
-        fake_points_ph = tf.placeholder(
-            tf.float32, [None] + list(data_shape), name='fake_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
-        is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
-
-        # Operations
-        G = self.generator(opts, noise_ph, is_training_ph)
+        G = self.generator(opts, noise, is_training, reuse=reuse)
         # We use conv2d_transpose in the generator, which results in the
         # output tensor of undefined shapes. However, we statically know
         # the shape of the generator output, which is [-1, dim1, dim2, dim3]
         # where (dim1, dim2, dim3) is given by self._data.data_shape
         G.set_shape([None] + list(self._data.data_shape))
 
-        d_logits_real = self.discriminator(opts, real_points_ph, is_training_ph)
-        d_logits_fake = self.discriminator(opts, G, is_training_ph, reuse=True)
+        d_logits_real = self.discriminator(
+            opts, real_points, is_training, reuse=reuse)
+        d_logits_fake = self.discriminator(opts, G, is_training, reuse=True)
 
         # Disccriminator copy for the unrolling steps
         d_logits_real_cp = self.discriminator(
-            opts, real_points_ph, is_training_ph, prefix='DISCRIMINATOR_CP')
+            opts, real_points, is_training, prefix='DISCRIMINATOR_CP',
+            reuse=reuse)
         d_logits_fake_cp = self.discriminator(
-            opts, G, is_training_ph, prefix='DISCRIMINATOR_CP', reuse=True)
-
-
-        c_logits_real = self.discriminator(
-            opts, real_points_ph, is_training_ph, prefix='CLASSIFIER')
-        c_logits_fake = self.discriminator(
-            opts, fake_points_ph, is_training_ph, prefix='CLASSIFIER', reuse=True)
-        c_training = tf.nn.sigmoid(
-            self.discriminator(opts, real_points_ph, is_training_ph,
-                               prefix='CLASSIFIER', reuse=True))
+            opts, G, is_training, prefix='DISCRIMINATOR_CP', reuse=True)
 
-        d_loss_real = tf.reduce_mean(
+        d_loss_real = ops.weighted_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_real, labels=tf.ones_like(d_logits_real)))
+                logits=d_logits_real, labels=tf.ones_like(d_logits_real)),
+            weights)
         d_loss_fake = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
                 logits=d_logits_fake, labels=tf.zeros_like(d_logits_fake)))
         d_loss = d_loss_real + d_loss_fake
 
-        d_loss_real_cp = tf.reduce_mean(
+        d_loss_real_cp = ops.weighted_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=d_logits_real_cp, labels=tf.ones_like(d_logits_real_cp)))
+                logits=d_logits_real_cp, labels=tf.ones_like(d_logits_real_cp)),
+            weights)
         d_loss_fake_cp = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
                 logits=d_logits_fake_cp,
@@ -1443,6 +1916,68 @@ class ImageUnrolledGan(ImageGan):
         else:
             assert False, 'No objective %r implemented' % opts['objective']
 
+        return {'G': G, 'd_loss': d_loss, 'd_loss_cp': d_loss_cp,
+                'g_loss': g_loss}
+
+    def _fused_update(self, opts, kind):
+        if kind == 'roll_back':
+            roll_back = []
+            for var, var_cp in zip(self._d_vars, self._d_vars_cp):
+                roll_back.append(tf.assign(var_cp, var.read_value()))
+            return tf.group(*roll_back), None
+        elif kind == 'd_cp':
+            noise = ops.sample_pz(opts, self._noise_num_ph)
+            reads = ops.FreshReads()
+            with tf.variable_scope(tf.get_variable_scope(), reuse=True,
+                                   custom_getter=reads):
+                losses = self._gan_losses(
+                    opts, self._real_points_ph, noise, self._is_training_ph,
+                    reuse=True, weights=self._real_weights_ph)
+            update = reads.minimize(
+                self._d_optimizer_cp, losses['d_loss_cp'], 'DISCRIMINATOR_CP/')
+            return update, losses['d_loss_cp']
+        return ImageGan._fused_update(self, opts, kind)
+
+    def _build_fused_step(self, opts):
+        """All the updates of one minibatch as a single op.
+
+        """
+        self._fused_step = unrolled_fused_step(
+            opts, lambda kind: self._fused_update(opts, kind))
+
+    def _build_model_internal(self, opts):
+        """Build the Graph corresponding to GAN implementation.
+
+        """
+        data_shape = self._data.data_shape
+
+        # Placeholders
+        real_points_ph = tf.placeholder(
+            tf.float32, [None] + list(data_shape), name='real_points_ph')
+        fake_points_ph = tf.placeholder(
+            tf.float32, [None] + list(data_shape), name='fake_points_ph')
+        # Noise is sampled in the graph unless noise_ph is fed
+        noise_ph, noise_num_ph = ops.noise_placeholder(opts)
+        is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
+        real_weights_ph = ops.weights_placeholder(real_points_ph)
+
+        # Operations
+        losses = self._gan_losses(
+            opts, real_points_ph, noise_ph, is_training_ph,
+            weights=real_weights_ph)
+        G = losses['G']
+        d_loss = losses['d_loss']
+        d_loss_cp = losses['d_loss_cp']
+        g_loss = losses['g_loss']
+
+        c_logits_real = self.discriminator(
+            opts, real_points_ph, is_training_ph, prefix='CLASSIFIER')
+        c_logits_fake = self.discriminator(
+            opts, fake_points_ph, is_training_ph, prefix='CLASSIFIER', reuse=True)
+        c_training = tf.nn.sigmoid(
+            self.discriminator(opts, real_points_ph, is_training_ph,
+                               prefix='CLASSIFIER', reuse=True))
+
         c_loss_real = tf.reduce_mean(
             tf.nn.sigmoid_cross_entropy_with_logits(
                 logits=c_logits_real, labels=tf.ones_like(c_logits_real)))
@@ -1464,11 +1999,15 @@ class ImageUnrolledGan(ImageGan):
             for var, var_cp in zip(d_vars, d_vars_cp):
                 roll_back.append(tf.assign(var_cp, var))
 
-        d_optim = ops.optimizer(opts, 'd').minimize(d_loss, var_list=d_vars)
-        d_optim_cp = ops.optimizer(opts, 'd').minimize(
+        # Optimizers are kept to reuse their slots in the fused updates
+        self._d_optimizer = ops.optimizer(opts, 'd')
+        self._d_optimizer_cp = ops.optimizer(opts, 'd')
+        self._g_optimizer = ops.optimizer(opts, 'g')
+        d_optim = self._d_optimizer.minimize(d_loss, var_list=d_vars)
+        d_optim_cp = self._d_optimizer_cp.minimize(
            d_loss_cp, var_list=d_vars_cp)
         c_optim = ops.optimizer(opts).minimize(c_loss, var_list=c_vars)
-        g_optim = ops.optimizer(opts, 'g').minimize(g_loss, var_list=g_vars)
+        g_optim = self._g_optimizer.minimize(g_loss, var_list=g_vars)
 
         # writer = tf.summary.FileWriter(opts['work_dir']+'/tensorboard', self._session.graph)
 
@@ -1495,6 +2034,8 @@ class ImageUnrolledGan(ImageGan):
         self._real_points_ph = real_points_ph
         self._fake_points_ph = fake_points_ph
         self._noise_ph = noise_ph
+        self._noise_num_ph = noise_num_ph
+        self._real_weights_ph = real_weights_ph
         self._is_training_ph = is_training_ph
         self._G = G
         self._roll_back = roll_back
@@ -1507,6 +2048,11 @@ class ImageUnrolledGan(ImageGan):
         self._d_optim = d_optim
         self._d_optim_cp = d_optim_cp
         self._c_optim = c_optim
+        self._d_vars = d_vars
+        self._d_vars_cp = d_vars_cp
+
+        if opts.get('fused_updates', False):
+            self._build_fused_step(opts)
 
         logging.debug("Building Graph Done.")
 
@@ -1519,44 +2065,60 @@ class ImageUnrolledGan(ImageGan):
         train_size = self._data.num_points
 
         counter = 0
+        train_metrics = utils.TrainingMetrics(
+            ['d_loss', 'g_loss'], window=batches_num)
+        sampler = utils.MinibatchSampler(
+            self._data_weights, opts['batch_size'],
+            opts.get('weights_mode', 'resample'))
+        fused = opts.get('fused_updates', False)
         logging.debug('Training GAN')
+        start_time = time.time()
         for _epoch in xrange(opts["gan_epoch_num"]):
             for _idx in TQDM(opts, xrange(batches_num),
                              desc='Epoch %2d/%2d' %\
                              (_epoch + 1, opts["gan_epoch_num"])):
                 # logging.debug('Step %d of %d' % (_idx, batches_num ) )
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
+                data_ids, batch_weights = sampler.sample()
                 batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
-                # Update discriminator parameters
-                for _iter in xrange(opts['d_steps']):
-                    _ = self._session.run(
-                        self._d_optim,
-                        feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise,
-                                   self._is_training_ph: True})
-                # Roll back discriminator_cp's variables
-                self._session.run(self._roll_back)
-                # Unrolling steps
-                for _iter in xrange(opts['unrolling_steps']):
-                    self._session.run(
-                        self._d_optim_cp,
+                if fused:
+                    # Updates, roll back and unrolling in one session.run
+                    d_loss, g_loss = self._session.run(
+                        self._fused_step,
                         feed_dict={self._real_points_ph: batch_images,
-                                   self._noise_ph: batch_noise,
-                                   self._is_training_ph: True})
-                # Update generator parameters
-                for _iter in xrange(opts['g_steps']):
-                    _ = self._session.run(
-                        self._g_optim,
-                        feed_dict={self._noise_ph: batch_noise,
+                                   self._real_weights_ph: batch_weights,
                                    self._is_training_ph: True})
+                else:
+                    # Update discriminator parameters
+                    for _iter in xrange(opts['d_steps']):
+                        _, d_loss = self._session.run(
+                            [self._d_optim, self._d_loss],
+                            feed_dict={self._real_points_ph: batch_images,
+                                       self._real_weights_ph: batch_weights,
+                                       self._is_training_ph: True})
+                    # Roll back discriminator_cp's variables
+                    self._session.run(self._roll_back)
+                    # Unrolling steps
+                    for _iter in xrange(opts['unrolling_steps']):
+                        self._session.run(
+                            self._d_optim_cp,
+                            feed_dict={self._real_points_ph: batch_images,
+                                       self._real_weights_ph: batch_weights,
+                                       self._is_training_ph: True})
+                    # Update generator parameters
+                    for _iter in xrange(opts['g_steps']):
+                        _, g_loss = self._session.run(
+                            [self._g_optim, self._g_loss],
+                            feed_dict={self._is_training_ph: True})
+                train_metrics.update(d_loss=d_loss, g_loss=g_loss)
                 counter += 1
 
                 if opts['verbose'] and counter % opts['plot_every'] == 0:
                     logging.debug(
-                        'Epoch: %d/%d, batch:%d/%d' % \
-                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num))
+                        'Epoch: %d/%d, batch:%d/%d, d_loss=%.4f, g_loss=%.4f, %.2f steps/sec' % \
+                        (_epoch+1, opts['gan_epoch_num'], _idx+1, batches_num,
+                         train_metrics.mean('d_loss'),
+                         train_metrics.mean('g_loss'),
+                         counter / (time.time() - start_time)))
                     metrics = Metrics()
                     points_to_plot = self._run_batch(
                         opts, self._G, self._noise_ph,
@@ -47,8 +47,18 @@ def main():
     opts['mnist_trained_model_file'] = None #'mnist_trainSteps_19999_yhat' # 'mnist_trainSteps_20000'
     opts['work_dir'] = FLAGS.workdir
     opts['ckpt_dir'] = 'checkpoints'
+    opts['ckpt_async'] = True # Write checkpoints on a background thread
+    opts['ckpt_keep_last'] = 10
     opts["verbose"] = 2
     opts['tf_run_batch_size'] = 128
+    opts['tf_intra_op_threads'] = 0 # 0 lets TensorFlow decide
+    opts['tf_inter_op_threads'] = 0
+    opts['tf_thread_affinity'] = None # e.g. 'granularity=fine,compact,1,0'
+    opts['tf_autotune'] = False # Benchmark thread settings per model class
+    opts['export_generator'] = True # Write a frozen decoder after training
+    opts['weights_mode'] = 'resample' # Or 'loss': uniform minibatches, data weights in the losses
+    opts['debug_plots'] = True # Plots of the extreme data weights and classifier outputs
+    opts['debug_max_points'] = 10 ** 6 # Debug plots use a random subset of larger datasets
     opts["early_stop"] = -1 # set -1 to run normally
     opts["plot_every"] = 500
     opts["save_every_epoch"] = 20
@@ -113,6 +123,7 @@ def main():
     opts['pot_lambda'] = FLAGS.pot_lambda
     opts['adv_c_loss'] = 'none'
     opts['vgg_layer'] = 'pool2'
+    opts['vgg_feature_cache'] = False # Compute VGG features of real points once
     opts['adv_c_patches_size'] = 5
     opts['adv_c_num_units'] = 32
     opts['adv_c_loss_w'] = 1.0
@@ -0,0 +1,47 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Tiling batches of pictures into grids and writing PNGs with PIL.
+
+"""
+
+import numpy as np
+from PIL import Image
+
+def to_uint8(images):
+    """Images with values in [0, 1] as uint8.
+
+    """
+    return np.round(np.clip(images, 0., 1.) * 255.).astype(np.uint8)
+
+def tile(pics, max_rows=16, pad_value=1.):
+    """Tiles (num, height, width, channels) pictures into one image.
+
+    The pictures fill the columns one after another, max_rows pictures per
+    column, and the last column is padded with pad_value.
+    """
+    pics = np.asarray(pics)
+    num, height, width, channels = pics.shape
+    rows = min(num, max_rows)
+    cols = int(np.ceil(1. * num / rows))
+    if cols * rows > num:
+        pad = np.empty([cols * rows - num, height, width, channels],
+                       dtype=pics.dtype)
+        pad.fill(pad_value)
+        pics = np.concatenate([pics, pad])
+    grid = np.reshape(pics, [cols, rows, height, width, channels])
+    grid = np.transpose(grid, (1, 2, 0, 3, 4))
+    return np.reshape(grid, [rows * height, cols * width, channels])
+
+def save(image, f, scale=1):
+    """Writes the (height, width, channels) image in [0, 1] as a PNG.
+
+    f is a path or a file object, every pixel becomes scale x scale pixels.
+    """
+    image = to_uint8(image)
+    if scale > 1:
+        image = np.repeat(np.repeat(image, scale, axis=0), scale, axis=1)
+    if image.shape[-1] == 1:
+        image = image[:, :, 0]
+    Image.fromarray(image).save(f, format='PNG')
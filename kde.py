@@ -0,0 +1,89 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Gaussian kernel density estimates for a grid of bandwidths at once.
+
+The squared distances between the query and the fit points do not depend
+on the bandwidth, so they are computed once, block by block, and the log
+densities for every bandwidth are obtained from the same block with
+logsumexp. For large problems a KD-tree is built once and queried with
+a relative tolerance for every bandwidth instead.
+"""
+
+import logging
+import numpy as np
+try:
+    from scipy.special import logsumexp
+except ImportError:
+    from scipy.misc import logsumexp
+from sklearn.neighbors import KDTree
+
+# Largest num_query * num_fit for which the distances are computed exactly
+MAX_EXACT = 10 ** 8
+
+def _flatten(points):
+    return np.reshape(points, [len(points), -1]).astype(np.float64)
+
+def squared_distances(query, fit, block_size=1024):
+    """Yields (start, block) with the squared distances of query points
+    start:start + block_size to all the fit points.
+
+    """
+    fit_norms = np.sum(fit * fit, axis=1)
+    for start in xrange(0, len(query), block_size):
+        block = query[start:start + block_size]
+        dist = np.dot(block, fit.T)
+        dist *= -2.
+        dist += np.sum(block * block, axis=1)[:, None]
+        dist += fit_norms[None, :]
+        # Rounding errors may give small negative values
+        np.maximum(dist, 0., out=dist)
+        yield start, dist
+
+class GaussianKde(object):
+    """Gaussian KDE fitted on points, scored for many bandwidths.
+
+    Matches sklearn KernelDensity(kernel='gaussian').score_samples.
+    """
+
+    def __init__(self, points, block_size=1024, max_exact=MAX_EXACT,
+                 rtol=1e-4):
+        self._fit = _flatten(points)
+        self._block_size = block_size
+        self._max_exact = max_exact
+        self._rtol = rtol
+        self._tree = None
+
+    def score_samples(self, points, bandwidths):
+        """Log densities of points, a (len(bandwidths), len(points)) array.
+
+        """
+        query = _flatten(points)
+        bandwidths = np.atleast_1d(np.asarray(bandwidths, dtype=np.float64))
+        num_fit, dim = self._fit.shape
+        if len(query) * num_fit > self._max_exact:
+            return self._score_tree(query, bandwidths)
+        res = np.empty((len(bandwidths), len(query)))
+        log_norm = - 0.5 * dim * np.log(2. * np.pi * bandwidths ** 2) \
+            - np.log(num_fit)
+        for start, dist in squared_distances(query, self._fit,
+                                             self._block_size):
+            end = start + len(dist)
+            dist *= -0.5
+            for idx, bandwidth in enumerate(bandwidths):
+                res[idx, start:end] = logsumexp(
+                    dist / bandwidth ** 2, axis=1) + log_norm[idx]
+        return res
+
+    def _score_tree(self, query, bandwidths):
+        if self._tree is None:
+            logging.debug('KDE: %d x %d points, using a KD-tree' % (
+                len(query), len(self._fit)))
+            self._tree = KDTree(self._fit)
+        res = np.empty((len(bandwidths), len(query)))
+        for idx, bandwidth in enumerate(bandwidths):
+            res[idx] = self._tree.kernel_density(
+                query, bandwidth, kernel='gaussian', rtol=self._rtol,
+                return_log=True) - np.log(len(self._fit))
+        return res
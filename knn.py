@@ -0,0 +1,202 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Nearest neighbour metrics of samples with respect to the training set.
+
+Precision and recall follow the k-NN manifold estimate of Kynkaanniemi et
+al. (2019): a sample is precise if it falls into the ball around some real
+point reaching its k-th nearest real neighbour, and a real point is
+recalled if it falls into such a ball around some sample. The distances of
+the samples to their nearest training points show memorization.
+"""
+
+import os
+import logging
+import numpy as np
+import tensorflow as tf
+import utils
+from kde import squared_distances
+
+INDEX_FILE = 'knn_index.npz'
+
+class NeighbourIndex(object):
+    """Batched nearest neighbour search over a fixed set of points.
+
+    In the 'exact' mode the distances are computed block by block. In the
+    'projection' mode the points are first mapped by a random Gaussian
+    projection to num_projections dimensions, the neighbours are searched
+    there and the best candidates are re-ranked with the exact distances.
+    """
+
+    def __init__(self, points, mode='exact', num_projections=64,
+                 block_size=1024, candidates=10, projection=None):
+        self._points = np.reshape(points, [len(points), -1]).astype(np.float32)
+        self._mode = mode
+        self._block_size = block_size
+        self._candidates = candidates
+        if mode == 'exact':
+            self._projection = None
+            self._search_points = self._points
+        elif mode == 'projection':
+            if projection is None:
+                dim = self._points.shape[1]
+                projection = np.random.normal(
+                    size=(dim, num_projections)) / np.sqrt(num_projections)
+            self._projection = projection.astype(np.float32)
+            self._search_points = np.dot(self._points, self._projection)
+        else:
+            assert False, 'Unknown index mode %s' % mode
+
+    def __len__(self):
+        return len(self._points)
+
+    @property
+    def points(self):
+        return self._points
+
+    def _search_space(self, points):
+        points = np.reshape(points, [len(points), -1]).astype(np.float32)
+        if self._projection is None:
+            return points, points
+        return points, np.dot(points, self._projection)
+
+    def query(self, points, k=1):
+        """Distances to the k nearest indexed points and their ids, sorted.
+
+        """
+        points, search = self._search_space(points)
+        num_search = k
+        if self._projection is not None:
+            num_search = min(len(self), k * self._candidates)
+        dists = np.zeros((len(points), k), dtype=np.float32)
+        ids = np.zeros((len(points), k), dtype=np.int64)
+        for start, block in squared_distances(search, self._search_points,
+                                              self._block_size):
+            end = start + len(block)
+            rows = np.arange(len(block))[:, None]
+            if num_search < len(self):
+                # Linear time selection of the num_search closest ones
+                cand = np.argpartition(block, num_search - 1, axis=1)
+                cand = cand[:, :num_search]
+            else:
+                cand = np.tile(np.arange(len(self)), (len(block), 1))
+            if self._projection is not None:
+                # Re-rank the candidates with the exact distances
+                diff = self._points[cand] - points[start:end, None, :]
+                cand_dists = np.sum(diff * diff, axis=2)
+            else:
+                cand_dists = block[rows, cand]
+            order = np.argsort(cand_dists, axis=1)[:, :k]
+            dists[start:end] = np.sqrt(cand_dists[rows, order])
+            ids[start:end] = cand[rows, order]
+        return dists, ids
+
+    def covered(self, points, radii):
+        """For every point whether it lies in the ball of radii[j] around
+        some indexed point j.
+
+        In the 'projection' mode the projected distances only pick the
+        candidate balls, which are then checked with the exact distances,
+        as in query().
+        """
+        points, search = self._search_space(points)
+        radii_sq = np.square(radii)[None, :]
+        num_search = min(len(self), self._candidates)
+        res = np.zeros(len(points), dtype=np.bool_)
+        for start, block in squared_distances(search, self._search_points,
+                                              self._block_size):
+            end = start + len(block)
+            if self._projection is None:
+                res[start:end] = np.any(block <= radii_sq, axis=1)
+                continue
+            # Balls the point is deepest inside of, judging by projections
+            cand = np.argpartition(block - radii_sq, num_search - 1, axis=1)
+            cand = cand[:, :num_search]
+            diff = self._points[cand] - points[start:end, None, :]
+            cand_dists = np.sum(diff * diff, axis=2)
+            res[start:end] = np.any(cand_dists <= radii_sq[0, cand], axis=1)
+        return res
+
+    def neighbour_distances(self, k):
+        """Distances of every indexed point to its k nearest other points.
+
+        """
+        dists, _ = self.query(self._points, k + 1)
+        # The closest one is the point itself
+        return dists[:, 1:]
+
+    def save(self, path, ids=None, neighbour_dists=None):
+        """Saves the search structure, the points themselves are not saved.
+
+        """
+        arrays = {'mode': np.array(self._mode),
+                  'num_points': np.array(len(self))}
+        if self._projection is not None:
+            arrays['projection'] = self._projection
+        if ids is not None:
+            arrays['ids'] = ids
+        if neighbour_dists is not None:
+            arrays['neighbour_dists'] = neighbour_dists
+        with utils.o_gfile(path, 'wb') as f:
+            np.savez(f, **arrays)
+
+def training_index(opts, data, k):
+    """Index over a subset of the training points, kept in the work dir.
+
+    Returns the index, the ids of the points and the distances of every
+    point to its k nearest other points of the subset. The same subset,
+    projection and distances are reused across AdaGAN steps.
+    """
+    path = os.path.join(opts['work_dir'], INDEX_FILE)
+    mode = opts.get('knn_mode', 'exact')
+    num_points = min(opts.get('knn_num_points', 10000), data.num_points)
+    num_projections = opts.get('knn_projections', 64)
+    if tf.gfile.Exists(path):
+        with utils.o_gfile(path, 'rb') as f:
+            saved = dict(np.load(f).items())
+        valid = str(saved['mode']) == mode \
+            and len(saved['ids']) == num_points \
+            and 'neighbour_dists' in saved \
+            and saved['neighbour_dists'].shape[1] == k
+        if mode == 'projection':
+            valid = valid and saved['projection'].shape[1] == num_projections
+        if valid:
+            index = NeighbourIndex(data.data[saved['ids']], mode,
+                                   projection=saved.get('projection'))
+            return index, saved['ids'], saved['neighbour_dists']
+        logging.debug('Rebuilding the nearest neighbour index')
+    ids = np.sort(np.random.choice(data.num_points, num_points, replace=False))
+    index = NeighbourIndex(data.data[ids], mode,
+                           num_projections=num_projections)
+    neighbour_dists = index.neighbour_distances(k)
+    utils.create_dir(opts['work_dir'])
+    index.save(path, ids, neighbour_dists)
+    return index, ids, neighbour_dists
+
+def evaluate(opts, step, data, fake_points, k=3):
+    """Precision, recall and nearest training point distances of samples.
+
+    """
+    real_index, _, real_dists = training_index(opts, data, k)
+    num_fake = min(len(fake_points), len(real_index))
+    fake_points = fake_points[:num_fake]
+    fake_index = NeighbourIndex(
+        fake_points, opts.get('knn_mode', 'exact'),
+        num_projections=opts.get('knn_projections', 64))
+    fake_radii = fake_index.neighbour_distances(k)[:, -1]
+    precision = np.mean(real_index.covered(fake_points, real_dists[:, -1]))
+    recall = np.mean(fake_index.covered(real_index.points, fake_radii))
+    # Memorization: samples much closer to the training set than the
+    # training points are to each other
+    nn_dists, _ = real_index.query(fake_points, 1)
+    nn_dists = nn_dists[:, 0]
+    real_nn = real_dists[:, 0]
+    memorized = np.mean(nn_dists < np.percentile(real_nn, 1))
+    logging.info(
+        'Evaluating step %d: precision=%.3f, recall=%.3f, NN distance=%.3f '
+        '(real %.3f), memorized=%.4f' % (
+            step, precision, recall, np.median(nn_dists),
+            np.median(real_nn), memorized))
+    return {'precision': precision, 'recall': recall,
+            'nn_dists': nn_dists, 'memorized': memorized}
@@ -7,14 +7,354 @@
 
 import os
 import logging
+import collections
 import tensorflow as tf
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy.stats import multivariate_normal as scipy_normal
-from sklearn.neighbors.kde import KernelDensity
+from scipy import linalg as scipy_linalg
 import utils
+import kde as kde_lib
+import image_grid
+
+# Pre-trained MNIST classifiers loaded in this process,
+# by model file and batch size
+_MNIST_CLASSIFIERS = {}
+
+class MnistClassifier(object):
+    """Pre-trained MNIST classifier with its own graph and session.
+
+    Points are classified in batches of a fixed size, padding the last one,
+    so that every run uses the same input shape.
+    """
+
+    def __init__(self, opts, model_file, batch_size):
+        self._batch_size = batch_size
+        self._graph = tf.Graph()
+        with self._graph.as_default():
+            saver = tf.train.import_meta_graph(model_file + '.meta')
+            self._session = utils.create_session(opts, self._graph)
+            saver.restore(self._session, model_file)
+            input_ph = tf.get_collection('X_')
+            assert len(input_ph) > 0, 'Failed to load pre-trained model'
+            # Input placeholder
+            self._input_ph = input_ph[0]
+            dropout_keep_prob_ph = tf.get_collection('keep_prob')
+            assert len(dropout_keep_prob_ph) > 0, 'Failed to load pre-trained model'
+            self._dropout_keep_prob_ph = dropout_keep_prob_ph[0]
+            trained_net = tf.get_collection('prediction')
+            assert len(trained_net) > 0, 'Failed to load pre-trained model'
+            # Predicted digit
+            self._trained_net = trained_net[0]
+            logits = tf.get_collection('y_hat')
+            assert len(logits) > 0, 'Failed to load pre-trained model'
+            # Resulting 10 logits
+            logits = logits[0]
+            self._prob_max = tf.reduce_max(tf.nn.softmax(logits),
+                                           reduction_indices=[1])
+            self._features = _penultimate_layer(logits, self._input_ph)
+        self._graph.finalize()
+
+    def _run(self, fetches, points):
+        """Yields (start, end, values of fetches) for batches of points.
+
+        """
+        num_points = len(points)
+        batch_size = self._batch_size
+        for start in xrange(0, num_points, batch_size):
+            end = min(num_points, start + batch_size)
+            batch = points[start:end]
+            if end - start < batch_size:
+                pad = np.zeros([batch_size - len(batch)] + list(batch.shape[1:]))
+                batch = np.concatenate([batch, pad])
+            yield start, end, self._session.run(
+                fetches,
+                feed_dict={self._input_ph: batch,
+                           self._dropout_keep_prob_ph: 1.})
+
+    def classify(self, points):
+        """Predicted digits and their probabilities for points in [0, 1].
+
+        """
+        num_points = len(points)
+        digits = np.zeros(num_points, dtype=np.int64)
+        probs = np.zeros(num_points, dtype=np.float32)
+        for start, end, (_res, prob) in self._run(
+                [self._trained_net, self._prob_max], points):
+            digits[start:end] = _res[:end - start]
+            probs[start:end] = prob[:end - start]
+        return digits, probs
+
+    def features(self, points):
+        """Activations of the last hidden layer for points in [0, 1].
+
+        """
+        res = np.zeros([len(points), self._features.get_shape()[1].value],
+                       dtype=np.float32)
+        for start, end, features in self._run(self._features, points):
+            res[start:end] = features[:end - start]
+        return res
+
+    def close(self):
+        self._session.close()
+
+def _ancestors(tensor):
+    """Ops the value of tensor is computed from, including its own op.
+
+    """
+    res = set()
+    pending = [tensor.op]
+    while pending:
+        op = pending.pop()
+        if op not in res:
+            res.add(op)
+            pending.extend(t.op for t in op.inputs)
+    return res
+
+def _penultimate_layer(logits, inputs):
+    """Input of the last fully connected layer producing logits.
+
+    The 'features' collection of the model is used if there is one.
+    Otherwise the MatMul closest to logits is searched through all the
+    inputs of the ops, and its operand computed from inputs is returned.
+    """
+    features = logits.graph.get_collection('features')
+    if len(features) > 0:
+        return features[0]
+    seen = set()
+    pending = collections.deque([logits.op])
+    while pending:
+        op = pending.popleft()
+        if op in seen:
+            continue
+        seen.add(op)
+        if op.type == 'MatMul':
+            for tensor in op.inputs:
+                if inputs.op in _ancestors(tensor):
+                    return tensor
+        pending.extend(t.op for t in op.inputs)
+    assert False, 'No fully connected layer between the inputs and the ' \
+        'logits of the MNIST classifier, put the features into the ' \
+        '"features" collection of the model'
+
+def mnist_classifier(opts, batch_size=None):
+    """The MnistClassifier of opts, loaded once per process.
+
+    batch_size defaults to opts['tf_run_batch_size'].
+    """
+    model_file = os.path.join(opts['trained_model_path'],
+                              opts['mnist_trained_model_file'])
+    if batch_size is None:
+        batch_size = opts['tf_run_batch_size']
+    key = (model_file, batch_size)
+    if key not in _MNIST_CLASSIFIERS:
+        logging.debug('Loading the pre-trained classifier %s' % model_file)
+        _MNIST_CLASSIFIERS[key] = MnistClassifier(
+            opts, model_file, batch_size)
+    return _MNIST_CLASSIFIERS[key]
+
+def mnist_digits(opts, points):
+    """Individual (28, 28, 1) digits of MNIST or mnist3 points, in [0, 1].
+
+    mnist3 points give three consecutive digits each.
+    """
+    if opts['input_normalize_sym']:
+        # Rescaling data back to [0, 1.]
+        points = points / 2. + 0.5
+    if opts['dataset'] != 'mnist3':
+        return points
+    num_points = len(points)
+    if opts['mnist3_to_channels']:
+        # (num, 28, 28, 3) -> (num, 3, 28, 28)
+        points = np.transpose(points, (0, 3, 1, 2))
+    else:
+        # (num, 28, 3 * 28, 1) -> (num, 3, 28, 28)
+        height, width = points.shape[1], points.shape[2] / 3
+        points = np.reshape(points, [num_points, height, 3, width])
+        points = np.transpose(points, (0, 2, 1, 3))
+    return np.reshape(points, [3 * num_points] + list(points.shape[2:]) + [1])
+
+def mnist_embedding(opts):
+    """Function mapping points to the features of the MNIST classifier.
+
+    The features of the three mnist3 digits are concatenated.
+    """
+    classifier = mnist_classifier(opts)
+    def embed(points):
+        features = classifier.features(mnist_digits(opts, points))
+        return np.reshape(features, [len(points), -1])
+    return embed
+
+class StreamingMoments(object):
+    """Running mean and covariance of feature vectors.
+
+    Batches are merged with the parallel update of Chan et al., so the
+    memory does not depend on the number of points.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self._m2 = None
+
+    def update(self, features):
+        features = np.reshape(features, [len(features), -1]).astype(np.float64)
+        num = len(features)
+        if num == 0:
+            return
+        batch_mean = np.mean(features, axis=0)
+        centered = features - batch_mean
+        batch_m2 = np.dot(centered.T, centered)
+        if self.count == 0:
+            self.mean = batch_mean
+            self._m2 = batch_m2
+            self.count = num
+            return
+        total = self.count + num
+        delta = batch_mean - self.mean
+        self.mean = self.mean + delta * num / total
+        self._m2 += batch_m2 + np.outer(delta, delta) * self.count * num / total
+        self.count = total
+
+    @property
+    def covariance(self):
+        assert self.count > 1, 'Not enough points for a covariance'
+        return self._m2 / (self.count - 1.)
+
+# Mean and covariance of a distribution
+Moments = collections.namedtuple('Moments', ['mean', 'covariance'])
+
+def frechet_distance(moments1, moments2, eps=1e-6):
+    """Frechet distance between Gaussians with the given moments.
+
+    Moments are StreamingMoments or Moments.
+    """
+    diff = moments1.mean - moments2.mean
+    cov1 = moments1.covariance
+    cov2 = moments2.covariance
+    covmean, _ = scipy_linalg.sqrtm(np.dot(cov1, cov2), disp=False)
+    if not np.all(np.isfinite(covmean)):
+        # Singular product, regularize the covariances
+        offset = np.eye(len(cov1)) * eps
+        covmean = scipy_linalg.sqrtm(np.dot(cov1 + offset, cov2 + offset))
+    covmean = np.real(covmean)
+    return np.dot(diff, diff) + np.trace(cov1) + np.trace(cov2) \
+        - 2. * np.trace(covmean)
+
+def feature_moments(embed_fn, batches):
+    """StreamingMoments of the embed_fn features of batches of points.
+
+    """
+    moments = StreamingMoments()
+    for points in batches:
+        moments.update(embed_fn(points))
+    return moments
+
+class MixtureEvaluator(object):
+    """MNIST and mnist3 metrics of an AdaGAN mixture from cached statistics.
+
+    The stored sample of every component is classified once. The mixture
+    distribution over the modes is the weighted average of the component
+    ones, so an AdaGAN step only classifies the sample of the new component.
+    The metrics are those of _evaluate_mnist and _evaluate_mnist3, computed
+    for the whole stored samples instead of a fresh mixture sample. With
+    features=True the component feature moments are cached as well, for
+    the Frechet distance of the mixture.
+    """
+
+    def __init__(self, opts, features=False):
+        assert opts['dataset'] in ('mnist', 'mnist3'), \
+            'Cached evaluation works only for MNIST and mnist3'
+        self._digits_per_point = 3 if opts['dataset'] == 'mnist3' else 1
+        self._num_modes = 10 ** self._digits_per_point
+        self._features = features
+        self._components = []
+        self._real_moments = None
+
+    def _component_stats(self, opts, points):
+        num_points = len(points)
+        num_digits = self._digits_per_point
+        classifier = mnist_classifier(
+            opts, num_digits * opts['tf_run_batch_size'])
+        inputs = mnist_digits(opts, points)
+        digits, probs = classifier.classify(inputs)
+        digits = np.dot(np.reshape(digits, [num_points, num_digits]),
+                        10 ** np.arange(num_digits)[::-1])
+        probs = np.reshape(probs, [num_points, num_digits])
+        is_confident = np.all(
+            probs > opts['digit_classification_threshold'], axis=1)
+        stats = {
+            'modes': np.bincount(digits, minlength=self._num_modes) \
+                / (num_points + 0.),
+            'confident_modes': np.bincount(
+                digits[is_confident], minlength=self._num_modes) \
+                / (num_points + 0.),
+            'confidence': np.mean(probs)}
+        if self._features:
+            features = classifier.features(inputs)
+            moments = StreamingMoments()
+            moments.update(np.reshape(features, [num_points, -1]))
+            stats['moments'] = Moments(moments.mean, moments.covariance)
+        return stats
+
+    def _mixture_moments(self, weights):
+        mean = 0.
+        second = 0.
+        for weight, stats in zip(weights, self._components):
+            moments = stats['moments']
+            mean = mean + weight * moments.mean
+            second = second + weight * (
+                moments.covariance + np.outer(moments.mean, moments.mean))
+        return Moments(mean, second - np.outer(mean, mean))
+
+    def evaluate(self, opts, step, adagan, real_points=None):
+        """(JS, C, C_actual, conf) of the current mixture of adagan.
+
+        The Frechet distance to real_points is logged if features are used.
+        """
+        while len(self._components) < adagan.steps_made:
+            comp_id = len(self._components)
+            logging.debug('Classifying the sample of component %d' % comp_id)
+            self._components.append(self._component_stats(
+                opts, adagan.component_sample(comp_id)))
+        weights = adagan._mixture_weights
+        modes = sum(w * stats['modes']
+                    for w, stats in zip(weights, self._components))
+        confident_modes = sum(w * stats['confident_modes']
+                              for w, stats in zip(weights, self._components))
+        conf = sum(w * stats['confidence']
+                   for w, stats in zip(weights, self._components))
+        if np.sum(confident_modes) == 0:
+            C_actual = 0.
+            C = 0.
+            JS = 2.
+        else:
+            # Compute the actual coverage
+            C_actual = np.mean(confident_modes > 0)
+            # Compute the JS with uniform
+            JS = utils.js_div_uniform_dist(modes)
+            # Compute Pdata(Pmodel > t) where Pmodel( Pmodel > t ) = 0.95
+            phat = confident_modes / np.sum(confident_modes)
+            threshold = np.percentile(phat, 5)
+            ratio_not_covered = np.mean(phat <= threshold)
+            C = 1. - ratio_not_covered
+        logging.info(
+            'Evaluating: JS=%.3f, C=%.3f, C_actual=%.3f, Confidence=%.4f' %\
+            (JS, C, C_actual, conf))
+        if self._features and real_points is not None:
+            if self._real_moments is None:
+                embed_fn = mnist_embedding(opts)
+                batch_size = opts['tf_run_batch_size']
+                self._real_moments = feature_moments(
+                    embed_fn, (real_points[start:start + batch_size]
+                               for start in xrange(0, len(real_points),
+                                                   batch_size)))
+            dist = frechet_distance(self._real_moments,
+                                    self._mixture_moments(weights))
+            logging.info('Evaluating: Frechet distance=%.3f' % dist)
+        return (JS, C, C_actual, conf)
 
 class Metrics(object):
     """A base class implementing metrics, used to assess the quality of AdaGAN.
@@ -27,6 +367,8 @@ class Metrics(object):
 
     def __init__(self):
         self.l2s = None
+        # Training steps of the l2s values (if downsampled)
+        self.l2s_steps = None
         self.losses_match = None
         self.losses_rec = None
         self.Qz = None
@@ -105,6 +447,29 @@ class Metrics(object):
             logging.debug('Can not evaluate, sorry...')
             return None
 
+    def evaluate_frechet(self, opts, step, real_points, sample_fn,
+                         num_fake, embed_fn=None):
+        """Frechet distance between the real and the fake features.
+
+        The fake points are drawn by sample_fn(num) batch by batch, so any
+        number of them is evaluated in bounded memory. embed_fn maps points
+        to features and defaults to the MNIST classifier features.
+        """
+        if embed_fn is None:
+            embed_fn = mnist_embedding(opts)
+        batch_size = opts['tf_run_batch_size']
+        real_ids = np.random.choice(
+            len(real_points), min(num_fake, len(real_points)), replace=False)
+        real_moments = feature_moments(
+            embed_fn, (real_points[real_ids[start:start + batch_size]]
+                       for start in xrange(0, len(real_ids), batch_size)))
+        fake_moments = feature_moments(
+            embed_fn, (sample_fn(min(batch_size, num_fake - start))
+                       for start in xrange(0, num_fake, batch_size)))
+        dist = frechet_distance(real_moments, fake_moments)
+        logging.info('Evaluating: Frechet distance=%.3f' % dist)
+        return dist
+
     def _evaluate_vec(self, opts, step, real_points,
                       fake_points, validation_fake_points, prefix=''):
         """Compute the average log-likelihood and the Coverage metric.
@@ -119,31 +484,29 @@ class Metrics(object):
         bandwidth = np.median(dist)
         num_real = len(real_points)
         num_fake = len(fake_points)
+        # The fake, real and validation points are scored for all the
+        # bandwidths from a single pass over the pairwise distances
+        queries = [fake_points, real_points]
         if validation_fake_points is not None:
-            max_score = -1000000.
-            num_val = len(validation_fake_points)
             b_grid = bandwidth * (2. ** (np.arange(14) - 7.))
-            for _bandwidth in b_grid:
-                kde = KernelDensity(kernel='gaussian', bandwidth=_bandwidth)
-                kde.fit(np.reshape(fake_points, [num_fake, -1]))
-                score = np.mean(kde.score_samples(
-                    np.reshape(validation_fake_points, [num_val, -1])))
-                if score > max_score:
-                    # logging.debug("Updating bandwidth to %.4f"
-                    #             " with likelyhood %.2f" % (_bandwidth, score))
-                    bandwidth = _bandwidth
-                    max_score = score
-        kde = KernelDensity(kernel='gaussian',
-                            bandwidth=bandwidth)
-        kde.fit(np.reshape(fake_points, [num_fake, -1]))
+            queries.append(validation_fake_points)
+        else:
+            b_grid = np.array([bandwidth])
+        queries = [np.reshape(points, [len(points), -1]) for points in queries]
+        kde = kde_lib.GaussianKde(fake_points)
+        log_density = kde.score_samples(np.vstack(queries), b_grid)
+        best = 0
+        if validation_fake_points is not None:
+            # Bandwidth maximizing the likelihood of the validation points
+            best = np.argmax(
+                np.mean(log_density[:, num_fake + num_real:], axis=1))
+        log_density = log_density[best]
 
         # Computing Coverage, refer to Section 4.3 of arxiv paper
-        model_log_density = kde.score_samples(
-            np.reshape(fake_points, [num_fake, -1]))
+        model_log_density = log_density[:num_fake]
         # np.percentaile(a, 10) returns t s.t. np.mean( a <= t ) = 0.1
         threshold = np.percentile(model_log_density, 5)
-        real_points_log_density = kde.score_samples(
-            np.reshape(real_points, [num_real, -1]))
+        real_points_log_density = log_density[num_fake:num_fake + num_real]
         ratio_not_covered = np.mean(real_points_log_density <= threshold)
 
         log_p = np.mean(real_points_log_density)
@@ -159,8 +522,6 @@ class Metrics(object):
 
         # Classifying points with pre-trained model.
         # Pre-trained classifier assumes inputs are in [0, 1.]
-        # There may be many points, so we will sess.run
-        # in small chunks.
 
         if opts['input_normalize_sym']:
             # Rescaling data back to [0, 1.]
@@ -170,51 +531,12 @@ class Metrics(object):
             if validation_fake_points  is not None:
                 validation_fake_points = validation_fake_points / 2. + 0.5
 
-        with tf.Graph().as_default() as g:
-            model_file = os.path.join(opts['trained_model_path'],
-                                      opts['mnist_trained_model_file'])
-            saver = tf.train.import_meta_graph(model_file + '.meta')
-            with tf.Session().as_default() as sess:
-                saver.restore(sess, model_file)
-                input_ph = tf.get_collection('X_')
-                assert len(input_ph) > 0, 'Failed to load pre-trained model'
-                # Input placeholder
-                input_ph = input_ph[0]
-                dropout_keep_prob_ph = tf.get_collection('keep_prob')
-                assert len(dropout_keep_prob_ph) > 0, 'Failed to load pre-trained model'
-                dropout_keep_prob_ph = dropout_keep_prob_ph[0]
-                trained_net = tf.get_collection('prediction')
-                assert len(trained_net) > 0, 'Failed to load pre-trained model'
-                # Predicted digit
-                trained_net = trained_net[0]
-                logits = tf.get_collection('y_hat')
-                assert len(logits) > 0, 'Failed to load pre-trained model'
-                # Resulting 10 logits
-                logits = logits[0]
-                prob_max = tf.reduce_max(tf.nn.softmax(logits),
-                                         reduction_indices=[1])
-
-                batch_size = opts['tf_run_batch_size']
-                batches_num = int(np.ceil((num_fake + 0.) / batch_size))
-                result = []
-                result_probs = []
-                result_is_confident = []
-                thresh = opts['digit_classification_threshold']
-                for idx in xrange(batches_num):
-                    end_idx = min(num_fake, (idx + 1) * batch_size)
-                    batch_fake = fake_points[idx * batch_size:end_idx]
-                    _res, prob = sess.run(
-                        [trained_net, prob_max],
-                        feed_dict={input_ph: batch_fake,
-                                   dropout_keep_prob_ph: 1.})
-                    result.append(_res)
-                    result_probs.append(prob)
-                    result_is_confident.append(prob > thresh)
-                result = np.hstack(result)
-                result_probs = np.hstack(result_probs)
-                result_is_confident = np.hstack(result_is_confident)
-                assert len(result) == num_fake
-                assert len(result_probs) == num_fake
+        classifier = mnist_classifier(opts)
+        result, result_probs = classifier.classify(fake_points)
+        result_is_confident = result_probs > \
+            opts['digit_classification_threshold']
+        assert len(result) == num_fake
+        assert len(result_probs) == num_fake
 
         # Normalizing back
         if opts['input_normalize_sym']:
@@ -280,118 +602,48 @@ class Metrics(object):
         num_fake = len(fake_points)
 
         # Classifying points with pre-trained model.
-        # Pre-trained classifier assumes inputs are in [0, 1.]
-        # There may be many points, so we will sess.run
-        # in small chunks.
-
-        if opts['input_normalize_sym']:
-            # Rescaling data back to [0, 1.]
-            if real_points is not None:
-                real_points = real_points / 2. + 0.5
-            fake_points = fake_points / 2. + 0.5
-            if validation_fake_points  is not None:
-                validation_fake_points = validation_fake_points / 2. + 0.5
-
-        with tf.Graph().as_default() as g:
-            model_file = os.path.join(opts['trained_model_path'],
-                                      opts['mnist_trained_model_file'])
-            saver = tf.train.import_meta_graph(model_file + '.meta')
-            with tf.Session().as_default() as sess:
-                saver.restore(sess, model_file)
-                input_ph = tf.get_collection('X_')
-                assert len(input_ph) > 0, 'Failed to load pre-trained model'
-                # Input placeholder
-                input_ph = input_ph[0]
-                dropout_keep_prob_ph = tf.get_collection('keep_prob')
-                assert len(dropout_keep_prob_ph) > 0, 'Failed to load pre-trained model'
-                dropout_keep_prob_ph = dropout_keep_prob_ph[0]
-                trained_net = tf.get_collection('prediction')
-                assert len(trained_net) > 0, 'Failed to load pre-trained model'
-                # Predicted digit
-                trained_net = trained_net[0]
-                logits = tf.get_collection('y_hat')
-                assert len(logits) > 0, 'Failed to load pre-trained model'
-                # Resulting 10 logits
-                logits = logits[0]
-                prob_max = tf.reduce_max(tf.nn.softmax(logits),
-                                         reduction_indices=[1])
-
-                batch_size = opts['tf_run_batch_size']
-                batches_num = int(np.ceil((num_fake + 0.) / batch_size))
-                result = []
-                result_probs = []
-                result_is_confident = []
-                thresh = opts['digit_classification_threshold']
-                for idx in xrange(batches_num):
-                    end_idx = min(num_fake, (idx + 1) * batch_size)
-                    batch_fake = fake_points[idx * batch_size:end_idx]
-                    if opts['mnist3_to_channels']:
-                        input1, input2, input3 = np.split(batch_fake, 3, axis=3)
-                    else:
-                        input1, input2, input3 = np.split(batch_fake, 3, axis=2)
-                    _res1, prob1 = sess.run(
-                        [trained_net, prob_max],
-                        feed_dict={input_ph: input1,
-                                   dropout_keep_prob_ph: 1.})
-                    _res2, prob2 = sess.run(
-                        [trained_net, prob_max],
-                        feed_dict={input_ph: input2,
-                                   dropout_keep_prob_ph: 1.})
-                    _res3, prob3 = sess.run(
-                        [trained_net, prob_max],
-                        feed_dict={input_ph: input3,
-                                   dropout_keep_prob_ph: 1.})
-                    result.append(100 * _res1 + 10 * _res2 + _res3)
-                    result_probs.append(
-                        np.column_stack((prob1, prob2, prob3)))
-                    result_is_confident.append(
-                        (prob1 > thresh) * (prob2 > thresh) * (prob3 > thresh))
-                result = np.hstack(result)
-                result_probs = np.vstack(result_probs)
-                result_is_confident = np.hstack(result_is_confident)
-                assert len(result) == num_fake
-                assert len(result_probs) == num_fake
-
-        # Normalizing back
-        if opts['input_normalize_sym']:
-            # Rescaling data back to [0, 1.]
-            if real_points is not None:
-                real_points = 2. * (real_points - 0.5)
-            fake_points = 2. * (fake_points - 0.5)
-            if validation_fake_points  is not None:
-                validation_fake_points = 2. * (validation_fake_points - 0.5)
+        # All the 3 * num_fake digits are classified in one batched pass
+        inputs = mnist_digits(opts, fake_points)
+        classifier = mnist_classifier(opts, 3 * opts['tf_run_batch_size'])
+        _res, prob = classifier.classify(inputs)
+        _res = np.reshape(_res, [num_fake, 3])
+        result_probs = np.reshape(prob, [num_fake, 3])
+        result = np.dot(_res, [100, 10, 1])
+        result_is_confident = np.all(
+            result_probs > opts['digit_classification_threshold'], axis=1)
+        assert len(result) == num_fake
+        assert len(result_probs) == num_fake
 
         digits = result.astype(int)
         logging.debug(
             'Ratio of confident predictions: %.4f' %\
             np.mean(result_is_confident))
-        # Plot one fake image per detected mode
-        gathered = []
-        points_to_plot = []
-        for (idx, dig) in enumerate(list(digits)):
-            if not dig in gathered and result_is_confident[idx]:
-                gathered.append(dig)
-                p = result_probs[idx]
-                points_to_plot.append(fake_points[idx])
-                logging.debug('Mode %03d covered with prob %.3f, %.3f, %.3f' %\
-                              (dig, p[0], p[1], p[2]))
+        # Plot one fake image per detected mode, the first one found
+        confident_ids = np.flatnonzero(result_is_confident)
+        modes, first_ids = np.unique(digits[confident_ids], return_index=True)
+        mode_ids = np.sort(confident_ids[first_ids])
+        for idx in mode_ids:
+            p = result_probs[idx]
+            logging.debug('Mode %03d covered with prob %.3f, %.3f, %.3f' %\
+                          (digits[idx], p[0], p[1], p[2]))
+        points_to_plot = fake_points[mode_ids]
         # Confidence of made predictions
         conf = np.mean(result_probs)
         if len(points_to_plot) > 0:
             self._make_plots_pics(
-                opts, step, None, np.array(points_to_plot), None, 'modes_')
-        if np.sum(result_is_confident) == 0:
+                opts, step, None, points_to_plot, None, 'modes_')
+        if len(confident_ids) == 0:
             C_actual = 0.
             C = 0.
             JS = 2.
         else:
             # Compute the actual coverage
-            C_actual = len(np.unique(digits[result_is_confident])) / 1000.
+            C_actual = len(modes) / 1000.
             # Compute the JS with uniform
             JS = utils.js_div_uniform(digits)
             # Compute Pdata(Pmodel > t) where Pmodel( Pmodel > t ) = 0.95
             # np.percentaile(a, 10) returns t s.t. np.mean( a <= t ) = 0.1
-            phat = np.bincount(digits[result_is_confident], minlength=1000)
+            phat = np.bincount(digits[confident_ids], minlength=1000)
             phat = (phat + 0.) / np.sum(phat)
             threshold = np.percentile(phat, 5)
             ratio_not_covered = np.mean(phat <= threshold)
@@ -479,7 +731,6 @@ class Metrics(object):
     def _make_plots_pics(self, opts, step, real_points,
                          fake_points, weights=None, prefix='', max_rows=16,
                          name_force=None, for_paper=False):
-        pics = []
         if opts['dataset'] in ('mnist', 'dsprites', 'mnist_mod', 'zalando', 'mnist3', 'guitars', 'cifar10', 'celebA'):
             if opts['input_normalize_sym']:
                 if fake_points is not None:
@@ -487,41 +738,30 @@ class Metrics(object):
         num_pics = len(fake_points)
         assert num_pics > 0, 'No points to plot'
 
-        # Loading images
-        for idx in xrange(num_pics):
-            if opts['dataset'] == 'mnist3':
-                if opts['mnist3_to_channels']:
-                    # Digits are stacked in channels
-                    dig1 = fake_points[idx, :, :, 0]
-                    dig2 = fake_points[idx, :, :, 1]
-                    dig3 = fake_points[idx, :, :, 2]
-                    pics.append(1. - np.concatenate(
-                        [dig1, dig2, dig3], axis=1))
-                else:
-                    # Digits are stacked in width
-                    dig1 = fake_points[idx, :, 0:28, :]
-                    dig2 = fake_points[idx, :, 28:56, :]
-                    dig3 = fake_points[idx, :, 56:84, :]
-                    pics.append(1. - np.concatenate(
-                        [dig1, dig2, dig3], axis=1))
-            else:
-                if opts['dataset'] in ['mnist', 'dsprites', 'mnist_mod', 'zalando']:
-                    pics.append(1. - fake_points[idx, :, :, :])
-                else:
-                    pics.append(fake_points[idx, :, :, :])
+        pics = fake_points
+        if opts['dataset'] == 'mnist3' and opts['mnist3_to_channels']:
+            # Digits are stacked in channels, put them side by side
+            _, height_dig, width_dig, _ = pics.shape
+            pics = np.transpose(pics, (0, 1, 3, 2))
+            pics = np.reshape(pics, [num_pics, height_dig, 3 * width_dig, 1])
+        # Grey pictures are shown as with the Greys colormap, the digits
+        # were inverted before so they come out light on black
+        grey = pics.shape[-1] == 1
+        if grey and opts['dataset'] not in (
+                'mnist', 'dsprites', 'mnist_mod', 'zalando', 'mnist3'):
+            pics = 1. - pics
+        image = image_grid.tile(pics, max_rows, pad_value=0. if grey else 1.)
 
-        # Figuring out a layout
-        num_cols = int(np.ceil(1. * num_pics / max_rows))
-        last_col_num = num_pics % max_rows
-        if num_cols == 1:
-            image = np.concatenate(pics, axis=0)
+        if name_force is None:
+            filename = prefix + 'mixture{:06d}.png'.format(step)
         else:
-            if last_col_num > 0:
-                for _ in xrange(max_rows - last_col_num):
-                    pics.append(np.ones(pics[0].shape))
-            pics = np.array(pics)
-            image = np.concatenate(np.split(pics, num_cols), axis=2)
-            image = np.concatenate(image, axis=0)
+            filename = name_force
+        utils.create_dir(opts['work_dir'])
+        if for_paper or self.l2s is None:
+            # Only the pictures, no axes or loss curves: no need for matplotlib
+            with utils.o_gfile((opts["work_dir"], filename), 'wb') as f:
+                image_grid.save(image, f, scale=3)
+            return True
 
         # Plotting
         dpi = 100
@@ -530,13 +770,7 @@ class Metrics(object):
         height = 3 * height_pic / float(dpi)
         width = 3 * width_pic / float(dpi)
 
-        if self.l2s is None:
-            fig = plt.figure(frameon=False, figsize=(width, height))#, dpi=1)
-            if for_paper:
-                ax = plt.Axes(fig, [0., 0., 1., 1.])
-                ax.set_axis_off()
-                fig.add_axes(ax)
-        elif self.Qz is None:
+        if self.Qz is None:
             fig = plt.figure(figsize=(width, height + height / 2))#, dpi=1)
             gs = matplotlib.gridspec.GridSpec(2, 1, height_ratios=[2, 1])
             plt.subplot(gs[0])
@@ -546,27 +780,18 @@ class Metrics(object):
             plt.subplot(gs[0, :])
 
         # Showing the image
-        if not for_paper:
-            if fake_points[0].shape[-1] == 1:
-                image = image[:, :, 0]
-                ax = plt.imshow(image, cmap='Greys', interpolation='none')
-            elif opts['dataset'] == 'mnist3':
-                ax = plt.imshow(image, cmap='Greys', interpolation='none')
-            else:
-                ax = plt.imshow(image, interpolation='none')
-
-            # Removing ticks
-            ax.axes.get_xaxis().set_ticks([])
-            ax.axes.get_yaxis().set_ticks([])
-            ax.axes.set_xlim([0, width_pic])
-            ax.axes.set_ylim([height_pic, 0])
-            ax.axes.set_aspect(1)
+        if grey:
+            ax = plt.imshow(image[:, :, 0], cmap='gray', vmin=0., vmax=1.,
+                            interpolation='none')
         else:
-            if fake_points[0].shape[-1] == 1:
-                image = image[:, :, 0]
-                ax.imshow(image, cmap='Greys', interpolation='none')
-            else:
-                ax.imshow(image, interpolation='none')
+            ax = plt.imshow(image, interpolation='none')
+
+        # Removing ticks
+        ax.axes.get_xaxis().set_ticks([])
+        ax.axes.get_yaxis().set_ticks([])
+        ax.axes.set_xlim([0, width_pic])
+        ax.axes.set_ylim([height_pic, 0])
+        ax.axes.set_aspect(1)
 
         # Plotting auxiliary stuff
         if self.l2s is not None:
@@ -576,7 +801,10 @@ class Metrics(object):
             else:
                 plt.subplot(gs[1,0])
             cutoff = 1e2
-            x = np.arange(1, len(self.l2s) + 1)
+            if self.l2s_steps is not None:
+                x = self.l2s_steps
+            else:
+                x = np.arange(1, len(self.l2s) + 1)
             y = np.array([el if abs(el) < cutoff else el / abs(el) * cutoff for el in self.l2s])
             plt.plot(x, y, color='red', label='loss')
             if self.losses_match is not None and self.losses_rec is not None:
@@ -612,11 +840,6 @@ class Metrics(object):
                 plt.ylim(ymin, ymax)
                 plt.legend(loc='upper left')
         # Saving
-        if name_force is None:
-            filename = prefix + 'mixture{:06d}.png'.format(step)
-        else:
-            filename = name_force
-        utils.create_dir(opts['work_dir'])
         fig.savefig(utils.o_gfile((opts["work_dir"], filename), 'wb'),
                     dpi=dpi, format='png')
         plt.close()
@@ -167,6 +167,97 @@ def optimizer(opts, net=None, decay=1.):
     else:
         assert False, 'Unknown optimizer.'
 
+def sample_pz(opts, num):
+    """Latent noise drawn inside the graph, see utils.generate_noise.
+
+    """
+    shape = tf.stack([num, opts['latent_space_dim']])
+    if opts['latent_space_distr'] == 'uniform':
+        return tf.random_uniform(shape, -1., 1., dtype=tf.float32)
+    elif opts['latent_space_distr'] == 'normal':
+        return tf.random_normal(shape, dtype=tf.float32)
+    assert False, 'In-graph noise supports only uniform and normal Pz.'
+
+def noise_placeholder(opts, num=None, scale=1., name='noise_ph'):
+    """Placeholder for the latent noise, by default sampled in the graph.
+
+    The noise is drawn from Pz (scaled by scale) unless the placeholder is
+    fed, e.g. with the fixed noise used for plots. num is the number of
+    points drawn by default: a tensor, or None in which case a placeholder
+    defaulting to opts['batch_size'] is created.
+
+    Returns the noise placeholder and the placeholder/tensor for num.
+    """
+    if num is None:
+        num = tf.placeholder_with_default(
+            opts['batch_size'], [], name=name + '_num')
+    noise = sample_pz(opts, num)
+    if scale != 1.:
+        noise = scale * noise
+    noise_ph = tf.placeholder_with_default(
+        noise, [None, opts['latent_space_dim']], name=name)
+    return noise_ph, num
+
+def weights_placeholder(real_points, name='real_weights_ph'):
+    """Per-example loss weights of the real points, ones unless fed.
+
+    """
+    return tf.placeholder_with_default(
+        tf.ones(tf.shape(real_points)[:1]), [None], name=name)
+
+def weighted_mean(values, weights=None):
+    """Mean of values, the points (first axis) weighted by weights.
+
+    """
+    if weights is None:
+        return tf.reduce_mean(values)
+    values = tf.reshape(values, tf.stack([tf.shape(values)[0], -1]))
+    return tf.reduce_mean(tf.expand_dims(weights, 1) * values)
+
+class FreshReads(object):
+    """Custom getter returning explicit reads of the trainable variables.
+
+    Converting a variable to a tensor uses the snapshot taken when the
+    variable was created, so inside tf.while_loop or after control
+    dependencies on update ops the networks would see stale values. Models
+    built with this getter read the variables again wherever they are used.
+    Gradients are taken w.r.t. the reads and applied to the variables.
+    """
+
+    def __init__(self):
+        self._reads = []
+
+    def __call__(self, getter, *args, **kwargs):
+        var = getter(*args, **kwargs)
+        if not kwargs.get('trainable', True):
+            return var
+        read = var.read_value()
+        self._reads.append((read, var))
+        return read
+
+    def minimize(self, optim, loss, prefix):
+        """Apply the gradients of loss to the variables whose name has prefix.
+
+        optim should be an optimizer which already created its slots for
+        these variables, since no new variables can be created in a loop.
+        """
+        reads = [(read, var) for (read, var) in self._reads
+                 if prefix in var.name]
+        grads = tf.gradients(loss, [read for (read, _) in reads])
+        var_grads = {}
+        var_list = []
+        for grad, (_, var) in zip(grads, reads):
+            if grad is None:
+                continue
+            if var.name not in var_grads:
+                var_list.append(var)
+                var_grads[var.name] = grad
+            else:
+                # Variable used more than once in the graph
+                var_grads[var.name] += grad
+        return optim.apply_gradients(
+            [(var_grads[var.name], var) for var in var_list])
+
 def log_sum_exp(logits):
     l_max = tf.reduce_max(logits, axis=1, keep_dims=True)
     return tf.add(l_max,
@@ -6,11 +6,14 @@
 
 """
 import collections
+import hashlib
 import logging
 import os
 import time
 import tensorflow as tf
 import utils
+import checkpoint
+import export
 from utils import ProgressBar
 from utils import TQDM
 import numpy as np
@@ -104,16 +107,30 @@ class Pot(object):
     """
     def __init__(self, opts, data, weights):
 
-        # Create a new session with session.graph = default graph
-        self._session = tf.Session()
+        # The session is created once the graph is built
+        self._session = None
         self._trained = False
         self._data = data
-        self._data_weights = np.copy(weights)
+        # Where export_generator writes the frozen decoder by default
+        self._export_dir = None
+        # Dense arrays of weights are accepted as well
+        self._data_weights = utils.SparseWeights.from_dense(weights)
         # Latent noise sampled ones to apply decoder while training
         self._noise_for_plots = opts['pot_pz_std'] * utils.generate_noise(opts, 1000)
         # Placeholders
         self._real_points_ph = None
+        self._fake_points_ph = None
         self._noise_ph = None
+        self._saver = None
+        # Mixture discriminator
+        self._c_training = None
+        self._c_optim = None
+        # Background checkpoint writer (if any)
+        self._checkpointer = None
+        # Fixed-network features of the real points, see vgg_feature_cache
+        self._real_embed = None
+        self._real_embed_ph = None
+        self._feature_store = None
         # Init ops
         self._additional_init_ops = []
         self._init_feed_dict = {}
@@ -122,15 +139,28 @@ class Pot(object):
 
         # Optimizers
 
-        with self._session.as_default(), self._session.graph.as_default():
+        graph = tf.get_default_graph()
+        with graph.as_default():
             logging.error('Building the graph...')
             self._build_model_internal(opts)
+            # Make sure AdamOptimizer, if used in the Graph, is defined before
+            # calling global_variables_initializer().
+            self._init_op = tf.global_variables_initializer()
+            tuning_step = None
+            if opts.get('tf_autotune', False):
+                tuning_step = self._tuning_step(opts)
 
-        # Make sure AdamOptimizer, if used in the Graph, is defined before
-        # calling global_variables_initializer().
-        init = tf.global_variables_initializer()
-        self._session.run(init)
-        self._session.run(self._additional_init_ops, self._init_feed_dict)
+        # Create a new session with session.graph = default graph
+        self._session = utils.create_session(
+            opts, graph, name=type(self).__name__,
+            init_fn=self._init_session, tuning_step=tuning_step)
+        self._init_session(self._session)
+        if self._saver is not None:
+            with graph.as_default():
+                self._checkpointer = checkpoint.AsyncSaver(
+                    self._session, self._saver,
+                    keep_last=opts.get('ckpt_keep_last', 10),
+                    background=opts.get('ckpt_async', True))
 
     def __enter__(self):
         return self
@@ -139,10 +169,31 @@ class Pot(object):
         # Cleaning the whole default Graph
         logging.error('Cleaning the graph...')
         tf.reset_default_graph()
+        if self._checkpointer is not None:
+            logging.error('Waiting for the checkpoints to be written...')
+            self._checkpointer.close()
         logging.error('Closing the session...')
         # Finishing the session
         self._session.close()
 
+    def _init_session(self, session):
+        session.run(self._init_op)
+        session.run(self._additional_init_ops, self._init_feed_dict)
+
+    def _tuning_step(self, opts):
+        """Fetches and feed_dict of a training step, to benchmark sessions.
+
+        """
+        batch_size = opts['batch_size']
+        fetches = [self._optim]
+        if self._d_optim is not None:
+            fetches.append(self._d_optim)
+        feed_dict = {self._real_points_ph: self._data.data[:batch_size],
+                     self._lr_decay_ph: 1.,
+                     self._is_training_ph: True,
+                     self._keep_prob_ph: opts['dropout_keep_prob']}
+        return fetches, feed_dict
+
     def train(self, opts):
         """Train a POT model.
 
@@ -150,6 +201,8 @@ class Pot(object):
         with self._session.as_default(), self._session.graph.as_default():
             self._train_internal(opts)
             self._trained = True
+        if opts.get('export_generator', True):
+            self.export_generator(opts)
 
     def sample(self, opts, num=100):
         """Sample points from the trained POT model.
@@ -159,6 +212,37 @@ class Pot(object):
         with self._session.as_default(), self._session.graph.as_default():
             return self._sample_internal(opts, num)
 
+    def sample_iter(self, opts, num):
+        """Iterate over num samples, for samples not fitting in memory.
+
+        Yields arrays of at most opts['tf_run_batch_size'] points.
+        """
+        assert self._trained, 'Can not sample from the un-trained POT'
+        with self._session.as_default(), self._session.graph.as_default():
+            for chunk in self._sample_chunks(opts, num):
+                yield chunk
+
+    def export_generator(self, opts, export_dir=None):
+        """Write the trained decoder as a frozen graph, see export.py.
+
+        """
+        if export_dir is None:
+            export_dir = self._export_dir
+        if export_dir is None:
+            export_dir = os.path.join(opts['work_dir'], 'generator')
+        return export.export_generator(self, opts, export_dir)
+
+    def _export_pz_scale(self, opts):
+        return opts['pot_pz_std']
+
+    def _decoder_for_export(self, opts, noise):
+        """Decoder applied to noise, in the inference mode.
+
+        """
+        if opts['pz_transform']:
+            noise = self.pz_sampler(opts, noise)
+        return self.generator(opts, noise, is_training=False, keep_prob=1.)
+
     def train_mixture_discriminator(self, opts, fake_images):
         """Train classifier separating true data from points in fake_images.
 
@@ -238,6 +322,9 @@ class Pot(object):
     def _sample_internal(self, opts, num):
         assert False, 'POT base class has no sample method defined.'
 
+    def _sample_chunks(self, opts, num):
+        assert False, 'POT base class has no sample method defined.'
+
     def _train_mixture_discriminator_internal(self, opts, fake_images):
         assert False, 'POT base class has no mixture discriminator method defined.'
 
@@ -506,6 +593,27 @@ class ImagePot(Pot):
                     - 0.5 * opts['latent_space_dim'] * np.log(sigma2_p)
         return hi
 
+    def mixture_classifier(self, opts, input_, is_training,
+                           prefix='CLASSIFIER', reuse=False):
+        """Classifier of the pictures, separating data from a mixture.
+
+        """
+        num_filters = opts['d_num_filters']
+
+        with tf.variable_scope(prefix, reuse=reuse):
+            h0 = ops.conv2d(opts, input_, num_filters, scope='h0_conv')
+            h0 = ops.batch_norm(opts, h0, is_training, reuse, scope='bn_layer1')
+            h0 = ops.lrelu(h0)
+            h1 = ops.conv2d(opts, h0, num_filters * 2, scope='h1_conv')
+            h1 = ops.batch_norm(opts, h1, is_training, reuse, scope='bn_layer2')
+            h1 = ops.lrelu(h1)
+            h2 = ops.conv2d(opts, h1, num_filters * 4, scope='h2_conv')
+            h2 = ops.batch_norm(opts, h2, is_training, reuse, scope='bn_layer3')
+            h2 = ops.lrelu(h2)
+            h3 = ops.linear(opts, h2, 1, scope='h3_lin')
+
+        return h3
+
     def pz_sampler(self, opts, input_, prefix='PZ_SAMPLER', reuse=False):
         """Transformation to be applied to the sample from Pz
         We are trying to match Qz to phi(Pz), where phi is defined by
@@ -729,9 +837,23 @@ class ImagePot(Pot):
     def discriminator_mmd_test(self, opts, sample_qz, sample_pz):
         """U statistic for MMD(Qz, Pz) with the RBF kernel
 
+        The estimator is selected with opts['mmd_estimator']:
+            quadratic: full n x n distance matrices (default),
+            block: same U statistic computed over row blocks, O(n * b) memory,
+            linear: linear-time MMD over disjoint pairs of points,
+            rff: random Fourier features approximation of the RBF kernel.
         """
+        estimator = opts.get('mmd_estimator', 'quadratic')
+        if estimator == 'block':
+            return self.discriminator_mmd_block_test(opts, sample_qz, sample_pz)
+        elif estimator == 'linear':
+            return self.discriminator_mmd_linear_test(opts, sample_qz, sample_pz)
+        elif estimator == 'rff':
+            return self.discriminator_mmd_rff_test(opts, sample_qz, sample_pz)
+        assert estimator == 'quadratic', \
+            'Unknown MMD estimator %s' % estimator
         sigma2_p = opts['pot_pz_std'] ** 2 # var = std ** 2
-        kernel = 'IM'
+        kernel = opts.get('mmd_kernel', 'IM')
         n = self.get_batch_size(opts, sample_qz)
         n = tf.cast(n, tf.int32)
         nf = tf.cast(n, tf.float32)
@@ -802,6 +924,165 @@ class ImagePot(Pot):
             # stat = tf.reduce_sum(res) / (nf * nf)
         return stat
 
+    def _mmd_kernel_width(self, opts):
+        """Fixed kernel width used by the non-quadratic MMD estimators.
+
+        Both the median heuristic of the RBF kernel and the scale of the
+        inverse multiquadratics kernel are replaced with the expected squared
+        distance between two points of Pz, which does not require the
+        full matrix of pairwise distances.
+        """
+        sigma2_p = opts['pot_pz_std'] ** 2 # var = std ** 2
+        return 2. * opts['latent_space_dim'] * sigma2_p
+
+    def _mmd_kernel(self, opts, distances):
+        """Kernel values from squared distances for the block/linear MMD.
+
+        """
+        kernel = opts.get('mmd_kernel', 'IM')
+        width = self._mmd_kernel_width(opts)
+        if kernel == 'RBF':
+            return tf.exp( - distances / 2. / width)
+        elif kernel == 'IM':
+            return width / (width + distances)
+        assert False, 'Unknown MMD kernel %s' % kernel
+
+    def _mmd_kernel_derivative(self, opts, distances, values):
+        """Derivative of the kernel in the squared distance.
+
+        values are the kernel values at distances.
+        """
+        kernel = opts.get('mmd_kernel', 'IM')
+        width = self._mmd_kernel_width(opts)
+        if kernel == 'RBF':
+            return - values / 2. / width
+        elif kernel == 'IM':
+            return - tf.square(values) / width
+        assert False, 'Unknown MMD kernel %s' % kernel
+
+    def _mmd_block_sum(self, opts, sample_x, sample_y, exclude_diag):
+        """Sum of k(x_i, y_j) over all pairs, computed by blocks of rows.
+
+        Only a b x n block of distances is alive at any time, where b is
+        opts['mmd_block_size']. This holds for the training as well: the
+        gradients in sample_x and sample_y are accumulated block by block in
+        the same loop, instead of backpropagating through the loop, which
+        would keep all the blocks. If exclude_diag is True the i == j terms
+        are skipped, which requires sample_x and sample_y to be the same.
+        """
+        block_size = opts.get('mmd_block_size', 128)
+        x = tf.stop_gradient(sample_x)
+        y = tf.stop_gradient(sample_y)
+        n = tf.shape(x)[0]
+        m = tf.shape(y)[0]
+        num_blocks = (n + block_size - 1) // block_size
+        norms_y = tf.reduce_sum(tf.square(y), axis=1)
+        norms_y = tf.expand_dims(norms_y, 0)
+
+        def _body(i, total, grads_x, grads_y):
+            start = i * block_size
+            size = tf.minimum(block_size, n - start)
+            block = tf.slice(x, [start, 0], [size, -1])
+            norms_block = tf.reduce_sum(
+                tf.square(block), axis=1, keep_dims=True)
+            dotprods = tf.matmul(block, y, transpose_b=True)
+            distances = norms_block + norms_y - 2. * dotprods
+            res = self._mmd_kernel(opts, distances)
+            der = self._mmd_kernel_derivative(opts, distances, res)
+            if exclude_diag:
+                mask = 1. - tf.one_hot(tf.range(start, start + size), m)
+                res = tf.multiply(res, mask)
+                der = tf.multiply(der, mask)
+            # d ||x - y||^2 / dx = 2 (x - y)
+            grad_block = 2. * (
+                tf.reduce_sum(der, axis=1, keep_dims=True) * block \
+                - tf.matmul(der, y))
+            grads_y += 2. * (
+                tf.expand_dims(tf.reduce_sum(der, axis=0), 1) * y \
+                - tf.matmul(der, block, transpose_a=True))
+            return (i + 1, total + tf.reduce_sum(res),
+                    grads_x.write(i, grad_block), grads_y)
+
+        _, total, grads_x, grads_y = tf.while_loop(
+            lambda i, total, grads_x, grads_y: i < num_blocks, _body,
+            [tf.constant(0, dtype=tf.int32), tf.constant(0., dtype=tf.float32),
+             tf.TensorArray(tf.float32, size=num_blocks, infer_shape=False),
+             tf.zeros_like(y)])
+        grads_x = grads_x.concat()
+        # Equals total, with gradients grads_x and grads_y
+        linear = tf.reduce_sum(sample_x * grads_x) + \
+            tf.reduce_sum(sample_y * grads_y)
+        return total + linear - tf.stop_gradient(linear)
+
+    def discriminator_mmd_block_test(self, opts, sample_qz, sample_pz):
+        """U statistic for MMD(Qz, Pz) computed over blocks of rows.
+
+        Gives the same value as the quadratic estimator (up to the kernel
+        width, see _mmd_kernel_width) while using O(n * b) memory, also for
+        the gradients.
+        """
+        n = self.get_batch_size(opts, sample_qz)
+        nf = tf.cast(n, tf.float32)
+        res1 = self._mmd_block_sum(opts, sample_qz, sample_qz, True)
+        res1 += self._mmd_block_sum(opts, sample_pz, sample_pz, True)
+        res1 = res1 / (nf * nf - nf)
+        res2 = self._mmd_block_sum(opts, sample_qz, sample_pz, False)
+        res2 = res2 * 2. / (nf * nf)
+        stat = res1 - res2
+        if opts['verbose'] == 2:
+            stat = tf.Print(stat, [res1, res2], 'First two terms, negative term:')
+        return stat
+
+    def discriminator_mmd_linear_test(self, opts, sample_qz, sample_pz):
+        """Linear-time MMD(Qz, Pz), see Lemma 14 of Gretton et al. (2012)
+
+        The statistic reads:
+            \[
+                \frac{1}{n/2}\sum_{i=1}^{n/2} k(x_{2i-1}, x_{2i})
+                    + k(y_{2i-1}, y_{2i})
+                    - k(x_{2i-1}, y_{2i}) - k(x_{2i}, y_{2i-1})
+            \]
+        """
+        n = self.get_batch_size(opts, sample_qz)
+        n = tf.cast(n, tf.int32)
+        half_size = n // 2
+        qz1 = sample_qz[:half_size, :]
+        qz2 = sample_qz[half_size:2 * half_size, :]
+        pz1 = sample_pz[:half_size, :]
+        pz2 = sample_pz[half_size:2 * half_size, :]
+        def _dist(a, b):
+            return tf.reduce_sum(tf.square(a - b), axis=1)
+        res = self._mmd_kernel(opts, _dist(qz1, qz2))
+        res += self._mmd_kernel(opts, _dist(pz1, pz2))
+        res -= self._mmd_kernel(opts, _dist(qz1, pz2))
+        res -= self._mmd_kernel(opts, _dist(qz2, pz1))
+        stat = tf.reduce_mean(res)
+        return stat
+
+    def discriminator_mmd_rff_test(self, opts, sample_qz, sample_pz):
+        """MMD(Qz, Pz) with the RBF kernel approximated by random features
+
+        Uses opts['mmd_rff_dim'] random Fourier features (Rahimi & Recht)
+        drawn once when the graph is built, so the cost is linear in n.
+        """
+        kernel = opts.get('mmd_kernel', 'IM')
+        assert kernel == 'RBF', \
+            'Random Fourier features are available only for the RBF kernel'
+        num_features = opts.get('mmd_rff_dim', 500)
+        dim = opts['latent_space_dim']
+        width = self._mmd_kernel_width(opts)
+        freqs = np.random.randn(dim, num_features) / np.sqrt(width)
+        freqs = tf.constant(freqs, dtype=tf.float32)
+        phases = np.random.uniform(0., 2. * np.pi, num_features)
+        phases = tf.constant(phases, dtype=tf.float32)
+        def _features(sample):
+            proj = tf.matmul(sample, freqs) + phases
+            return np.sqrt(2. / num_features) * tf.cos(proj)
+        mean_qz = tf.reduce_mean(_features(sample_qz), axis=0)
+        mean_pz = tf.reduce_mean(_features(sample_pz), axis=0)
+        stat = tf.reduce_sum(tf.square(mean_qz - mean_pz))
+        return stat
+
     def correlation_loss(self, opts, input_):
         """
         Independence test based on Pearson's correlation.
@@ -1198,6 +1479,46 @@ class ImagePot(Pot):
 
         return adv_c_loss, emb_c_loss
 
+    def _real_embed_input(self, opts, real_p_embed):
+        """Allows feeding the fixed-network features of the real points.
+
+        With opts['vgg_feature_cache'] they are computed once per training
+        point and fed with the minibatch, so the network only runs on the
+        reconstructions.
+        """
+        if opts.get('vgg_feature_cache', False):
+            assert not opts['data_augm'], \
+                'Features of augmented images can not be cached'
+        self._real_embed = real_p_embed
+        self._real_embed_ph = tf.placeholder_with_default(
+            real_p_embed, real_p_embed.get_shape(), name='real_embed_ph')
+        return self._real_embed_ph
+
+    def _build_feature_store(self, opts):
+        """Computes (or loads) the features of all the training points.
+
+        """
+        def _compute(ids):
+            return self._session.run(
+                self._real_embed,
+                feed_dict={self._real_points_ph: self._data.data[ids],
+                           self._is_training_ph: False,
+                           self._keep_prob_ph: 1.})
+        path = os.path.join(opts['work_dir'], 'features_%s_%s.npy' % (
+            opts['adv_c_loss'], opts['vgg_layer']))
+        # A few evenly spaced rows tell whether the data itself changed
+        rows = np.linspace(0, self._data.num_points - 1,
+                           num=min(16, self._data.num_points)).astype(int)
+        data_hash = hashlib.md5(
+            np.ascontiguousarray(self._data.data[rows]).tobytes()).hexdigest()
+        fingerprint = 'dataset=%s input_normalize_sym=%s adv_c_loss=%s ' \
+                      'vgg_layer=%s data=%s' % (
+                          opts['dataset'], opts['input_normalize_sym'],
+                          opts['adv_c_loss'], opts['vgg_layer'], data_hash)
+        self._feature_store = utils.FeatureStore.build(
+            path, self._data.num_points, _compute,
+            batch_size=opts['tf_run_batch_size'], fingerprint=fingerprint)
+
     def _recon_loss_using_vgg(self, opts, reconstructed_training, real_points, is_training, keep_prob):
         """Build an additional loss using a pretrained VGG in X space."""
 
@@ -1240,7 +1561,8 @@ class ImagePot(Pot):
         reconstructed_embed = _architecture(reconstructed_training, reuse=True)
         # Below line enforces the forward to be reconstructed_embed and backwards to NOT change the discriminator....
         crazy_hack = reconstructed_embed-reconstructed_embed_sg+tf.stop_gradient(reconstructed_embed_sg)
-        real_p_embed = _architecture(real_points, reuse=True)
+        real_p_embed = self._real_embed_input(
+            opts, _architecture(real_points, reuse=True))
 
         emb_c = tf.reduce_mean(tf.square(crazy_hack - tf.stop_gradient(real_p_embed)), 1)
         emb_c_loss = tf.reduce_mean(tf.sqrt(emb_c + 1e-5))
@@ -1288,7 +1610,8 @@ class ImagePot(Pot):
         reconstructed_embed = _architecture(reconstructed_training, reuse=True)
         # Below line enforces the forward to be reconstructed_embed and backwards to NOT change the discriminator....
         crazy_hack = reconstructed_embed-reconstructed_embed_sg+tf.stop_gradient(reconstructed_embed_sg)
-        real_p_embed = _architecture(real_points, reuse=True)
+        real_p_embed = self._real_embed_input(
+            opts, _architecture(real_points, reuse=True))
 
         emb_c = tf.reduce_mean(tf.square(crazy_hack - tf.stop_gradient(real_p_embed)), 1)
         emb_c_loss = tf.reduce_mean(emb_c)
@@ -1398,10 +1721,15 @@ class ImagePot(Pot):
         # Placeholders
         real_points_ph = tf.placeholder(
             tf.float32, [None] + list(data_shape), name='real_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
-        enc_noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='enc_noise_ph')
+        fake_points_ph = tf.placeholder(
+            tf.float32, [None] + list(data_shape), name='fake_points_ph')
+        # Pz noise and the noise of the random encoder are sampled in the
+        # graph (one point per input point) unless the placeholders are fed
+        num_points = tf.shape(real_points_ph)[0]
+        noise_ph, _ = ops.noise_placeholder(
+            opts, num=num_points, scale=opts['pot_pz_std'])
+        enc_noise_ph, _ = ops.noise_placeholder(
+            opts, num=num_points, name='enc_noise_ph')
         lr_decay_ph = tf.placeholder(tf.float32)
         is_training_ph = tf.placeholder(tf.bool, name='is_training_ph')
         keep_prob_ph = tf.placeholder(tf.float32, name='keep_prob_ph')
@@ -1569,12 +1897,29 @@ class ImagePot(Pot):
         # this is handy when visually inspection Qz = Pz
         self.add_least_gaussian2d_ops(opts)
 
+        # Mixture discriminator, used by AdaGAN to reweight the data
+        c_logits_real = self.mixture_classifier(
+            opts, real_points_ph, is_training_ph)
+        c_logits_fake = self.mixture_classifier(
+            opts, fake_points_ph, is_training_ph, reuse=True)
+        c_training = tf.nn.sigmoid(
+            self.mixture_classifier(opts, real_points_ph, is_training_ph,
+                                    reuse=True))
+        c_loss_real = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=c_logits_real, labels=tf.ones_like(c_logits_real)))
+        c_loss_fake = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=c_logits_fake, labels=tf.zeros_like(c_logits_fake)))
+        c_loss = c_loss_real + c_loss_fake
+
         # Optimizer ops
         t_vars = tf.trainable_variables()
         # Updates for discriminator
         d_vars = [var for var in t_vars if 'DISCRIMINATOR/' in var.name]
         # Updates for everything but adversary (encoder, decoder and possibly pz-transform)
-        all_vars = [var for var in t_vars if 'DISCRIMINATOR/' not in var.name]
+        all_vars = [var for var in t_vars if 'DISCRIMINATOR/' not in var.name
+                    and 'CLASSIFIER/' not in var.name]
         # Updates for everything but adversary (encoder, decoder and possibly pz-transform)
         eg_vars = [var for var in t_vars if 'GENERATOR/' in var.name or 'ENCODER/' in var.name]
         # Encoder variables separately if we want to pretrain
@@ -1593,6 +1938,8 @@ class ImagePot(Pot):
         pretrain_optim = None
         if opts['e_pretrain']:
             pretrain_optim = ops.optimizer(opts, net='g').minimize(loss=loss_pretrain, var_list=e_vars)
+        c_vars = [var for var in t_vars if 'CLASSIFIER/' in var.name]
+        c_optim = ops.optimizer(opts).minimize(c_loss, var_list=c_vars)
 
 
         generated_images = self.generator(
@@ -1600,6 +1947,7 @@ class ImagePot(Pot):
             reuse=True, keep_prob=keep_prob_ph)
 
         self._real_points_ph = real_points_ph
+        self._fake_points_ph = fake_points_ph
         self._real_points = real_points
         self._noise_ph = noise_ph
         self._noise = noise
@@ -1618,6 +1966,8 @@ class ImagePot(Pot):
         self._additional_losses = additional_losses
         self._g_mom_stats = g_mom_stats
         self._d_loss = d_loss
+        self._c_training = c_training
+        self._c_optim = c_optim
         self._generated = generated_images
         self._Qz = encoded_training
         self._reconstruct_x = reconstructed_training
@@ -1649,18 +1999,12 @@ class ImagePot(Pot):
             data_ids = np.random.choice(train_size, min(train_size, batch_size),
                                         replace=False)
             batch_images = self._data.data[data_ids].astype(np.float)
-            batch_noise = opts['pot_pz_std'] *\
-                utils.generate_noise(opts, batch_size)
-            # Noise for the random encoder (if present)
-            batch_enc_noise = utils.generate_noise(opts, batch_size)
 
             # Update encoder
             [_, loss_pretrain] = self._session.run(
                 [self._pretrain_optim,
                  self._loss_pretrain],
                 feed_dict={self._real_points_ph: batch_images,
-                           self._noise_ph: batch_noise,
-                           self._enc_noise_ph: batch_enc_noise,
                            self._is_training_ph: True,
                            self._keep_prob_ph: opts['dropout_keep_prob']})
 
@@ -1680,10 +2024,16 @@ class ImagePot(Pot):
         train_size = self._data.num_points
         num_plot = 320
         sample_prev = np.zeros([num_plot] + list(self._data.data_shape))
-        l2s = []
-        losses = []
-        losses_rec = []
-        losses_match = []
+        # Mean over the last epoch and minimum over the last 20 epochs
+        train_metrics = utils.TrainingMetrics(
+            ['loss', 'loss_rec', 'loss_match'],
+            window=batches_num, min_window=20 * batches_num)
+        # The Qz matching terms and the extra reconstruction losses treat
+        # the minibatch as a sample of the target distribution
+        assert opts.get('weights_mode', 'resample') == 'resample', \
+            'POT supports only the resample weights mode'
+        sampler = utils.MinibatchSampler(
+            self._data_weights, opts['batch_size'], 'resample')
         wait = 0
 
         start_time = time.time()
@@ -1698,6 +2048,10 @@ class ImagePot(Pot):
             self.pretrain(opts)
             logging.error('Pretraining the encoder done')
 
+        if opts.get('vgg_feature_cache', False) and self._real_embed is not None:
+            logging.error('Computing the features of the training points')
+            self._build_feature_store(opts)
+
         for _epoch in xrange(opts["gan_epoch_num"]):
 
             if opts['decay_schedule'] == "manual":
@@ -1712,42 +2066,38 @@ class ImagePot(Pot):
                 decay = 1.0 * 10**(-_epoch / float(opts['decay_schedule']))
 
             if _epoch > 0 and _epoch % opts['save_every_epoch'] == 0:
-                os.path.join(opts['work_dir'], opts['ckpt_dir'])
-                self._saver.save(self._session,
-                                 os.path.join(opts['work_dir'],
-                                              opts['ckpt_dir'],
-                                              'trained-pot'),
-                                 global_step=counter)
+                self._checkpointer.save(
+                    os.path.join(opts['work_dir'],
+                                 opts['ckpt_dir'],
+                                 'trained-pot'),
+                    global_step=counter,
+                    score=train_metrics.mean('loss'))
 
             for _idx in xrange(batches_num):
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
+                data_ids, _ = sampler.sample()
                 batch_images = self._data.data[data_ids].astype(np.float)
-                # Noise for the Pz=Qz GAN
-                batch_noise = opts['pot_pz_std'] *\
-                    utils.generate_noise(opts, opts['batch_size'])
-                # Noise for the random encoder (if present)
-                batch_enc_noise = utils.generate_noise(opts, opts['batch_size'])
 
                 # Update generator (decoder) and encoder
+                feed_dict = {self._real_points_ph: batch_images,
+                             self._lr_decay_ph: decay,
+                             self._is_training_ph: True,
+                             self._keep_prob_ph: opts['dropout_keep_prob']}
+                if self._feature_store is not None:
+                    feed_dict[self._real_embed_ph] = \
+                        self._feature_store[data_ids]
                 [_, loss, loss_rec, loss_match] = self._session.run(
                     [self._optim,
                      self._loss,
                      self._loss_reconstruct,
                      self._loss_match],
-                    feed_dict={self._real_points_ph: batch_images,
-                               self._noise_ph: batch_noise,
-                               self._enc_noise_ph: batch_enc_noise,
-                               self._lr_decay_ph: decay,
-                               self._is_training_ph: True,
-                               self._keep_prob_ph: opts['dropout_keep_prob']})
+                    feed_dict=feed_dict)
 
                 if opts['decay_schedule'] == "plateau":
                     # First 30 epochs do nothing
                     if _epoch >= 30:
                         # If no significant progress was made in last 10 epochs
                         # then decrease the learning rate.
-                        if loss < min(losses[-20 * batches_num:]):
+                        if loss < train_metrics.min('loss'):
                             wait = 0
                         else:
                             wait += 1
@@ -1755,30 +2105,23 @@ class ImagePot(Pot):
                             decay = max(decay  / 1.4, 1e-6)
                             logging.error('Reduction in learning rate: %f' % decay)
                             wait = 0
-                losses.append(loss)
-                losses_rec.append(loss_rec)
-                losses_match.append(loss_match)
+                train_metrics.update(loss=loss, loss_rec=loss_rec,
+                                     loss_match=loss_match)
                 if opts['verbose'] >= 2:
-                    # logging.error('loss after %d steps : %f' % (counter, losses[-1]))
-                    logging.error('loss match  after %d steps : %f' % (counter, losses_match[-1]))
+                    # logging.error('loss after %d steps : %f' % (counter, loss))
+                    logging.error('loss match  after %d steps : %f' % (counter, loss_match))
 
                 # Update discriminator in Z space (if any).
                 if self._d_optim is not None:
                     for _st in range(opts['d_steps']):
                         if opts['d_new_minibatch']:
-                            d_data_ids = np.random.choice(
-                                train_size, opts['batch_size'],
-                                replace=False, p=self._data_weights)
-                            d_batch_images = self._data.data[data_ids].astype(np.float)
-                            d_batch_enc_noise = utils.generate_noise(opts, opts['batch_size'])
+                            d_data_ids, _ = sampler.sample()
+                            d_batch_images = self._data.data[d_data_ids].astype(np.float)
                         else:
                             d_batch_images = batch_images
-                            d_batch_enc_noise = batch_enc_noise
                         _ = self._session.run(
                             [self._d_optim, self._d_loss],
                             feed_dict={self._real_points_ph: d_batch_images,
-                                       self._noise_ph: batch_noise,
-                                       self._enc_noise_ph: d_batch_enc_noise,
                                        self._lr_decay_ph: decay,
                                        self._is_training_ph: True,
                                        self._keep_prob_ph: opts['dropout_keep_prob']})
@@ -1793,9 +2136,7 @@ class ImagePot(Pot):
                         [self._loss_reconstruct, self._reconstruct_x, self._g_mom_stats, self._loss_z_corr,
                          self._additional_losses],
                         feed_dict={self._real_points_ph: test,
-                                   self._enc_noise_ph: utils.generate_noise(opts, len(test)),
                                    self._is_training_ph: False,
-                                   self._noise_ph: batch_noise,
                                    self._keep_prob_ph: 1e5})
                     debug_str = 'Epoch: %d/%d, batch:%d/%d, batch/sec:%.2f' % (
                         _epoch+1, opts['gan_epoch_num'], _idx+1,
@@ -1841,7 +2182,6 @@ class ImagePot(Pot):
                         self._Qz,
                         feed_dict={
                             self._real_points_ph: self._data.data[:Qz_num],
-                            self._enc_noise_ph: utils.generate_noise(opts, Qz_num),
                             self._is_training_ph: False,
                             self._keep_prob_ph: 1e5})
                     # Searching least Gaussian 2d projection
@@ -1854,9 +2194,11 @@ class ImagePot(Pot):
                         metrics.Qz_labels = self._data.labels[:Qz_num]
                     else:
                         metrics.Qz_labels = None
-                    metrics.l2s = losses[:]
-                    metrics.losses_match = [opts['pot_lambda'] * el for el in losses_match]
-                    metrics.losses_rec = [opts['reconstr_w'] * el for el in losses_rec]
+                    metrics.l2s_steps, metrics.l2s = train_metrics.history('loss')
+                    _, losses_match = train_metrics.history('loss_match')
+                    _, losses_rec = train_metrics.history('loss_rec')
+                    metrics.losses_match = opts['pot_lambda'] * losses_match
+                    metrics.losses_rec = opts['reconstr_w'] * losses_rec
                     to_plot = [points_to_plot, 0 * batch_images[:16], batch_images]
                     if rec_test is not None:
                         to_plot += [0 * batch_images[:16], rec_test[:64]]
@@ -1875,7 +2217,6 @@ class ImagePot(Pot):
                         [self._reconstruct_x, self._real_points],
                         feed_dict={
                             self._real_points_ph: self._data.data[:num_real_p],
-                            self._enc_noise_ph: utils.generate_noise(opts, num_real_p),
                             self._is_training_ph: True,
                             self._keep_prob_ph: 1e5})
                     points = real_p
@@ -1895,19 +2236,68 @@ class ImagePot(Pot):
                         prefix='reconstr_e%04d_mb%05d_' % (_epoch, _idx))
                     sample_prev = points_to_plot[:]
         if _epoch > 0:
-            os.path.join(opts['work_dir'], opts['ckpt_dir'])
-            self._saver.save(self._session,
-                             os.path.join(opts['work_dir'],
-                                          opts['ckpt_dir'],
-                                          'trained-pot-final'),
-                             global_step=counter)
+            self._checkpointer.save(
+                os.path.join(opts['work_dir'],
+                             opts['ckpt_dir'],
+                             'trained-pot-final'),
+                global_step=counter)
 
     def _sample_internal(self, opts, num):
-        """Sample from the trained GAN model.
+        """Sample from the trained POT model.
 
         """
-        # noise = opts['pot_pz_std'] * utils.generate_noise(opts, num)
-        # sample = self._run_batch(
-        #     opts, self._generated, self._noise_ph, noise, self._is_training_ph, False)
-        sample = None
+        sample = np.empty([num] + list(self._data.data_shape),
+                          dtype=np.float32)
+        start = 0
+        for chunk in self._sample_chunks(opts, num):
+            sample[start:start + len(chunk)] = chunk
+            start += len(chunk)
         return sample
+
+    def _sample_chunks(self, opts, num):
+        """Decodes Pz noise in chunks of opts['tf_run_batch_size'] points.
+
+        """
+        batch_size = opts['tf_run_batch_size']
+        pool = utils.noise_pool(opts, scale=opts['pot_pz_std'])
+        feed_dict = {self._is_training_ph: False,
+                     self._keep_prob_ph: 1.}
+        for start in xrange(0, num, batch_size):
+            feed_dict[self._noise_ph] = pool.get(min(batch_size, num - start))
+            yield self._session.run(self._generated, feed_dict=feed_dict)
+
+    def _train_mixture_discriminator_internal(self, opts, fake_images):
+        """Train a classifier separating true data from points in fake_images.
+
+        """
+
+        batches_num = self._data.num_points / opts['batch_size']
+        logging.debug('Training a mixture discriminator')
+        logging.debug('Using %d real points and %d fake ones' %\
+                      (self._data.num_points, len(fake_images)))
+        for epoch in xrange(opts["mixture_c_epoch_num"]):
+            for idx in xrange(batches_num):
+                ids = np.random.choice(len(fake_images), opts['batch_size'],
+                                       replace=False)
+                batch_fake_images = fake_images[ids]
+                ids = np.random.choice(self._data.num_points, opts['batch_size'],
+                                       replace=False)
+                batch_real_images = self._data.data[ids]
+                _ = self._session.run(
+                    self._c_optim,
+                    feed_dict={self._real_points_ph: batch_real_images,
+                               self._fake_points_ph: batch_fake_images,
+                               self._is_training_ph: True})
+
+        # Evaluating trained classifier on real points
+        res = self._run_batch(
+            opts, self._c_training,
+            self._real_points_ph, self._data.data,
+            self._is_training_ph, False)
+
+        # Evaluating trained classifier on fake points
+        res_fake = self._run_batch(
+            opts, self._c_training,
+            self._real_points_ph, fake_images,
+            self._is_training_ph, False)
+        return res, res_fake
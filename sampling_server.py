@@ -0,0 +1,254 @@
+# Copyright 2017 Max Planck Society
+# Distributed under the BSD-3 Software license,
+# (See accompanying file ./LICENSE.txt or copy at
+# https://opensource.org/licenses/BSD-3-Clause)
+"""Serving samples of a trained AdaGAN mixture over local HTTP.
+
+Loads the frozen generators exported for every component (see export.py)
+and the mixture weights saved by AdaGan, without the training code.
+
+    GET /sample?num=N   N samples, as a numpy .npy file
+    GET /stats          latency percentiles and throughput, as json
+
+Concurrent requests are coalesced into a single batched decoder run.
+"""
+
+import os
+import io
+import json
+import time
+import logging
+import threading
+import collections
+from six.moves import BaseHTTPServer
+from six.moves import socketserver
+from six.moves import queue
+from six.moves.urllib.parse import urlparse, parse_qs
+import numpy as np
+import tensorflow as tf
+import export
+
+flags = tf.app.flags
+flags.DEFINE_string("workdir", 'results_mnist', "Working directory of AdaGAN ['results_mnist']")
+flags.DEFINE_string("host", 'localhost', "Host to listen on ['localhost']")
+flags.DEFINE_integer("port", 8470, "Port to listen on [8470]")
+flags.DEFINE_integer("max_batch", 1000, "Largest number of samples decoded at once [1000]")
+flags.DEFINE_float("max_delay", 0.005, "Seconds to wait for more requests to batch [0.005]")
+FLAGS = flags.FLAGS
+
+MAX_NUM = 100000 # Largest number of samples per request
+
+class MixtureSampler(object):
+    """Samples from the mixture of exported component generators.
+
+    """
+
+    def __init__(self, work_dir, seed=None):
+        self.weights = np.load(
+            os.path.join(work_dir, 'mixture_weights.npy')).astype(np.float64)
+        self.weights /= np.sum(self.weights)
+        self._generators = []
+        for comp_id in xrange(len(self.weights)):
+            export_dir = os.path.join(work_dir, 'generator{:02d}'.format(comp_id))
+            self._generators.append(export.FrozenGenerator(export_dir))
+        self.data_shape = self._generators[0].meta['data_shape']
+        self._rng = np.random.RandomState(seed)
+
+    def sample(self, num):
+        counts = self._rng.multinomial(num, self.weights)
+        res = np.empty([num] + self.data_shape, dtype=np.float32)
+        start = 0
+        for generator, count in zip(self._generators, counts):
+            if count > 0:
+                res[start:start + count] = generator.sample(count)
+                start += count
+        # Otherwise the samples are sorted by component
+        self._rng.shuffle(res)
+        return res
+
+    def close(self):
+        for generator in self._generators:
+            generator.close()
+
+class _Request(object):
+    def __init__(self, num):
+        self.num = num
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class Batcher(object):
+    """Runs the sampler on a background thread, batching pending requests.
+
+    The first waiting request starts a batch, which then collects the
+    requests arriving within max_delay seconds, as long as the total
+    number of samples stays below max_batch.
+    """
+
+    def __init__(self, sampler, max_batch=1000, max_delay=0.005):
+        self._sampler = sampler
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._queue = queue.Queue()
+        self.stats = ServerStats()
+        self._thread = threading.Thread(target=self._worker)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def sample(self, num):
+        start = time.time()
+        request = _Request(num)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        self.stats.add_request(num, time.time() - start)
+        return request.result
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        if batch[0] is None:
+            return None
+        total = batch[0].num
+        deadline = time.time() + self._max_delay
+        while total < self._max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # Finish the current batch first
+                self._queue.put(None)
+                break
+            batch.append(request)
+            total += request.num
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                points = self._sampler.sample(sum(r.num for r in batch))
+                self.stats.add_batch(len(batch))
+                start = 0
+                for request in batch:
+                    request.result = points[start:start + request.num]
+                    start += request.num
+            except Exception as e:
+                logging.error('Sampling failed: %s' % e)
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+class ServerStats(object):
+    """Request latencies and throughput counters.
+
+    """
+
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=window)
+        self._start = time.time()
+        self._requests = 0
+        self._samples = 0
+        self._batches = 0
+        self._batched_requests = 0
+
+    def add_request(self, num, latency):
+        with self._lock:
+            self._latencies.append(latency)
+            self._requests += 1
+            self._samples += num
+
+    def add_batch(self, num_requests):
+        with self._lock:
+            self._batches += 1
+            self._batched_requests += num_requests
+
+    def summary(self):
+        with self._lock:
+            elapsed = time.time() - self._start
+            latencies = np.array(self._latencies)
+            res = {'requests': self._requests,
+                   'samples': self._samples,
+                   'batches': self._batches,
+                   'uptime': elapsed,
+                   'requests_per_sec': self._requests / elapsed,
+                   'samples_per_sec': self._samples / elapsed}
+            if self._batches > 0:
+                res['requests_per_batch'] = \
+                    self._batched_requests / float(self._batches)
+        if len(latencies) > 0:
+            res['latency_p50'] = float(np.percentile(latencies, 50))
+            res['latency_p99'] = float(np.percentile(latencies, 99))
+        return res
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/sample':
+            args = parse_qs(url.query)
+            try:
+                num = int(args.get('num', ['1'])[0])
+            except ValueError:
+                num = 0
+            if num < 1 or num > MAX_NUM:
+                self.send_error(400, 'num should be in [1, %d]' % MAX_NUM)
+                return
+            buf = io.BytesIO()
+            np.save(buf, self.server.batcher.sample(num))
+            self._reply(buf.getvalue(), 'application/octet-stream')
+        elif url.path == '/stats':
+            summary = self.server.batcher.stats.summary()
+            self._reply(json.dumps(summary), 'application/json')
+        else:
+            self.send_error(404)
+
+    def _reply(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+class SamplingServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server handling every request on its own thread.
+
+    """
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        BaseHTTPServer.HTTPServer.__init__(self, address, _Handler)
+        self.batcher = batcher
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+    sampler = MixtureSampler(FLAGS.workdir)
+    batcher = Batcher(sampler, FLAGS.max_batch, FLAGS.max_delay)
+    server = SamplingServer((FLAGS.host, FLAGS.port), batcher)
+    logging.info('Serving %d components on %s:%d' % (
+        len(sampler.weights), FLAGS.host, FLAGS.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    batcher.close()
+    sampler.close()
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,11 @@ import tensorflow as tf
 import os
 import sys
 import copy
+import time
+import multiprocessing
+import threading
+from six.moves import queue
+import collections
 import numpy as np
 import logging
 import matplotlib
@@ -27,14 +32,112 @@ def generate_noise(opts, num=100):
         noise = np.random.uniform(
             -1, 1, [num, opts["latent_space_dim"]]).astype(np.float32)
     elif opts['latent_space_distr'] == 'normal':
-        mean = np.zeros(opts["latent_space_dim"])
-        cov = np.identity(opts["latent_space_dim"])
-        noise = np.random.multivariate_normal(
-            mean, cov, num).astype(np.float32)
+        noise = np.random.standard_normal(
+            [num, opts["latent_space_dim"]]).astype(np.float32)
     elif opts['latent_space_distr'] == 'mnist':
         noise = np.random.rand(1, opts['latent_space_dim'])
     return noise
 
+def noise_chunk(dim, num, distr='normal', scale=1., seed=0, stream_id=0):
+    """num float32 points of the latent noise stream stream_id of seed.
+
+    These are the points NoisePool(dim, distr, scale, seed, chunk_size=num)
+    returns as its chunk number stream_id.
+    """
+    rng = np.random.RandomState([seed, stream_id])
+    shape = [num, dim]
+    if distr == 'normal':
+        chunk = rng.standard_normal(shape)
+    else:
+        chunk = rng.uniform(-1., 1., shape)
+    chunk = chunk.astype(np.float32)
+    if scale != 1.:
+        chunk *= scale
+    return chunk
+
+class NoisePool(object):
+    """Latent noise pre-generated by a background thread.
+
+    Noise is generated in chunks of chunk_size float32 points, at most
+    num_chunks of them are kept ready. Chunk number i is drawn from its own
+    np.random.RandomState([seed, i]), so the sequence of points only
+    depends on the seed. get() returns views into the chunks (no copy)
+    whenever the requested points fit into the current chunk. Chunks are
+    never overwritten, so the returned arrays stay valid.
+    """
+
+    def __init__(self, dim, distr='normal', scale=1., seed=0,
+                 chunk_size=10000, num_chunks=4):
+        assert distr in ('normal', 'uniform'), \
+            'Noise pool supports only uniform and normal distributions'
+        self._dim = dim
+        self._distr = distr
+        self._scale = scale
+        self._seed = seed
+        self._chunk_size = chunk_size
+        self._chunks = queue.Queue(maxsize=num_chunks)
+        self._current = np.zeros((0, dim), dtype=np.float32)
+        self._pos = 0
+        self._stopped = False
+        self._thread = threading.Thread(target=self._fill)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _generate(self, stream_id):
+        return noise_chunk(self._dim, self._chunk_size, self._distr,
+                           self._scale, self._seed, stream_id)
+
+    def _fill(self):
+        stream_id = 0
+        while not self._stopped:
+            chunk = self._generate(stream_id)
+            while not self._stopped:
+                try:
+                    self._chunks.put(chunk, timeout=1.)
+                    break
+                except queue.Full:
+                    pass
+            stream_id += 1
+
+    def get(self, num):
+        """Next num points of the pool, array of shape [num, dim].
+
+        """
+        if self._pos + num <= len(self._current):
+            res = self._current[self._pos:self._pos + num]
+            self._pos += num
+            return res
+        parts = [self._current[self._pos:]]
+        left = num - len(parts[0])
+        while left > 0:
+            self._current = self._chunks.get()
+            self._pos = min(left, len(self._current))
+            parts.append(self._current[:self._pos])
+            left -= self._pos
+        return np.concatenate(parts)
+
+    def close(self):
+        self._stopped = True
+        self._thread.join()
+
+_NOISE_POOLS = {}
+
+def noise_pool(opts, scale=1.):
+    """Process-wide noise pool for the latent distribution of opts.
+
+    Pools are seeded with opts['random_seed'], a new seed (e.g. the next
+    run in the same process) stops the pools of the previous one.
+    """
+    seed = opts.get('random_seed', 0)
+    key = (seed, opts['latent_space_distr'], opts['latent_space_dim'], scale)
+    if key not in _NOISE_POOLS:
+        for stale in [k for k in _NOISE_POOLS if k[0] != seed]:
+            _NOISE_POOLS.pop(stale).close()
+        _NOISE_POOLS[key] = NoisePool(
+            opts['latent_space_dim'], opts['latent_space_distr'], scale,
+            seed=seed)
+    return _NOISE_POOLS[key]
+
 class ArraySaver(object):
     """A simple class helping with saving/loading numpy arrays from files.
 
@@ -64,6 +167,144 @@ class ArraySaver(object):
         else:
             assert False, 'Unknown save / load mode'
 
+class SparseWeights(object):
+    """Discrete distribution over the training points, kept on its support.
+
+    AdaGAN reweighting often zeroes out most of the training points, so only
+    the ids of the points with non-zero weight and their weights are stored.
+    """
+
+    def __init__(self, ids, values, num_points):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.num_points = num_points
+
+    @classmethod
+    def from_dense(cls, weights):
+        """SparseWeights of a dense (num_points,) array of weights.
+
+        """
+        if isinstance(weights, SparseWeights):
+            return weights
+        weights = np.asarray(weights, dtype=np.float64)
+        ids = np.flatnonzero(weights)
+        return cls(ids, weights[ids], len(weights))
+
+    @classmethod
+    def uniform(cls, num_points):
+        return cls(np.arange(num_points),
+                   np.ones(num_points) / (num_points + 0.), num_points)
+
+    def __len__(self):
+        return self.num_points
+
+    @property
+    def support_size(self):
+        return len(self.ids)
+
+    def dense(self):
+        res = np.zeros(self.num_points)
+        res[self.ids] = self.values
+        return res
+
+    def sample(self, num, replace=False):
+        """Ids of num points drawn according to the weights.
+
+        """
+        pos = np.random.choice(self.support_size, num,
+                               replace=replace, p=self.values)
+        return self.ids[pos]
+
+class MinibatchSampler(object):
+    """Draws minibatches of training points according to the data weights.
+
+    In the 'resample' mode the points are drawn with probabilities given by
+    the weights and all get unit loss weights. In the 'loss' mode they are
+    drawn uniformly from the support of the weights, which costs
+    O(batch_size), and the data weights (scaled by the support size, so that
+    the expected loss stays the same) are returned as per-example loss
+    weights. Weights are either a dense array or SparseWeights.
+    """
+
+    def __init__(self, weights, batch_size, mode='resample'):
+        self._weights = SparseWeights.from_dense(weights)
+        self._batch_size = batch_size
+        self._mode = mode
+        if mode == 'resample':
+            self._ones = np.ones(batch_size, dtype=np.float32)
+        elif mode == 'loss':
+            self._loss_weights = (self._weights.support_size *
+                                  self._weights.values).astype(np.float32)
+        else:
+            assert False, 'Unknown weights mode %s' % mode
+
+    def sample(self):
+        """Ids of the minibatch points and their loss weights.
+
+        """
+        if self._mode == 'resample':
+            return self._weights.sample(self._batch_size), self._ones
+        pos = np.random.randint(self._weights.support_size,
+                                size=self._batch_size)
+        return self._weights.ids[pos], self._loss_weights[pos]
+
+class FeatureStore(object):
+    """Fixed per data point features, memory-mapped from a .npy file.
+
+    Row i holds the features of the i-th training point, so a minibatch
+    of features is store[data_ids].
+    """
+
+    def __init__(self, path):
+        self.features = np.load(path, mmap_mode='r')
+
+    def __len__(self):
+        return len(self.features)
+
+    def __getitem__(self, ids):
+        return self.features[ids]
+
+    @classmethod
+    def build(cls, path, num_points, compute_fn, batch_size=128,
+              fingerprint=''):
+        """Store compute_fn(ids) of all the points, unless already stored.
+
+        fingerprint is a string describing how the features were computed.
+        It is kept in path + '.key' and a stored file with another
+        fingerprint or row count is computed again.
+        """
+        key_path = path + '.key'
+        if os.path.exists(path) and os.path.exists(key_path):
+            with open(key_path) as f:
+                stored_fingerprint = f.read()
+            store = cls(path)
+            if len(store) == num_points and \
+                    stored_fingerprint == fingerprint:
+                logging.error('Using stored features from %s' % path)
+                return store
+            logging.error('Stored features in %s are stale, recomputing' % path)
+            del store
+        if os.path.exists(key_path):
+            # Features without their key are never picked up
+            os.remove(key_path)
+        tmp_path = path + '.tmp'
+        features = None
+        for start in xrange(0, num_points, batch_size):
+            ids = np.arange(start, min(start + batch_size, num_points))
+            batch = compute_fn(ids)
+            if features is None:
+                features = np.lib.format.open_memmap(
+                    tmp_path, mode='w+', dtype=np.float32,
+                    shape=(num_points,) + batch.shape[1:])
+            features[ids] = batch
+        features.flush()
+        del features
+        # Partially written stores are never picked up
+        os.rename(tmp_path, path)
+        with open(key_path, 'w') as f:
+            f.write(fingerprint)
+        return cls(path)
+
 class ProgressBar(object):
     """Super-simple progress bar.
 
@@ -95,6 +336,214 @@ def TQDM(opts, myRange, *args, **kwargs):
     else:
         return myRange
 
+# Thread configurations picked by the auto-tuning, per model class
+_TUNED_THREADS = {}
+
+def session_config(opts, intra_threads=None, inter_threads=None):
+    """tf.ConfigProto with the threading and graph options from opts.
+
+    0 threads means that TensorFlow picks the number of threads itself.
+    """
+    if intra_threads is None:
+        intra_threads = opts.get('tf_intra_op_threads', 0)
+    if inter_threads is None:
+        inter_threads = opts.get('tf_inter_op_threads', 0)
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=intra_threads,
+        inter_op_parallelism_threads=inter_threads,
+        use_per_session_threads=opts.get('tf_per_session_threads', False),
+        allow_soft_placement=True)
+    if opts.get('tf_xla_jit', False):
+        config.graph_options.optimizer_options.global_jit_level = \
+            tf.OptimizerOptions.ON_1
+    return config
+
+def set_thread_affinity(opts):
+    """Pin the OpenMP threads of MKL builds of TensorFlow.
+
+    Has effect only before the first session of the process is created.
+    """
+    affinity = opts.get('tf_thread_affinity', None)
+    if affinity is None:
+        return
+    os.environ.setdefault('KMP_AFFINITY', affinity)
+    os.environ.setdefault('KMP_BLOCKTIME', '1')
+    intra_threads = opts.get('tf_intra_op_threads', 0)
+    if intra_threads > 0:
+        os.environ.setdefault('OMP_NUM_THREADS', str(intra_threads))
+
+def _thread_candidates(opts):
+    candidates = opts.get('tf_autotune_candidates', None)
+    if candidates is not None:
+        return candidates
+    cores = multiprocessing.cpu_count()
+    candidates = [(0, 0), (cores, 1), (cores, 2),
+                  (max(1, cores / 2), 2), (max(1, cores / 4), 4)]
+    res = []
+    for candidate in candidates:
+        if candidate not in res:
+            res.append(candidate)
+    return res
+
+def _autotune_threads(opts, graph, init_fn, tuning_step):
+    """Time a few training steps for each (intra, inter) thread setting.
+
+    """
+    fetches, feed_dict = tuning_step
+    num_steps = opts.get('tf_autotune_steps', 20)
+    best = None
+    for intra_threads, inter_threads in _thread_candidates(opts):
+        config = session_config(opts, intra_threads, inter_threads)
+        # Global thread pools are created only once per process
+        config.use_per_session_threads = True
+        with tf.Session(graph=graph, config=config) as session:
+            init_fn(session)
+            # The first step includes the graph setup
+            session.run(fetches, feed_dict)
+            start_time = time.time()
+            for _ in xrange(num_steps):
+                session.run(fetches, feed_dict)
+            step_time = (time.time() - start_time) / num_steps
+        logging.error('Threads intra=%d, inter=%d: %.4f sec/step' % (
+            intra_threads, inter_threads, step_time))
+        if best is None or step_time < best[0]:
+            best = (step_time, intra_threads, inter_threads)
+    return best[1], best[2]
+
+def create_session(opts, graph, name=None, init_fn=None, tuning_step=None):
+    """Create a session for the graph, configured by opts.
+
+    If opts['tf_autotune'] is set, the thread settings are chosen by timing
+    tuning_step = (fetches, feed_dict) in sessions initialized with
+    init_fn. The result is cached by name, so the benchmark runs once per
+    model class and process.
+    """
+    set_thread_affinity(opts)
+    if opts.get('tf_autotune', False) and tuning_step is not None:
+        if name not in _TUNED_THREADS:
+            logging.error('Auto-tuning the threads for %s...' % name)
+            _TUNED_THREADS[name] = _autotune_threads(
+                opts, graph, init_fn, tuning_step)
+        intra_threads, inter_threads = _TUNED_THREADS[name]
+        config = session_config(opts, intra_threads, inter_threads)
+        config.use_per_session_threads = True
+    else:
+        config = session_config(opts)
+    return tf.Session(graph=graph, config=config)
+
+class _MetricStream(object):
+    """Bounded statistics of a single scalar recorded every training step.
+
+    """
+
+    def __init__(self, window, min_window, history, ema_decay):
+        # Ring buffer with the last `window` values
+        self.buffer = np.zeros(window)
+        self.window_sum = 0.
+        # Monotonic deque of (step, value) pairs for the sliding minimum
+        self.min_window = min_window
+        self.min_deque = collections.deque()
+        # Downsampled history: every `stride`-th value is kept
+        self.history_size = history
+        self.history_steps = []
+        self.history_values = []
+        self.stride = 1
+        self.ema_decay = ema_decay
+        self.ema = None
+        self.total = 0.
+        self.count = 0
+        self.last = None
+
+    def update(self, value):
+        value = float(value)
+        pos = self.count % len(self.buffer)
+        if self.count >= len(self.buffer):
+            self.window_sum -= self.buffer[pos]
+        self.buffer[pos] = value
+        self.window_sum += value
+        while self.min_deque and self.min_deque[-1][1] >= value:
+            self.min_deque.pop()
+        self.min_deque.append((self.count, value))
+        while self.min_deque[0][0] <= self.count - self.min_window:
+            self.min_deque.popleft()
+        if self.ema is None:
+            self.ema = value
+        else:
+            self.ema = self.ema_decay * self.ema + (1. - self.ema_decay) * value
+        if self.count % self.stride == 0:
+            self.history_steps.append(self.count + 1)
+            self.history_values.append(value)
+            if len(self.history_values) >= 2 * self.history_size:
+                self.history_steps = self.history_steps[::2]
+                self.history_values = self.history_values[::2]
+                self.stride *= 2
+        self.total += value
+        self.count += 1
+        self.last = value
+
+class TrainingMetrics(object):
+    """Constant-time and bounded-memory bookkeeping of training losses.
+
+    For every name keeps the last value, the mean over the last `window`
+    values (ring buffer), the minimum over the last `min_window` values
+    (monotonic deque), the running mean and exponential moving average,
+    and a history downsampled to at most 2 * `history` points for plots.
+    """
+
+    def __init__(self, names, window=100, min_window=None,
+                 history=500, ema_decay=0.99):
+        if min_window is None:
+            min_window = window
+        self._streams = {}
+        for name in names:
+            self._streams[name] = _MetricStream(
+                window, min_window, history, ema_decay)
+
+    def update(self, **kwargs):
+        for name, value in kwargs.items():
+            self._streams[name].update(value)
+
+    def count(self, name):
+        return self._streams[name].count
+
+    def last(self, name):
+        return self._streams[name].last
+
+    def min(self, name):
+        """Minimum over the last min_window values, inf if nothing recorded.
+
+        """
+        stream = self._streams[name]
+        if not stream.min_deque:
+            return np.inf
+        return stream.min_deque[0][1]
+
+    def mean(self, name):
+        """Mean over the last window values.
+
+        """
+        stream = self._streams[name]
+        num = min(stream.count, len(stream.buffer))
+        if num == 0:
+            return np.nan
+        return stream.window_sum / num
+
+    def total_mean(self, name):
+        stream = self._streams[name]
+        if stream.count == 0:
+            return np.nan
+        return stream.total / stream.count
+
+    def ema(self, name):
+        return self._streams[name].ema
+
+    def history(self, name):
+        """Downsampled (steps, values) arrays for plotting.
+
+        """
+        stream = self._streams[name]
+        return np.array(stream.history_steps), np.array(stream.history_values)
+
 def create_dir(d):
     if not tf.gfile.IsDirectory(d):
         tf.gfile.MakeDirs(d)
@@ -132,6 +581,14 @@ def js_div_uniform(p, num_cat=1000):
 
     """
     phat = np.bincount(p, minlength=num_cat)
+    return js_div_uniform_dist(phat)
+
+def js_div_uniform_dist(phat):
+    """ JS-divergence between the distribution phat and the uniform one.
+
+    phat may be unnormalized.
+    """
+    num_cat = len(phat)
     phat = (phat + 0.0) / np.sum(phat)
     pu = (phat * .0 + 1.) / num_cat
     pref = (phat + pu) / 2.
@@ -141,31 +598,63 @@ def js_div_uniform(p, num_cat=1000):
 
     return JS
 
+def _debug_subset(opts, num, num_plot):
+    """Ids of at most opts['debug_max_points'] distinct random points out
+    of num, None to use all of them.
+
+    At least 2 * num_plot points are kept, the least and most extreme ones
+    are plotted.
+    """
+    max_points = opts.get('debug_max_points', 10 ** 6)
+    if max_points is None:
+        return None
+    max_points = max(max_points, 2 * num_plot)
+    if num <= max_points:
+        return None
+    return np.sort(np.random.choice(num, max_points, replace=False))
+
+def _extreme_ids(values, num):
+    """Ids of the num smallest and of the num largest values, in ascending
+    order of the values.
+
+    Linear time selection, only the selected values are sorted.
+    """
+    part = np.argpartition(values, [num - 1, len(values) - num])
+    lowest = part[:num]
+    highest = part[-num:]
+    lowest = lowest[np.argsort(values[lowest])]
+    highest = highest[np.argsort(values[highest])]
+    return lowest, highest
+
 def debug_mixture_classifier(opts, step, probs, points, num_plot=320, real=True):
     """Small debugger for the mixture classifier's output.
 
     """
+    if not opts.get('debug_plots', True):
+        return
     num = len(points)
     if len(probs) != num:
         return
     if num < 2 * num_plot:
         return
-    sorted_vals_and_ids = sorted(zip(probs, range(num)))
+    probs = np.reshape(probs, [num, -1])[:, 0]
+    subset = _debug_subset(opts, num, num_plot)
+    if subset is not None:
+        lowest, highest = _extreme_ids(probs[subset], num_plot)
+        lowest, highest = subset[lowest], subset[highest]
+    else:
+        lowest, highest = _extreme_ids(probs, num_plot)
     if real:
-        correct = sorted_vals_and_ids[-num_plot:]
-        wrong = sorted_vals_and_ids[:num_plot]
+        correct_ids, wrong_ids = highest, lowest
     else:
-        correct = sorted_vals_and_ids[:num_plot]
-        wrong = sorted_vals_and_ids[-num_plot:]
-    correct_ids = [_id for val, _id in correct]
-    wrong_ids = [_id for val, _id in wrong]
+        correct_ids, wrong_ids = lowest, highest
     idstring = 'real' if real else 'fake'
     logging.debug('Correctly classified %s points probs:' %\
                   idstring)
-    logging.debug([val[0] for val, _id in correct])
+    logging.debug(list(probs[correct_ids]))
     logging.debug('Incorrectly classified %s points probs:' %\
                   idstring)
-    logging.debug([val[0] for val, _id in wrong])
+    logging.debug(list(probs[wrong_ids]))
     metrics = metrics_lib.Metrics()
     metrics.make_plots(opts, step,
                        None, points[correct_ids],
@@ -177,21 +666,28 @@ def debug_mixture_classifier(opts, step, probs, points, num_plot=320, real=True)
 def debug_updated_weights(opts, steps, weights, data):
     """ Various debug plots for updated weights of training points.
 
+    weights is an instance of SparseWeights.
     """
     assert data.num_points == len(weights), 'Length mismatch'
-    ws_and_ids = sorted(zip(weights,
-                        range(len(weights))))
+    if not opts.get('debug_plots', True):
+        return
+    sparse = weights
     num_plot = 20 * 16
-    if num_plot > len(weights):
+    if num_plot > len(sparse):
         return
-    ids = [_id for w, _id in ws_and_ids[:num_plot]]
-    plot_points = data.data[ids]
+    weights = sparse.dense()
+    subset = _debug_subset(opts, len(weights), num_plot)
+    if subset is not None:
+        weights = weights[subset]
+    least_ids, most_ids = _extreme_ids(weights, num_plot)
+    if subset is not None:
+        least_ids, most_ids = subset[least_ids], subset[most_ids]
+    plot_points = data.data[least_ids]
     metrics = metrics_lib.Metrics()
     metrics.make_plots(opts, steps,
                        None, plot_points,
                        prefix='d_least_')
-    ids = [_id for w, _id in ws_and_ids[-num_plot:]]
-    plot_points = data.data[ids]
+    plot_points = data.data[most_ids]
     metrics = metrics_lib.Metrics()
     metrics.make_plots(opts, steps,
                        None, plot_points,
@@ -199,14 +695,16 @@ def debug_updated_weights(opts, steps, weights, data):
     plt.clf()
     ax1 = plt.subplot(211)
     ax1.set_title('Weights over data points')
-    plt.plot(range(len(weights)), sorted(weights))
+    plt.plot(range(len(weights)), np.sort(weights))
     plt.axis([0, len(weights), 0., 2. * np.max(weights)])
     if data.labels is not None:
-        all_labels = np.unique(data.labels)
-        w_per_label = -1. * np.ones(len(all_labels))
-        for _id, y in enumerate(all_labels):
-            w_per_label[_id] = np.sum(
-                    weights[np.where(data.labels == y)[0]])
+        # Labels are small non-negative integers
+        labels = np.asarray(data.labels).astype(np.int64).flatten()
+        all_labels = np.nonzero(np.bincount(labels))[0]
+        # Points outside of the support do not contribute
+        w_per_label = np.bincount(labels[sparse.ids], weights=sparse.values,
+                                  minlength=all_labels[-1] + 1)
+        w_per_label = w_per_label[all_labels]
         ax2 = plt.subplot(212)
         ax2.set_title('Weights over labels')
         plt.scatter(range(len(all_labels)), w_per_label, s=30)
@@ -10,6 +10,8 @@ import os
 import logging
 import tensorflow as tf
 import utils
+import checkpoint
+import export
 from utils import ProgressBar
 from utils import TQDM
 import numpy as np
@@ -22,16 +24,22 @@ class Vae(object):
     """
     def __init__(self, opts, data, weights):
 
-        # Create a new session with session.graph = default graph
-        self._session = tf.Session()
+        # The session is created once the graph is built
+        self._session = None
         self._trained = False
         self._data = data
-        self._data_weights = np.copy(weights)
+        # Where export_generator writes the frozen decoder by default
+        self._export_dir = None
+        # Dense arrays of weights are accepted as well
+        self._data_weights = utils.SparseWeights.from_dense(weights)
         # Latent noise sampled ones to apply decoder while training
         self._noise_for_plots = utils.generate_noise(opts, 500)
         # Placeholders
         self._real_points_ph = None
         self._noise_ph = None
+        self._saver = None
+        # Background checkpoint writer (if any)
+        self._checkpointer = None
 
         # Main operations
         # FIX
@@ -44,14 +52,28 @@ class Vae(object):
         # Optimizers
         self.optim = None
 
-        with self._session.as_default(), self._session.graph.as_default():
+        graph = tf.get_default_graph()
+        with graph.as_default():
             logging.error('Building the graph...')
             self._build_model_internal(opts)
+            # Make sure AdamOptimizer, if used in the Graph, is defined before
+            # calling global_variables_initializer().
+            self._init_op = tf.global_variables_initializer()
+            tuning_step = None
+            if opts.get('tf_autotune', False):
+                tuning_step = self._tuning_step(opts)
 
-        # Make sure AdamOptimizer, if used in the Graph, is defined before
-        # calling global_variables_initializer().
-        init = tf.global_variables_initializer()
-        self._session.run(init)
+        # Create a new session with session.graph = default graph
+        self._session = utils.create_session(
+            opts, graph, name=type(self).__name__,
+            init_fn=self._init_session, tuning_step=tuning_step)
+        self._init_session(self._session)
+        if self._saver is not None:
+            with graph.as_default():
+                self._checkpointer = checkpoint.AsyncSaver(
+                    self._session, self._saver,
+                    keep_last=opts.get('ckpt_keep_last', 10),
+                    background=opts.get('ckpt_async', True))
 
     def __enter__(self):
         return self
@@ -60,10 +82,26 @@ class Vae(object):
         # Cleaning the whole default Graph
         logging.error('Cleaning the graph...')
         tf.reset_default_graph()
+        if self._checkpointer is not None:
+            logging.error('Waiting for the checkpoints to be written...')
+            self._checkpointer.close()
         logging.error('Closing the session...')
         # Finishing the session
         self._session.close()
 
+    def _init_session(self, session):
+        session.run(self._init_op)
+
+    def _tuning_step(self, opts):
+        """Fetches and feed_dict of a training step, to benchmark sessions.
+
+        """
+        batch_size = opts['batch_size']
+        feed_dict = {self._real_points_ph: self._data.data[:batch_size],
+                     self._lr_decay_ph: 1.,
+                     self._is_training_ph: True}
+        return self._optim, feed_dict
+
     def train(self, opts):
         """Train a VAE model.
 
@@ -71,6 +109,8 @@ class Vae(object):
         with self._session.as_default(), self._session.graph.as_default():
             self._train_internal(opts)
             self._trained = True
+        if opts.get('export_generator', True):
+            self.export_generator(opts)
 
     def sample(self, opts, num=100):
         """Sample points from the trained VAE model.
@@ -80,6 +120,25 @@ class Vae(object):
         with self._session.as_default(), self._session.graph.as_default():
             return self._sample_internal(opts, num)
 
+    def export_generator(self, opts, export_dir=None):
+        """Write the trained decoder as a frozen graph, see export.py.
+
+        """
+        if export_dir is None:
+            export_dir = self._export_dir
+        if export_dir is None:
+            export_dir = os.path.join(opts['work_dir'], 'generator')
+        return export.export_generator(self, opts, export_dir)
+
+    def _export_pz_scale(self, opts):
+        return 1.
+
+    def _decoder_for_export(self, opts, noise):
+        """Decoder applied to noise, in the inference mode.
+
+        """
+        return self.generator(opts, noise, False)
+
     def train_mixture_discriminator(self, opts, fake_images):
         """Train classifier separating true data from points in fake_images.
 
@@ -280,8 +339,10 @@ class ImageVae(Vae):
         # Placeholders
         real_points_ph = tf.placeholder(
             tf.float32, [None] + list(data_shape), name='real_points_ph')
-        noise_ph = tf.placeholder(
-            tf.float32, [None] + [opts['latent_space_dim']], name='noise_ph')
+        # Noise is sampled in the graph unless noise_ph is fed
+        noise_ph, _ = ops.noise_placeholder(
+            opts, num=tf.shape(real_points_ph)[0])
+        real_weights_ph = ops.weights_placeholder(real_points_ph)
         is_training_ph = tf.placeholder(tf.bool, name='is_train_ph')
         lr_decay_ph = tf.placeholder(tf.float32)
 
@@ -319,8 +380,8 @@ class ImageVae(Vae):
         dec_enc_x = self.generator(opts, latent_x_mean,
                                    is_training=False, reuse=True)
 
-        loss_reconstruct = tf.reduce_mean(loss_reconstruct)
-        loss_kl = tf.reduce_mean(loss_kl)
+        loss_reconstruct = ops.weighted_mean(loss_reconstruct, real_weights_ph)
+        loss_kl = ops.weighted_mean(loss_kl, real_weights_ph)
         loss = loss_kl + loss_reconstruct
         # loss = tf.Print(loss, [loss, loss_kl, loss_reconstruct], 'Loss, KL, reconstruct')
         optim = ops.optimizer(opts, decay=lr_decay_ph).minimize(loss)
@@ -329,6 +390,7 @@ class ImageVae(Vae):
                                           is_training_ph, reuse=True)
 
         self._real_points_ph = real_points_ph
+        self._real_weights_ph = real_weights_ph
         self._noise_ph = noise_ph
         self._is_training_ph = is_training_ph
         self._optim = optim
@@ -363,7 +425,11 @@ class ImageVae(Vae):
         train_size = self._data.num_points
         num_plot = 320
         sample_prev = np.zeros([num_plot] + list(self._data.data_shape))
-        l2s = []
+        train_metrics = utils.TrainingMetrics(
+            ['loss', 'loss_kl', 'loss_rec', 'l2'], window=batches_num)
+        sampler = utils.MinibatchSampler(
+            self._data_weights, opts['batch_size'],
+            opts.get('weights_mode', 'resample'))
 
         counter = 0
         decay = 1.
@@ -379,26 +445,26 @@ class ImageVae(Vae):
                     decay = decay / 10.
 
             if _epoch > 0 and _epoch % opts['save_every_epoch'] == 0:
-                os.path.join(opts['work_dir'], opts['ckpt_dir'])
-                self._saver.save(self._session,
-                                 os.path.join(opts['work_dir'],
-                                              opts['ckpt_dir'],
-                                              'trained-pot'),
-                                 global_step=counter)
+                self._checkpointer.save(
+                    os.path.join(opts['work_dir'],
+                                 opts['ckpt_dir'],
+                                 'trained-pot'),
+                    global_step=counter,
+                    score=train_metrics.mean('loss'))
 
             for _idx in xrange(batches_num):
                 # logging.error('Step %d of %d' % (_idx, batches_num ) )
-                data_ids = np.random.choice(train_size, opts['batch_size'],
-                                            replace=False, p=self._data_weights)
+                data_ids, batch_weights = sampler.sample()
                 batch_images = self._data.data[data_ids].astype(np.float)
-                batch_noise = utils.generate_noise(opts, opts['batch_size'])
                 _, loss, loss_kl, loss_reconstruct = self._session.run(
                     [self._optim, self._loss, self._loss_kl,
                      self._loss_reconstruct],
                     feed_dict={self._real_points_ph: batch_images,
-                               self._noise_ph: batch_noise,
+                               self._real_weights_ph: batch_weights,
                                self._lr_decay_ph: decay,
                                self._is_training_ph: True})
+                train_metrics.update(loss=loss, loss_kl=loss_kl,
+                                     loss_rec=loss_reconstruct)
                 counter += 1
 
                 if opts['verbose'] and counter % opts['plot_every'] == 0:
@@ -414,8 +480,9 @@ class ImageVae(Vae):
                         opts, self._generated, self._noise_ph,
                         self._noise_for_plots[0:num_plot],
                         self._is_training_ph, False)
-                    l2s.append(np.sum((points_to_plot - sample_prev)**2))
-                    metrics.l2s = l2s[:]
+                    train_metrics.update(
+                        l2=np.sum((points_to_plot - sample_prev)**2))
+                    metrics.l2s_steps, metrics.l2s = train_metrics.history('l2')
                     metrics.make_plots(
                         opts,
                         counter,
@@ -436,18 +503,17 @@ class ImageVae(Vae):
                 if opts['early_stop'] > 0 and counter > opts['early_stop']:
                     break
         if _epoch > 0:
-            os.path.join(opts['work_dir'], opts['ckpt_dir'])
-            self._saver.save(self._session,
-                             os.path.join(opts['work_dir'],
-                                          opts['ckpt_dir'],
-                                          'trained-pot-final'),
-                             global_step=counter)
+            self._checkpointer.save(
+                os.path.join(opts['work_dir'],
+                             opts['ckpt_dir'],
+                             'trained-pot-final'),
+                global_step=counter)
 
     def _sample_internal(self, opts, num):
         """Sample from the trained GAN model.
 
         """
-        noise = utils.generate_noise(opts, num)
+        noise = utils.noise_pool(opts).get(num)
         sample = self._run_batch(
             opts, self._generated, self._noise_ph, noise,
             self._is_training_ph, False)